@@ -57,8 +57,11 @@ class ApiTool(SimpleItem):
     security.declareProtected(view_management_screens, 'dump_ldap')
 
     def dump_ldap(self, REQUEST=None, RESPONSE=None):
-        """ """
-        dump_ldap(LDAP_DISK_STORAGE)
+        """ Dump LDAP to LDAP_DISK_STORAGE; with `incremental` in the query
+        string, only the changes since the last dump are applied """
+        incremental = bool(REQUEST is not None and
+                           REQUEST.form.get('incremental'))
+        dump_ldap(LDAP_DISK_STORAGE, incremental=incremental)
         return 'FINISHED dump_ldap @ {}/ to {}'.format(
             self.absolute_url(),
             LDAP_DISK_STORAGE
@@ -0,0 +1,375 @@
+""" Disable the users that haven't logged in for a long time
+
+The decisions are made from the LDAP dump and the login statistics feed
+and applied by `apply_decisions`, which sends the emails through a
+`Notifier`. `AutomatedUserDisabler` uses them inside Zope; `main` is a
+runner that doesn't need Zope at all: it reads its settings from
+config.yaml, next to the dump, and writes to LDAP directly. With
+buildout::
+
+    [auto-disable]
+    recipe = zc.recipe.egg
+    eggs = eea.ldapadmin
+    scripts = auto_disable_users
+    arguments = "${buildout:directory}/var/log/ldap/"
+
+and ``bin/auto_disable_users --dry-run`` only prints what would be done.
+"""
+import logging
+import os.path
+import sys
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+
+import ldap
+import requests
+import transaction
+import yaml
+from dateutil import parser
+from eea.usersdb import UsersDB
+from eea.usersdb.db_agent import UserNotFound
+
+import ldapdump
+import mail_outbox
+from constants import LDAP_DISK_STORAGE, NETWORK_NAME
+
+log = logging.getLogger(__name__)
+
+DISABLE_DELTA = timedelta(days=780)
+ONE_MONTH = timedelta(days=30)
+SERVICE_URL = "http://ldapmon.eea.europa.eu/export"
+# seconds to wait for the login statistics
+SERVICE_TIMEOUT = 60
+LDAP_PREDISABLE_FIELDNAME = "employeeNumber"
+
+ACTIONS = ('predisable', 'disable', 'remove_pending')
+
+NO_REPLY = "no-reply@eea.europa.eu"
+HELPDESK = "helpdesk@eea.europa.eu"
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'zpt', 'users')
+
+
+def login_statistics(url=SERVICE_URL):
+    """ A dict of user id -> date of the last login """
+    return requests.get(url, timeout=SERVICE_TIMEOUT).json()
+
+
+def user_records(dump_users):
+    """ Yield the `ldapdump.DumpUser`s that have an email as dicts """
+    for user in dump_users:
+        if not user.mail:   # probably a system user
+            continue
+        yield dict(
+            disabled=user.status in ['disabled'],
+            dn=user.dn,
+            email=user.mail,
+            full_name=user.cn,
+            id=user.uid,
+            pending_disable=user.pending_disable,
+            username=user.uid,
+        )
+
+
+def decide(users, users_stats, now, disable_delta=DISABLE_DELTA,
+           one_month=ONE_MONTH):
+    """ Yield (action, user) for the `users` to 'predisable', 'disable'
+    or 'remove_pending', based on their last login in `users_stats` """
+
+    for user in users:
+        if user['disabled']:
+            continue
+        last_login = users_stats.get(user['username'])
+
+        if not last_login:
+            continue
+        last_login = parser.parse(last_login)
+        user['last_login'] = last_login
+
+        # check if the user has logged during in the one month period
+        pending_disable = user.get('pending_disable')
+
+        if pending_disable:
+            pending_disable = parser.parse(pending_disable)
+
+            if last_login > pending_disable:
+                yield 'remove_pending', user
+
+                continue
+
+        if last_login + disable_delta < now:
+            if pending_disable:
+                if (pending_disable + one_month) < now:
+                    # double check if everything is ok
+
+                    if (last_login + disable_delta + one_month) < now:
+                        yield 'disable', user
+            else:
+                yield 'predisable', user
+
+
+def group_decisions(decisions):
+    """ A dict of action -> list of users """
+    result = dict((action, []) for action in ACTIONS)
+
+    for action, user in decisions:
+        result[action].append(user)
+
+    return result
+
+
+def read_live_state(agent, user):
+    """ Update `user` with the predisable timestamp and the status stored in
+    LDAP now; returns False if the user doesn't exist anymore """
+    try:
+        result = agent.conn.search_s(
+            agent._user_dn(user['username']), ldap.SCOPE_BASE,
+            attrlist=[LDAP_PREDISABLE_FIELDNAME, 'employeeType'])
+    except ldap.NO_SUCH_OBJECT:
+        return False
+
+    if not result:
+        return False
+    dn, attrs = result[0]
+    user['pending_disable'] = (
+        attrs.get(LDAP_PREDISABLE_FIELDNAME, [''])[0] or None)
+    user['disabled'] = attrs.get('employeeType', [''])[0] == 'disabled'
+
+    return True
+
+
+def recheck(agent, decisions, users_stats, now, disable_delta=DISABLE_DELTA,
+            one_month=ONE_MONTH):
+    """ Decide again for the users of `decisions`, with their state read
+    from LDAP. The dump may be older than the last run: the users it shows
+    without a predisable timestamp may have been warned already, and
+    warning them again would postpone their disabling forever. """
+    users = [user for action in ACTIONS for user in decisions[action]
+             if read_live_state(agent, user)]
+
+    return group_decisions(decide(users, users_stats, now, disable_delta,
+                                  one_month))
+
+
+def set_predisable(agent, user, value):
+    """ Store the predisable timestamp (or '' to remove it) on the user;
+    returns False if the user doesn't exist anymore """
+    try:
+        result = agent.conn.modify_s(
+            agent._user_dn(user['username']),
+            [(ldap.MOD_REPLACE, LDAP_PREDISABLE_FIELDNAME, value), ]
+        )
+    except ldap.NO_SUCH_OBJECT:
+        return False
+    assert result[:2] == (ldap.RES_MODIFY, [])
+
+    return True
+
+
+class Notifier(object):
+    """ The emails of the automated disabling. `render(name, **options)`
+    returns the body made from the zpt/users template `name` and
+    `send(addr_from, addr_to, message)` sends a `MIMEText` message. """
+
+    def __init__(self, render, send, site_title, helpdesk=HELPDESK):
+        self.render = render
+        self.send = send
+        self.site_title = site_title
+        self.helpdesk = helpdesk
+
+    def _send(self, addr_to, subject, template, **options):
+        options['site_title'] = self.site_title
+        body = self.render(template, **options)
+        message = MIMEText('')
+        message['From'] = NO_REPLY
+        message['To'] = addr_to
+        message['Subject'] = subject
+        message.set_payload(body.encode('utf-8'), charset='utf-8')
+        self.send(NO_REPLY, addr_to, message)
+
+    def predisabled(self, user):
+        self._send(user['email'], "[You will be automatically disabled]",
+                   'email_auto_predisabled.zpt', **user)
+
+    def disabled(self, user):
+        self._send(user['email'], "[You have been automatically disabled]",
+                   'email_auto_disabled.zpt', **user)
+
+    def report(self, decisions, days):
+        self._send(self.helpdesk, "[Report on auto-disabled users]",
+                   'email_report_autodisable.zpt',
+                   users_predisable=decisions['predisable'],
+                   users_disable=decisions['disable'], days=days)
+
+
+def apply_decisions(agent, decisions, users_stats, now, notifier,
+                    disable_delta=DISABLE_DELTA, one_month=ONE_MONTH):
+    """ Act on the candidates of `decisions`, decided again on their state
+    in LDAP (see `recheck`): warn, disable or remove the predisable
+    timestamp, tell the users with `notifier` and send the helpdesk a
+    report, if anything was done. Returns the decisions applied. """
+    decisions = recheck(agent, decisions, users_stats, now, disable_delta,
+                        one_month)
+    applied = dict((action, []) for action in ACTIONS)
+
+    for user in decisions['predisable']:
+        log.warn("User will be disabled the next check %s", user['username'])
+
+        if not set_predisable(agent, user, datetime.now().isoformat()):
+            log.info("Could not predisable user: %s", user['dn'])
+
+            continue
+        notifier.predisabled(user)
+        applied['predisable'].append(user)
+
+    for user in decisions['disable']:
+        log.warn("Disabling user %s", user['username'])
+        try:
+            agent.disable_user(user['username'])
+        except (UserNotFound, ldap.NO_SUCH_OBJECT):
+            log.info("Could not disable user: %s", user['dn'])
+
+            continue
+        notifier.disabled(user)
+        applied['disable'].append(user)
+
+    for user in decisions['remove_pending']:
+        log.warn("Removing predisable for user %s", user['username'])
+
+        if not set_predisable(agent, user, ''):
+            log.info("Could not remove predisable for user: %s", user['dn'])
+
+            continue
+        applied['remove_pending'].append(user)
+
+    if any(applied.values()):
+        notifier.report(applied, (disable_delta + one_month).days)
+
+    return applied
+
+
+def report(decisions, dry_run=False):
+    """ What is (or, on a dry run, would be) done to which users """
+    lines = ["%sPredisabled %s users, disabled %s users, removed the "
+             "predisable of %s users" % (
+                 dry_run and "DRY RUN: " or "",
+                 len(decisions['predisable']), len(decisions['disable']),
+                 len(decisions['remove_pending']))]
+
+    for action in ACTIONS:
+        for user in decisions[action]:
+            lines.append("%s %s (last login %s)" % (
+                action, user['username'],
+                user['last_login'].strftime('%Y-%m-%d')))
+
+    return '\n'.join(lines)
+
+
+def read_config(ldap_logging_path):
+    """ The settings of the runner, from the `ldap`, `smtp` and optional
+    `auto_disable` sections of config.yaml """
+    with open(os.path.join(ldap_logging_path, 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+    dump_ldap = config['ldap']
+    settings = {
+        # UsersDB connects with ldap:// on the default port, then StartTLS
+        'ldap_server': dump_ldap['host'],
+        'start_tls': True,
+        'users_dn': 'ou=Users,o=EIONET,l=Europe',
+        'orgs_dn': 'ou=Organisations,o=EIONET,l=Europe',
+        'roles_dn': 'ou=Roles,o=EIONET,l=Europe',
+        'admin_dn': dump_ldap.get('dn'),
+        'admin_pw': dump_ldap.get('password'),
+        'service_url': SERVICE_URL,
+        'site_title': NETWORK_NAME,
+        'helpdesk': HELPDESK,
+        'smtp': config.get('smtp') or {},
+    }
+    settings.update(config.get('auto_disable') or {})
+    settings['db_path'] = os.path.join(ldap_logging_path,
+                                       ldapdump.DUMP_FILENAME)
+    settings['outbox_path'] = os.path.join(ldap_logging_path,
+                                           mail_outbox.OUTBOX_DIRNAME)
+
+    return settings
+
+
+class OfflineDisabler(object):
+    """ Runs the automated disabling with the settings from `read_config`
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.outbox = mail_outbox.MaildirOutbox(settings['outbox_path'],
+                                                settings['smtp'])
+
+    def connect(self):
+        agent = UsersDB(ldap_server=self.settings['ldap_server'],
+                        users_rdn='uid',
+                        users_dn=self.settings['users_dn'],
+                        orgs_dn=self.settings['orgs_dn'],
+                        roles_dn=self.settings['roles_dn'])
+        if self.settings['start_tls']:
+            # UsersDB connects with ldap://, don't send the password in clear
+            agent.conn.start_tls_s()
+        agent.perform_bind(self.settings['admin_dn'],
+                           self.settings['admin_pw'])
+
+        return agent
+
+    def render(self, name, **options):
+        from zope.pagetemplate.pagetemplatefile import PageTemplateFile
+
+        template = PageTemplateFile(os.path.join(TEMPLATES_DIR, name))
+
+        return template(**options)
+
+    def send(self, addr_from, addr_to, message):
+        self.outbox.put(addr_from, [addr_to], message.as_string())
+
+    def apply(self, decisions, users_stats, now):
+        """ `apply_decisions`, connected to LDAP; the emails are sent
+        before returning """
+        notifier = Notifier(self.render, self.send,
+                            self.settings['site_title'],
+                            self.settings['helpdesk'])
+        agent = self.connect()
+        try:
+            decisions = apply_decisions(agent, decisions, users_stats, now,
+                                        notifier)
+        finally:
+            agent.conn.unbind_s()
+
+        # the emails are queued when the transaction commits
+        transaction.commit()
+        self.outbox.flush()
+
+        return decisions
+
+    def run(self, dry_run=False, now=None):
+        """ Decide from the dump and, unless `dry_run`, act on the
+        candidates after reading their state again from LDAP """
+        now = now or datetime.now()
+        users = user_records(ldapdump.load_users(self.settings['db_path']))
+        users_stats = login_statistics(self.settings['service_url'])
+        decisions = group_decisions(decide(users, users_stats, now))
+
+        if not dry_run and any(decisions.values()):
+            decisions = self.apply(decisions, users_stats, now)
+
+        return report(decisions, dry_run)
+
+
+def main(ldap_logging_path=None, dry_run=None):
+    """ Console script: ``auto_disable_users [folder of config.yaml]
+    [--dry-run]`` """
+    args = sys.argv[1:]
+
+    if dry_run is None:
+        dry_run = '--dry-run' in args
+    args = [arg for arg in args if arg != '--dry-run']
+    ldap_logging_path = ldap_logging_path or (args and args[0]) or \
+        LDAP_DISK_STORAGE
+    logging.basicConfig(level=logging.INFO)
+
+    print OfflineDisabler(read_config(ldap_logging_path)).run(dry_run)
@@ -0,0 +1,253 @@
+""" Persistent queue of bulk user creation jobs
+
+A job holds the rows of a spreadsheet, each with the user info to create;
+no passwords, they are made up by the worker creating the user.
+The rows are kept in a sqlite database next to the LDAP dump, so a job
+goes on after a restart, and are processed by a pool of worker threads.
+"""
+import json
+import logging
+import os.path
+import sqlite3
+import threading
+import time
+
+from constants import LDAP_DISK_STORAGE
+
+log = logging.getLogger(__name__)
+
+JOBS_FILENAME = 'bulk_jobs.db'
+
+# rows a worker takes from a job at once
+CLAIM_SIZE = 10
+# a row still running after this many seconds is taken to be abandoned,
+# e.g. by a stopped instance, and is queued again; the claim of the rows
+# a worker holds is renewed after each row it finishes
+STALE_AFTER = 600
+# seconds an idle worker waits before looking for new rows
+POLL_INTERVAL = 30
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class JobStore(object):
+    """ The jobs and their rows, in the sqlite database at `db_path` """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            if not LDAP_DISK_STORAGE:
+                raise ValueError("LDAP_DISK_STORAGE is not set, there is "
+                                 "no folder for the bulk creation jobs")
+            db_path = os.path.join(LDAP_DISK_STORAGE, JOBS_FILENAME)
+        self.db_path = db_path
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS jobs "
+                             "(id INTEGER PRIMARY KEY, tool_path TEXT, "
+                             "author TEXT, created REAL, errors TEXT)")
+                conn.execute("CREATE TABLE IF NOT EXISTS job_rows "
+                             "(job_id INTEGER, row INTEGER, user_info TEXT, "
+                             "status TEXT, claimed REAL, message TEXT, "
+                             "PRIMARY KEY (job_id, row))")
+                conn.execute("CREATE INDEX IF NOT EXISTS job_rows_status "
+                             "ON job_rows (status, job_id)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def add_job(self, tool_path, author, rows, errors=()):
+        """ Queue the creation of the users in `rows`, (spreadsheet row
+        number, user info dict) pairs, by the tool at `tool_path`, for
+        `author`; `errors` are the ones found when the spreadsheet was
+        checked. Returns the id of the job. """
+        conn = self._connect()
+        try:
+            with conn:
+                job_id = conn.execute(
+                    "INSERT INTO jobs (tool_path, author, created, errors) "
+                    "VALUES (?, ?, ?, ?)",
+                    ('/'.join(tool_path), author, time.time(),
+                     json.dumps(list(errors)))).lastrowid
+                conn.executemany(
+                    "INSERT INTO job_rows VALUES (?, ?, ?, ?, NULL, '')",
+                    ((job_id, row, json.dumps(user_info), QUEUED)
+                     for row, user_info in rows))
+        finally:
+            conn.close()
+
+        return job_id
+
+    def claim(self, size=CLAIM_SIZE, now=None):
+        """ Mark up to `size` rows of the oldest job with work left as
+        running. Returns a tuple of (job info dict, list of (row, user info))
+        or None if there is nothing to do. """
+        now = now or time.time()
+        conn = self._connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                available = ("(status = ? OR (status = ? AND claimed < ?))")
+                args = [QUEUED, RUNNING, now - STALE_AFTER]
+                row = conn.execute("SELECT job_id FROM job_rows WHERE %s "
+                                   "ORDER BY job_id LIMIT 1" % available,
+                                   args).fetchone()
+
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                job_id = row[0]
+                rows = conn.execute(
+                    "SELECT row, user_info FROM job_rows WHERE job_id = ? "
+                    "AND %s ORDER BY row LIMIT ?" % available,
+                    [job_id] + args + [size]).fetchall()
+                conn.executemany(
+                    "UPDATE job_rows SET status = ?, claimed = ? "
+                    "WHERE job_id = ? AND row = ?",
+                    [(RUNNING, now, job_id, number) for number, _ in rows])
+                tool_path, author = conn.execute(
+                    "SELECT tool_path, author FROM jobs WHERE id = ?",
+                    (job_id,)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        job = {'id': job_id, 'tool_path': tool_path.split('/'),
+               'author': author}
+
+        return job, [(number, json.loads(user_info))
+                     for number, user_info in rows]
+
+    def finish(self, job_id, row, status, message=''):
+        """ Record the outcome of a row """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE job_rows SET status = ?, message = ? "
+                    "WHERE job_id = ? AND row = ?",
+                    (status, message, job_id, row))
+        finally:
+            conn.close()
+
+    def renew(self, job_id, rows, now=None):
+        """ Renew the claim of the `rows` of a job still running, so they
+        are not taken to be abandoned while the worker gets to them """
+        now = now or time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE job_rows SET claimed = ? WHERE job_id = ? "
+                    "AND row = ? AND status = ?",
+                    [(now, job_id, row, RUNNING) for row in rows])
+        finally:
+            conn.close()
+
+    def progress(self, job_id):
+        """ The state of a job: the number of rows queued, running, done and
+        failed, the messages of the finished rows and the errors found
+        when the spreadsheet was checked; None if there is no such job """
+        conn = self._connect()
+        try:
+            job = conn.execute("SELECT author, errors FROM jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+
+            if job is None:
+                return None
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM job_rows WHERE job_id = ? "
+                "GROUP BY status", (job_id,)).fetchall())
+            messages = conn.execute(
+                "SELECT row, status, message FROM job_rows WHERE job_id = ? "
+                "AND status IN (?, ?) ORDER BY row",
+                (job_id, DONE, FAILED)).fetchall()
+        finally:
+            conn.close()
+
+        result = dict((status, counts.get(status, 0))
+                      for status in (QUEUED, RUNNING, DONE, FAILED))
+        result['author'] = job[0]
+        result['errors'] = json.loads(job[1])
+        result['messages'] = [{'row': row, 'status': status,
+                               'message': message}
+                              for row, status, message in messages]
+        result['finished'] = not (result[QUEUED] or result[RUNNING])
+
+        return result
+
+
+class JobRunner(object):
+    """ A pool of `size` worker threads processing the rows of the jobs in
+    `store`
+
+    `processor(job, rows, report)` is called with the rows claimed from a
+    job and must call `report(row, status, message)` for each of them.
+    """
+
+    def __init__(self, store, processor, size=4):
+        self.store = store
+        self.processor = processor
+        self.size = size
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads
+                             if thread.is_alive()]
+
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work,
+                                          name='bulk-create-worker')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        """ Wake up the workers, there are new rows """
+        self._wakeup.set()
+
+    def run_once(self):
+        """ Process one claim of rows; returns False if there was none """
+        claimed = self.store.claim()
+
+        if claimed is None:
+            return False
+        job, rows = claimed
+        reported = set()
+
+        def report(row, status, message=''):
+            reported.add(row)
+            self.store.finish(job['id'], row, status, message)
+            self.store.renew(job['id'], [number for number, _ in rows
+                                         if number not in reported])
+
+        try:
+            self.processor(job, rows, report)
+        except Exception:
+            log.exception("Bulk creation job %s failed", job['id'])
+
+            for row, user_info in rows:
+                if row not in reported:
+                    report(row, FAILED, "Error creating %s user" %
+                           user_info.get('id'))
+
+        return True
+
+    def _work(self):
+        while True:
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                log.exception("Could not claim bulk creation rows")
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
@@ -0,0 +1,149 @@
+""" Server-side processing for the DataTables grids
+
+The parameters and the response follow the DataTables 1.10 protocol
+(`draw`, `start`, `length`, `order[0][column]`, `search[value]`) or, when
+the grid was set up with `sAjaxSource`, the legacy one (`sEcho`,
+`iDisplayStart`, `iDisplayLength`, `iSortCol_0`, `sSearch`).
+"""
+import json
+
+# most rows returned for a single page, also when "All" is requested
+MAX_PAGE_LENGTH = 1000
+
+
+def _int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace').lower()
+
+    return unicode(value or '').lower()
+
+
+def contains(search, *values):
+    """ True if the (lowercase) `search` term is in any of `values` """
+    return any(search in _text(value) for value in values)
+
+
+def read_params(form):
+    """ Return the paging, sorting and search parameters of a DataTables
+    request as a dict with the keys `draw`, `legacy`, `start`, `length`,
+    `sort_column` (index), `sort_desc`, `search` (lowercase) and
+    `columns` (the data names of the columns, if sent)
+    """
+    legacy = 'sEcho' in form
+
+    if legacy:
+        params = {
+            'draw': _int(form.get('sEcho'), 0),
+            'start': _int(form.get('iDisplayStart'), 0),
+            'length': _int(form.get('iDisplayLength'), 10),
+            'sort_column': _int(form.get('iSortCol_0'), 0),
+            'sort_desc': form.get('sSortDir_0') == 'desc',
+            'search': form.get('sSearch', ''),
+        }
+    else:
+        params = {
+            'draw': _int(form.get('draw'), 0),
+            'start': _int(form.get('start'), 0),
+            'length': _int(form.get('length'), 10),
+            'sort_column': _int(form.get('order[0][column]'), 0),
+            'sort_desc': form.get('order[0][dir]') == 'desc',
+            'search': form.get('search[value]', ''),
+        }
+
+    # the names of the columns, when the grid sets `columns[i][data]`
+    names, i = [], 0
+    name_param = 'mDataProp_%d' if legacy else 'columns[%d][data]'
+
+    while name_param % i in form:
+        names.append(form[name_param % i])
+        i += 1
+    params['columns'] = names
+
+    if isinstance(params['search'], str):
+        params['search'] = params['search'].decode('utf-8')
+    params['search'] = params['search'].strip().lower()
+    params['start'] = max(params['start'], 0)
+
+    if not 0 < params['length'] <= MAX_PAGE_LENGTH:
+        params['length'] = MAX_PAGE_LENGTH
+    params['legacy'] = legacy
+
+    return params
+
+
+def response(params, data, total, filtered):
+    """ The DataTables response for a page of `data` (a list of rows) """
+    if params['legacy']:
+        return {'sEcho': params['draw'], 'iTotalRecords': total,
+                'iTotalDisplayRecords': filtered, 'aaData': data}
+
+    return {'draw': params['draw'], 'recordsTotal': total,
+            'recordsFiltered': filtered, 'data': data}
+
+
+def sort_key(params, columns):
+    """ The key of `columns` the grid is sorted by, or None """
+    names = params['columns'] or columns
+    index = params['sort_column']
+
+    if 0 <= index < len(names) and names[index] in columns:
+        return names[index]
+
+
+def page_rows(rows, columns, params):
+    """ Search, sort and slice `rows` (dicts) in memory; `columns` are the
+    keys the grid can be searched and sorted by. Returns the DataTables
+    response.
+    """
+    search = params['search']
+
+    if search:
+        filtered = [row for row in rows
+                    if contains(search, *[row.get(key) for key in columns])]
+    else:
+        filtered = list(rows)
+
+    key = sort_key(params, columns)
+
+    if key is not None:
+        filtered.sort(key=lambda row: _text(row.get(key)),
+                      reverse=params['sort_desc'])
+
+    start = params['start']
+    page = filtered[start:start + params['length']]
+
+    return response(params, page, len(rows), len(filtered))
+
+
+def page_sorted(rows, params, matches=None):
+    """ The page of `rows`, already sorted ascending by the column the grid
+    is sorted by, as a tuple of (page, filtered count). When searching,
+    the rows `matches(row, search)` finds are kept; otherwise only the
+    rows of the page are copied.
+    """
+    search = params['search']
+
+    if search and matches is not None:
+        rows = [row for row in rows if matches(row, search)]
+    start, stop = params['start'], params['start'] + params['length']
+
+    if params['sort_desc']:
+        count = len(rows)
+        page = rows[max(count - stop, 0):max(count - start, 0)][::-1]
+    else:
+        page = rows[start:stop]
+
+    return page, len(rows)
+
+
+def render_json(REQUEST, result):
+    REQUEST.RESPONSE.setHeader('Content-Type', 'application/json')
+
+    return json.dumps(result, default=str)
@@ -1,9 +1,22 @@
-import yaml
+""" The roles of a user in the other Eionet services
+
+The services are the `endpoints` of config.yaml, read again only when the
+file changes. The profile page asks for each service separately, so a
+slow service only delays its own answer; each service is asked with its own
+timeout and `ProfileCache` keeps its answers about a user for a while.
+"""
+import logging
 import os
+import threading
+import time
+
 import requests
+import yaml
 
 from App.config import getConfiguration
 
+log = logging.getLogger(__name__)
+
 CONFIG = getConfiguration()
 if hasattr(CONFIG, 'environment'):
     CONFIG.environment.update(os.environ)
@@ -11,26 +24,102 @@ if hasattr(CONFIG, 'environment'):
 LDAP_DISK_STORAGE = getattr(CONFIG, 'environment', {}).\
                             get('LDAP_DISK_STORAGE', '')
 
+# seconds to wait for a service, unless its endpoint sets a `timeout`
+TIMEOUT = 20
+# seconds the answers of a service about a user are reused
+CACHE_TTL = 300
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+def config_path():
+    return os.path.abspath(os.path.join(LDAP_DISK_STORAGE, "config.yaml"))
+
 
 def get_endpoints():
     """
     Reads config.yaml file if exists and returns list of configured endpoints
     """
+    path = config_path()
     try:
-        config_file = open(os.path.abspath(os.path.join(LDAP_DISK_STORAGE,
-                                                        "config.yaml")), "r")
-    except Exception:
+        mtime = os.path.getmtime(path)
+    except OSError:
         return []
-    config = yaml.load(config_file)
-    return config.get('endpoints', [])
+
+    with _endpoints_lock:
+        if _endpoints.get('key') != (path, mtime):
+            with open(path, "r") as config_file:
+                config = yaml.safe_load(config_file) or {}
+            _endpoints['key'] = (path, mtime)
+            _endpoints['endpoints'] = config.get('endpoints') or []
+
+        return _endpoints['endpoints']
 
 
 def get_endpoint_data(endpoint, userid):
-    """ Performs query to endpoint. May be slow or unsuccessful. """
+    """ Performs query to endpoint. May be slow or unsuccessful; raises
+    `requests.RequestException` if the service doesn't answer with 200. """
     _ = endpoint
     req = requests.get(_['url'], params={'userid': userid},
-                       auth=(_['user'], _['password']))
-    if req.status_code == 200:
-        return req.json()
-    else:
-        return {}
+                       auth=(_['user'], _['password']),
+                       timeout=_.get('timeout', TIMEOUT))
+    if req.status_code != 200:
+        raise requests.HTTPError("HTTP %s" % req.status_code, response=req)
+
+    return req.json()
+
+
+def _query(endpoint, userid):
+    """ The answer of a service, as a dict with the `data`, the `error` (if
+    it failed) and the `latency` in seconds """
+    started = time.time()
+    try:
+        data, error = get_endpoint_data(endpoint, userid), None
+    except (requests.RequestException, ValueError), e:
+        log.warning("Could not get the roles of %s from %s: %s",
+                    userid, endpoint['url'], e)
+        data, error = {}, str(e) or e.__class__.__name__
+
+    return {'data': data, 'error': error,
+            'latency': round(time.time() - started, 3)}
+
+
+class ProfileCache(object):
+    """ The answers of the services about the users; the successful ones
+    are kept for `ttl` seconds """
+
+    def __init__(self, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def answer(self, endpoint, userid, now=None):
+        """ The answer of the service at `endpoint` about `userid`, see
+        `_query`; asked in the calling thread, within the endpoint's
+        timeout, unless it is known """
+        now = now or time.time()
+        key = (userid, endpoint['title'])
+
+        with self._lock:
+            entry = self._cache.get(key)
+
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        result = _query(endpoint, userid)
+
+        if result['error'] is None:
+            with self._lock:
+                for old_key, old_entry in self._cache.items():
+                    if old_entry[0] <= now:
+                        del self._cache[old_key]
+                self._cache[key] = (now + self.ttl, result)
+
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+profile_cache = ProfileCache()
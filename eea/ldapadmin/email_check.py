@@ -0,0 +1,84 @@
+""" Checks of lists of email addresses, for bulk verification and imports
+
+Addresses are compared case-insensitively, through sets, and looked up in
+LDAP in chunks so that a long list doesn't build a huge search filter.
+"""
+import re
+from collections import Counter
+
+import colander
+
+# values looked up in LDAP with one search
+LOOKUP_CHUNK = 200
+
+
+def split_emails(text):
+    """ The addresses in `text`, separated by spaces, commas or new lines
+    """
+    return [email for email in re.split(r'[\s,]+', text or '') if email]
+
+
+def find_duplicates(values):
+    """ Split `values` in the first occurrence of each (ignoring case) and
+    the ones repeated """
+    seen = set()
+    singles, duplicates = [], []
+
+    for value in values:
+        key = value.lower()
+
+        if key in seen:
+            duplicates.append(value)
+        else:
+            seen.add(key)
+            singles.append(value)
+
+    return singles, duplicates
+
+
+def repeated(values):
+    """ A dict of value (lower case) -> count, for the values that appear
+    more than once, ignoring case """
+    return dict((value, count) for value, count in
+                Counter(value.lower() for value in values).iteritems()
+                if count > 1)
+
+
+def existing(lookup, values, chunk=LOOKUP_CHUNK):
+    """ The `values` found by `lookup` (e.g. `agent.existing_emails`),
+    asking for `chunk` of them at a time """
+    values = sorted(set(values))
+    found = []
+
+    for start in range(0, len(values), chunk):
+        found.extend(lookup(values[start:start + chunk]))
+
+    return found
+
+
+def check_emails(agent, emails, node):
+    """ Sort `emails` in duplicates, invalid ones (for the colander `node`),
+    ones already used in LDAP and valid ones, as expected by the
+    bulk_check_email page """
+    singles, duplicates = find_duplicates(emails)
+    valid, invalid = [], []
+
+    for email in singles:
+        try:
+            node.validator(node, email)
+        except colander.Invalid:
+            invalid.append(email)
+        else:
+            valid.append(email.lower())
+
+    taken = sorted(existing(agent.existing_emails, valid)) if valid else []
+    taken_keys = set(email.lower() for email in taken)
+
+    return {
+        'emails': sorted(singles),
+        'valid': sorted(email for email in valid if email not in taken_keys),
+        'invalid': invalid,
+        'taken': taken,
+        'bulk_emails': [],
+        'duplicates': sorted(duplicates),
+    }
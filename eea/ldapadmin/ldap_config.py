@@ -1,6 +1,13 @@
+import hashlib
+import logging
+import threading
+import time
+
+import ldap
 from eea.usersdb import UsersDB
 from ui_common import load_template
 
+log = logging.getLogger(__name__)
 
 defaults = {
     'admin_dn': "cn=Eionet Administrator,o=EIONET,l=Europe",
@@ -12,8 +19,18 @@ defaults = {
     'roles_dn': "ou=Roles,o=EIONET,l=Europe",
     'secondary_admin_dn': "cn=Accounts Browser,o=EIONET,l=Europe",
     'secondary_admin_pw': "",
+    'pool_size': 10,
 }
 
+# seconds an unused pooled connection is kept open before being closed
+POOL_MAX_IDLE = 300
+# seconds of idleness after which a pooled connection is checked before reuse
+POOL_CHECK_INTERVAL = 30
+
+_MISSING = object()
+
+REQUEST_CACHE_KEY = '_eea_ldapadmin_cache'
+
 
 def read_form(form, edit=False):
     config = dict((name, form.get(name, default))
@@ -29,7 +46,15 @@ def read_form(form, edit=False):
     return config
 
 
-def ldap_agent_with_config(config, bind=False, secondary=False):
+def _bind_credentials(config, secondary=False):
+    if secondary:
+        return config['secondary_admin_dn'], config['secondary_admin_pw']
+
+    return (config.get('admin_dn', config.get('browser_dn')),
+            config.get('admin_pw', config.get('browser_pw')))
+
+
+def _new_agent(config, bind=False, secondary=False):
     db = UsersDB(
         ldap_server=config.get('ldap_server', defaults['ldap_server']),
         # next is for bwd compat with objects created with v1.0.0
@@ -39,12 +64,7 @@ def ldap_agent_with_config(config, bind=False, secondary=False):
         roles_dn=config.get('roles_dn', defaults['roles_dn']))
 
     if bind:
-        if secondary:
-            db.perform_bind(config['secondary_admin_dn'],
-                            config['secondary_admin_pw'])
-        else:
-            db.perform_bind(config.get('admin_dn', config.get('browser_dn')),
-                            config.get('admin_pw', config.get('browser_pw')))
+        db.perform_bind(*_bind_credentials(config, secondary))
         legacy_ldap_server = config.get('legacy_ldap_server', None)
 
         if legacy_ldap_server:
@@ -61,4 +81,215 @@ def ldap_agent_with_config(config, bind=False, secondary=False):
     return db
 
 
+def _close_agent(agent):
+    try:
+        agent.conn.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+
+class AgentPool(object):
+    """ A thread-safe pool of bound `UsersDB` agents sharing the same
+    server and credentials.
+
+    At most `size` idle agents are kept; when all of them are borrowed a new
+    one is created and it is closed instead of pooled when given back.
+    """
+
+    def __init__(self, factory, size, max_idle=POOL_MAX_IDLE,
+                 check_interval=POOL_CHECK_INTERVAL):
+        self.factory = factory
+        self.size = size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self._idle = []     # (agent, last_used) pairs
+        self._lock = threading.Lock()
+
+    def _is_alive(self, agent):
+        try:
+            agent.conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                                ['1.1'])
+        except ldap.LDAPError:
+            return False
+
+        return True
+
+    def evict_idle(self, now=None):
+        """ Close the connections that were not used for `max_idle` seconds
+        """
+        now = now or time.time()
+        with self._lock:
+            expired = [e for e in self._idle if now - e[1] > self.max_idle]
+            self._idle = [e for e in self._idle
+                          if now - e[1] <= self.max_idle]
+
+        for agent, last_used in expired:
+            _close_agent(agent)
+
+    def acquire(self):
+        """ Borrow an agent, reconnecting if the pooled one went stale """
+        self.evict_idle()
+
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                agent, last_used = self._idle.pop()
+
+            if time.time() - last_used < self.check_interval:
+                return agent
+
+            if self._is_alive(agent):
+                return agent
+            log.info("Discarding broken pooled LDAP connection")
+            _close_agent(agent)
+
+        agent = self.factory()
+        agent._pool_author = vars(agent).get('_author', _MISSING)
+
+        return agent
+
+    def release(self, agent):
+        """ Give back an agent borrowed with `acquire` """
+        author = getattr(agent, '_pool_author', _MISSING)
+
+        if author is _MISSING:
+            vars(agent).pop('_author', None)
+        else:
+            agent._author = author
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((agent, time.time()))
+
+                return
+        _close_agent(agent)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for agent, last_used in idle:
+            _close_agent(agent)
+
+
+class _AgentLease(object):
+    """ Held on the REQUEST; gives the agent back to its pool when the
+    request is closed
+    """
+
+    def __init__(self, pool, agent):
+        self.pool = pool
+        self.agent = agent
+
+    def __del__(self):
+        self.pool.release(self.agent)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_size(config):
+    try:
+        return int(config.get('pool_size', defaults['pool_size']) or 0)
+    except ValueError:
+        return defaults['pool_size']
+
+
+def _pool_key(config, bind, secondary):
+    key = [config.get(name, defaults[name]) for name in
+           ('ldap_server', 'users_rdn', 'users_dn', 'orgs_dn', 'roles_dn')]
+
+    if bind:
+        bind_dn, bind_pw = _bind_credentials(config, secondary)
+        key += [bind_dn, hashlib.sha1(bind_pw or '').hexdigest(), secondary]
+
+    return tuple(key)
+
+
+def get_pool(config, bind=False, secondary=False):
+    """ Return the shared `AgentPool` for this configuration """
+    key = _pool_key(config, bind, secondary)
+    with _pools_lock:
+        pool = _pools.get(key)
+
+        if pool is None:
+            config = dict(config)
+            factory = lambda: _new_agent(config, bind, secondary)
+            pool = _pools[key] = AgentPool(factory, _pool_size(config))
+        else:
+            pool.size = _pool_size(config)
+
+        pools = _pools.values()
+
+    # pools for changed credentials are never borrowed from again, so
+    # their idle connections are closed here
+    for other in pools:
+        if other is not pool:
+            other.evict_idle()
+
+    return pool
+
+
+def clear_pools():
+    """ Close all pooled connections """
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+
+    for pool in pools:
+        pool.clear()
+
+
+def ldap_agent_with_config(config, bind=False, secondary=False, request=None):
+    """ Return an `UsersDB` agent for `config`
+
+    When a `request` is given, the agent is borrowed from a connection pool
+    and given back once the request is closed. Otherwise a new connection
+    is opened.
+    """
+    if (not hasattr(request, '_hold') or config.get('legacy_ldap_server') or
+            not _pool_size(config)):
+        return _new_agent(config, bind, secondary)
+
+    pool = get_pool(config, bind, secondary)
+    agent = pool.acquire()
+    request._hold(_AgentLease(pool, agent))
+
+    return agent
+
+
+def request_cache(tool, name):
+    """ Return a dict for memoizing `name` lookups of `tool` during the
+    current request, or None when there is no request
+
+    The dicts are kept in REQUEST.other, which is cleared when the request
+    is closed.
+    """
+    other = getattr(getattr(tool, 'REQUEST', None), 'other', None)
+
+    if not isinstance(other, dict):
+        return None
+    caches = other.setdefault(REQUEST_CACHE_KEY, {})
+
+    return caches.setdefault((tool.getPhysicalPath(), name), {})
+
+
+def request_agent(tool, factory, bind=False, secondary=False):
+    """ Return the agent `factory(bind, secondary)` already made for `tool`
+    in the current request, making it on first use
+    """
+    agents = request_cache(tool, 'agents')
+
+    if agents is None:
+        return factory(bind, secondary)
+    key = (bind, secondary)
+
+    if key not in agents:
+        agents[key] = factory(bind, secondary)
+
+    return agents[key]
+
+
 edit_macro = load_template('zpt/ldap_config.zpt').macros['edit']
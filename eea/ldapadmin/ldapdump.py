@@ -1,16 +1,671 @@
+import json
 import logging
 import os.path
+import re
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import datetime, timedelta
 
+import ldap
+import yaml
+from DateTime import DateTime
+from ldap.controls import SimplePagedResultsControl
 from naaya.ldapdump import main
+from unidecode import unidecode
+
+from constants import LDAP_DISK_STORAGE
 
 
 log = logging.getLogger(__name__)
 
+DUMP_FILENAME = 'ldap_eionet_europa_eu.db'
+
+# changelog actions that give or take away one role (in data['role'])
+ROLE_ACTIONS = {
+    'ADDED_TO_ROLE': 'added',
+    'ADDED_AS_ROLE_OWNER': 'added',
+    'REMOVED_FROM_ROLE': 'removed',
+    'REMOVED_AS_ROLE_OWNER': 'removed',
+}
+# changelog actions that give or take away several roles (in data['roles'])
+ACCOUNT_ACTIONS = {
+    'ENABLE_ACCOUNT': 'added',
+    'DISABLE_ACCOUNT': 'removed',
+}
+
+# sqlite refuses queries with more than 999 parameters
+_QUERY_CHUNK = 500
+
 
-def dump_ldap(ldap_logging_path):
-    """ Perform a dump of an LDAP database according to the config file. """
+# entries changed this long before the last run are fetched again, in case
+# the clocks of the LDAP server and of this host differ
+CLOCK_SKEW = timedelta(minutes=5)
+# entries read from LDAP at once, below the size limit of the server
+PAGE_SIZE = 500
+# the attributes of the changed entries: the user ones and the operational
+# ones (createTimestamp, modifyTimestamp), like the full dump
+CHANGED_ATTRS = ['*', '+']
+
+
+def dump_ldap(ldap_logging_path, incremental=False):
+    """ Perform a dump of an LDAP database according to the config file.
+
+    With `incremental`, only the changes since the last run are applied to
+    the existing dump; the first run is always a full dump.
+    """
     naaya_ldap_cfg = os.path.join(ldap_logging_path, 'config.yaml')
     if not os.path.exists(naaya_ldap_cfg):
         log.info("%s does not exist", naaya_ldap_cfg)
+        return
+
+    db_path = os.path.join(ldap_logging_path, DUMP_FILENAME)
+    started = datetime.utcnow()
+
+    if incremental and last_run(db_path) is not None:
+        return update_dump(naaya_ldap_cfg, db_path, started)
+
+    result = main.dump_ldap(naaya_ldap_cfg)
+    if os.path.exists(db_path):
+        index_dump(db_path)
+        set_last_run(db_path, started)
     else:
-        return main.dump_ldap(naaya_ldap_cfg)
+        log.warning("%s does not exist, the dump was not indexed",
+                    db_path)
+    return result
+
+
+def dump_db_path():
+    """ Path of the sqlite database written by `dump_ldap` """
+    db_path = os.path.join(LDAP_DISK_STORAGE, DUMP_FILENAME)
+
+    if not os.path.exists(db_path):
+        from naaya.ldapdump.interfaces import IDumpReader
+        from zope.component import getUtility
+        db_path = getUtility(IDumpReader).db_path
+
+    return db_path
+
+
+def changelog_events(dn, changelog):
+    """ Yield (uid, role, action, date) for each role change recorded in the
+    JSON `changelog` of the user at `dn`
+
+    `action` is either 'added' or 'removed' and `date` is the CET date of
+    the change, in ISO format.
+    """
+    try:
+        entries = json.loads(changelog)
+    except (TypeError, ValueError):
+        log.warning("Invalid changelog for user %r", dn)
+        return
+
+    uid = dn.split(',')[0].split('=', 1)[1]
+
+    for entry in entries:
+        if not entry.get('timestamp'):
+            continue    # this is due to some API changes
+        data = entry.get('data') or {}
+
+        if entry.get('action') in ROLE_ACTIONS:
+            action = ROLE_ACTIONS[entry['action']]
+            roles = [data.get('role')]
+        elif entry.get('action') in ACCOUNT_ACTIONS:
+            action = ACCOUNT_ACTIONS[entry['action']]
+            roles = data.get('roles') or []
+        else:
+            continue
+
+        date = DateTime(entry['timestamp']).toZone("CET").asdatetime().date()
+
+        for role in roles:
+            if role:
+                yield uid, role, action, date.isoformat()
+
+
+def build_membership_events(db_path):
+    """ (Re)build the `membership_events` table from the changelogs in the
+    dump at `db_path` """
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT dn, value FROM ldapmapping "
+                            "WHERE attr = 'registeredAddress'").fetchall()
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS membership_events")
+            conn.execute("CREATE TABLE membership_events "
+                         "(uid TEXT, role TEXT, action TEXT, date TEXT)")
+            conn.executemany(
+                "INSERT INTO membership_events VALUES (?, ?, ?, ?)",
+                (event for dn, value in rows
+                 for event in changelog_events(dn, value)))
+            conn.execute("CREATE INDEX membership_events_role_date "
+                         "ON membership_events (role, date)")
+    finally:
+        conn.close()
+
+
+def _create_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS ldapmapping_dn_attr "
+                 "ON ldapmapping (dn, attr)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ldapmapping_attr "
+                 "ON ldapmapping (attr)")
+
+
+def _build_registration_stats(conn):
+    conn.execute("DROP TABLE IF EXISTS registration_stats")
+    conn.execute("CREATE TABLE registration_stats "
+                 "(year INTEGER, month INTEGER, status TEXT, users INTEGER)")
+    conn.execute(
+        "INSERT INTO registration_stats "
+        "SELECT CAST(substr(c.value, 1, 4) AS INTEGER), "
+        "CAST(substr(c.value, 5, 2) AS INTEGER), "
+        "CASE WHEN EXISTS (SELECT 1 FROM ldapmapping t WHERE t.dn = c.dn "
+        "AND t.attr = 'employeeType' AND t.value = 'disabled') "
+        "THEN 'disabled' ELSE 'enabled' END, COUNT(*) "
+        "FROM ldapmapping c WHERE c.attr = 'createTimestamp' "
+        "AND c.dn LIKE 'uid=%' GROUP BY 1, 2, 3")
+
+
+def index_dump(db_path):
+    """ Add the indexes used by the listings and the registration
+    statistics to the dump at `db_path` """
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            _create_indexes(conn)
+            _build_registration_stats(conn)
+    finally:
+        conn.close()
+    build_membership_events(db_path)
+
+
+def summarize_registrations(rows):
+    """ Sum up (year, month, status, number of users) `rows` as a dict with
+    `yearly` (year -> number), `monthly` ((year, month) -> number) and
+    `by_status` (year -> dict of status -> number) """
+    yearly, monthly = defaultdict(int), defaultdict(int)
+    by_status = defaultdict(lambda: {'enabled': 0, 'disabled': 0})
+
+    for year, month, status, users in rows:
+        yearly[year] += users
+        monthly[year, month] += users
+        by_status[year][status] += users
+
+    return {'yearly': dict(yearly), 'monthly': dict(monthly),
+            'by_status': dict(by_status)}
+
+
+def registration_stats(db_path=None):
+    """ The `summarize_registrations` of the users in the dump, or None when
+    the dump has no registration statistics """
+    conn = sqlite3.connect(db_path or dump_db_path())
+    try:
+        rows = conn.execute("SELECT year, month, status, users "
+                            "FROM registration_stats").fetchall()
+    except sqlite3.OperationalError:
+        log.warning("The LDAP dump has no registration statistics, "
+                    "run dump_ldap")
+        return None
+    finally:
+        conn.close()
+
+    if not rows:    # the dump has no createTimestamp values
+        return None
+
+    return summarize_registrations(rows)
+
+
+def org_member_emails(db_path=None):
+    """ Yield the email of each user of the dump that is a member of an
+    organisation (has an `o`), once, in dump order """
+    conn = sqlite3.connect(db_path or dump_db_path())
+    seen = set()
+    try:
+        rows = conn.execute(
+            "SELECT m.value FROM ldapmapping m WHERE m.attr = 'mail' "
+            "AND m.dn LIKE 'uid=%' AND EXISTS (SELECT 1 FROM ldapmapping o "
+            "WHERE o.dn = m.dn AND o.attr = 'o' AND o.value != '') "
+            "ORDER BY m.rowid")
+
+        for (email,) in rows:
+            if email and email not in seen:
+                seen.add(email)
+                yield email
+    finally:
+        conn.close()
+
+
+def last_run(db_path):
+    """ The UTC `datetime` the last successful dump to `db_path` started
+    at, or None """
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute("SELECT value FROM dump_state "
+                           "WHERE name = 'last_run'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+    return row and datetime.strptime(row[0], '%Y-%m-%dT%H:%M:%S')
+
+
+def _save_last_run(conn, started):
+    conn.execute("CREATE TABLE IF NOT EXISTS dump_state "
+                 "(name TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT OR REPLACE INTO dump_state VALUES ('last_run', ?)",
+                 (started.strftime('%Y-%m-%dT%H:%M:%S'),))
+
+
+def set_last_run(db_path, started):
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            _save_last_run(conn, started)
+    finally:
+        conn.close()
+
+
+def _ldap_connection(config):
+    """ A connection bound as configured in the `ldap` section of
+    config.yaml """
+    scheme = 'ldaps' if int(config.get('port', 389)) == 636 else 'ldap'
+    conn = ldap.initialize('%s://%s:%s' % (scheme, config['host'],
+                                           config.get('port', 389)))
+    conn.protocol_version = ldap.VERSION3
+    conn.simple_bind_s(config.get('dn', ''), config.get('password', ''))
+
+    return conn
+
+
+def _paged_search(conn, root_dn, filterstr, attrlist=None):
+    """ Yield the (dn, attrs) of a subtree search, asked from the server
+    `PAGE_SIZE` entries at a time """
+    control = SimplePagedResultsControl(True, size=PAGE_SIZE, cookie='')
+
+    while True:
+        msgid = conn.search_ext(root_dn, ldap.SCOPE_SUBTREE, filterstr,
+                                attrlist=attrlist, serverctrls=[control])
+        _, results, _, controls = conn.result3(msgid)
+
+        for result in results:
+            yield result
+        cookies = [ctrl.cookie for ctrl in controls if ctrl.controlType ==
+                   SimplePagedResultsControl.controlType]
+
+        if not (cookies and cookies[0]):
+            return
+        control.cookie = cookies[0]
+
+
+def _text_values(attrs, encoding):
+    """ The (attr, value) of the text values in `attrs`; the binary ones,
+    e.g. photos, aren't kept in the dump """
+    for name, values in attrs.iteritems():
+        for value in values:
+            try:
+                yield name, value.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+
+
+def fetch_changes(conn, root_dns, since, encoding='utf-8'):
+    """ Search the `root_dns` subtrees for the entries modified after
+    `since` (a UTC `datetime`)
+
+    Returns a tuple of (dict of dn -> list of (attr, value) for the
+    modified entries, set of the DNs of all entries).
+    """
+    changed, dns = {}, set()
+    timestamp = since.strftime('%Y%m%d%H%M%SZ')
+
+    for root_dn in root_dns:
+        for dn, attrs in _paged_search(conn, root_dn,
+                                       '(modifyTimestamp>=%s)' % timestamp,
+                                       attrlist=CHANGED_ATTRS):
+            changed[dn.decode(encoding)] = list(_text_values(attrs,
+                                                             encoding))
+
+        # no attributes, only the DNs, to find out the deleted entries
+        for dn, attrs in _paged_search(conn, root_dn, '(objectClass=*)',
+                                       attrlist=['1.1']):
+            dns.add(dn.decode(encoding))
+
+    return changed, dns
+
+
+def apply_changes(db_path, changed, dns, started):
+    """ Replace the `changed` entries (see `fetch_changes`) in the dump at
+    `db_path` and remove the entries not in `dns`, together with their
+    membership events, in a single transaction """
+    conn = sqlite3.connect(db_path)
+    try:
+        dumped = set(dn for (dn,) in
+                     conn.execute("SELECT DISTINCT dn FROM ldapmapping"))
+        removed = (dumped - dns) | (dumped & set(changed))
+        has_events = conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'membership_events'").fetchone()[0]
+
+        with conn:
+            removed = list(removed)
+            for start in range(0, len(removed), _QUERY_CHUNK):
+                chunk = removed[start:start + _QUERY_CHUNK]
+                placeholders = ', '.join('?' * len(chunk))
+                conn.execute("DELETE FROM ldapmapping WHERE dn IN (%s)" %
+                             placeholders, chunk)
+                uids = [dn.split(',')[0].split('=', 1)[1] for dn in chunk
+                        if dn.startswith('uid=')]
+                if has_events and uids:
+                    conn.execute(
+                        "DELETE FROM membership_events WHERE uid IN (%s)" %
+                        ', '.join('?' * len(uids)), uids)
+            conn.executemany(
+                "INSERT INTO ldapmapping (dn, attr, value) "
+                "VALUES (?, ?, ?)",
+                ((dn, name, value) for dn, attrs in changed.iteritems()
+                 for name, value in attrs))
+            if has_events:
+                conn.executemany(
+                    "INSERT INTO membership_events VALUES (?, ?, ?, ?)",
+                    (event for dn, attrs in changed.iteritems()
+                     for name, value in attrs if name == 'registeredAddress'
+                     for event in changelog_events(dn, value)))
+            _create_indexes(conn)
+            _build_registration_stats(conn)
+            _save_last_run(conn, started)
+    finally:
+        conn.close()
+
+    if not has_events:
+        build_membership_events(db_path)
+
+    log.info("Updated %d and removed %d entries of %s", len(changed),
+             len(dumped - dns), db_path)
+
+
+def update_dump(config_path, db_path, started):
+    """ Apply the LDAP changes since the last run to the dump at `db_path`
+    """
+    with open(config_path) as config_file:
+        config = yaml.safe_load(config_file)['ldap']
+    conn = _ldap_connection(config)
+    try:
+        changed, dns = fetch_changes(conn, config.get('root_DNs', []),
+                                     last_run(db_path) - CLOCK_SKEW,
+                                     config.get('encoding', 'utf-8'))
+    finally:
+        conn.unbind_s()
+    apply_changes(db_path, changed, dns, started)
+
+
+# the columns of `users_page`, with the attribute each one is read from
+USER_COLUMNS = OrderedDict([
+    ('id', 'uid'),
+    ('full_name', 'cn'),
+    ('email', 'mail'),
+    ('organisation', 'o'),
+    ('status', 'employeeType'),
+])
+
+
+def _like(term):
+    return '%%%s%%' % re.sub(r'([\\%_])', r'\\\1', term)
+
+
+def users_page(search='', sort='full_name', sort_desc=False, start=0,
+               length=10, search_columns=('id', 'full_name', 'email'),
+               name='', lookup=(), members=None, missing=True,
+               disabled=None, db_path=None):
+    """ Return a page of the users in the dump, sorted by one of the
+    `USER_COLUMNS`, as a tuple of (users, total count, filtered count)
+
+    The users are filtered by a `search` term in `search_columns`, by a
+    `name` in any of the `lookup` attributes and, if `disabled` is True or
+    False, by their status. `members`, a dict of user id -> dn, limits
+    the page to these users; the ones missing from the dump are listed
+    with only an id, unless `missing` is False.
+    """
+    conn = sqlite3.connect(db_path or dump_db_path())
+    conn.row_factory = sqlite3.Row
+    try:
+        if members is None:
+            listed = ("SELECT dn, value AS uid FROM ldapmapping "
+                      "WHERE attr = 'uid'")
+        else:
+            conn.execute("CREATE TEMP TABLE members (dn TEXT, uid TEXT)")
+            conn.executemany("INSERT INTO members VALUES (?, ?)",
+                             [(dn, uid) for uid, dn in members.iteritems()])
+            listed = "SELECT dn, uid FROM members m"
+
+            if not missing:
+                listed += (" WHERE EXISTS (SELECT 1 FROM ldapmapping "
+                           "WHERE dn = m.dn)")
+        users = ("SELECT l.dn AS dn, l.uid AS id, %s FROM (%s) l" % (
+            ', '.join("(SELECT value FROM ldapmapping WHERE dn = l.dn AND "
+                      "attr = '%s' LIMIT 1) AS %s" % (attr, column)
+                      for column, attr in USER_COLUMNS.iteritems()
+                      if column != 'id'), listed))
+        where, args = [], []
+
+        columns = [column for column in search_columns
+                   if column in USER_COLUMNS]
+
+        if search and columns:
+            where.append('(%s)' % ' OR '.join(
+                "%s LIKE ? ESCAPE '\\'" % column for column in columns))
+            args += [_like(search)] * len(columns)
+
+        if name and lookup:
+            where.append(
+                "EXISTS (SELECT 1 FROM ldapmapping WHERE dn = u.dn AND "
+                "attr IN (%s) AND value LIKE ? ESCAPE '\\')" %
+                ', '.join('?' * len(lookup)))
+            args += list(lookup) + [_like(name)]
+
+        if disabled is not None:
+            where.append("status = 'disabled'" if disabled else
+                         "(status IS NULL OR status != 'disabled')")
+        where = ('WHERE ' + ' AND '.join(where)) if where else ''
+
+        if sort not in USER_COLUMNS:
+            sort = 'full_name'
+        total = conn.execute("SELECT COUNT(*) FROM (%s)" %
+                             listed).fetchone()[0]
+        filtered = conn.execute("SELECT COUNT(*) FROM (%s) u %s" %
+                                (users, where), args).fetchone()[0]
+        rows = conn.execute(
+            "SELECT * FROM (%s) u %s ORDER BY %s COLLATE NOCASE %s, id "
+            "LIMIT ? OFFSET ?" % (users, where, sort,
+                                  'DESC' if sort_desc else 'ASC'),
+            args + [length, start]).fetchall()
+    finally:
+        conn.close()
+    result = []
+
+    for row in rows:
+        row = dict(row)
+        del row['dn']
+        result.append(row)
+
+    return result, total, filtered
+
+
+def former_role_members(role_ids, date, db_path=None):
+    """ Return a dict of uid -> set of roles, for the users that had any of
+    `role_ids` on `date` (a `datetime.date`) and no longer have it
+
+    Returns None if the dump has no membership events.
+    """
+    conn = sqlite3.connect(db_path or dump_db_path())
+    role_ids = list(role_ids)
+    result = {}
+    try:
+        for start in range(0, len(role_ids), _QUERY_CHUNK):
+            chunk = role_ids[start:start + _QUERY_CHUNK]
+            query = ("SELECT uid, role FROM membership_events "
+                     "WHERE role IN (%s) AND date > ? "
+                     "GROUP BY uid, role HAVING "
+                     "SUM(CASE action WHEN 'removed' THEN 1 ELSE -1 END) > 0"
+                     % ', '.join('?' * len(chunk)))
+            for uid, role in conn.execute(query, chunk + [date.isoformat()]):
+                result.setdefault(uid, set()).add(role)
+    except sqlite3.OperationalError:
+        log.warning("The LDAP dump has no membership events, run dump_ldap")
+        return None
+    finally:
+        conn.close()
+
+    return result
+
+
+def former_role_members_from_dump(dump, role_ids, date):
+    """ Same as `former_role_members`, computed from the changelogs of all
+    (dn, attrs) users in `dump` """
+    role_ids = set(role_ids)
+    date = date.isoformat()
+    balance = defaultdict(int)
+
+    for dn, attrs in dump:
+        if not attrs.get('registeredAddress'):
+            continue
+
+        for uid, role, action, event_date in changelog_events(
+                dn, attrs['registeredAddress']):
+            if role in role_ids and event_date > date:
+                balance[uid, role] += 1 if action == 'removed' else -1
+
+    result = {}
+
+    for (uid, role), count in balance.iteritems():
+        if count > 0:
+            result.setdefault(uid, set()).add(role)
+
+    return result
+
+
+# a user of the dump, as kept in memory by `DumpCache`
+DumpUser = namedtuple('DumpUser', ['dn', 'uid', 'cn', 'ascii_cn', 'mail',
+                                   'status', 'pending_disable'])
+
+# the dump attribute of each `DumpUser` field
+DUMP_USER_ATTRS = OrderedDict([
+    ('uid', 'uid'),
+    ('cn', 'cn'),
+    ('mail', 'mail'),
+    ('status', 'employeeType'),
+    ('pending_disable', 'employeeNumber'),
+])
+
+
+def load_users(db_path):
+    """ Read the users (the `uid=` entries) of the dump at `db_path` as a
+    tuple of `DumpUser`, in dump order """
+    fields = dict((attr, name) for name, attr in DUMP_USER_ATTRS.items())
+    users = OrderedDict()
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT dn, attr, value FROM ldapmapping WHERE attr IN (%s) "
+            "ORDER BY rowid" % ', '.join('?' * len(fields)), list(fields))
+
+        for dn, attr, value in rows:
+            if not dn.startswith('uid='):
+                continue
+            # keep the first value of multi-valued attributes
+            users.setdefault(dn, {}).setdefault(fields[attr], value)
+    finally:
+        conn.close()
+
+    result = []
+
+    for dn, attrs in users.iteritems():
+        cn = attrs.get('cn') or u''
+        result.append(DumpUser(
+            dn=dn,
+            uid=attrs.get('uid') or dn.split(',')[0].split('=', 1)[1],
+            cn=cn,
+            ascii_cn=unidecode(cn),
+            mail=attrs.get('mail'),
+            status=attrs.get('status') or 'enabled',
+            pending_disable=attrs.get('pending_disable')))
+
+    return tuple(result)
+
+
+class DumpCache(object):
+    """ The users of the LDAP dump, kept in memory for the whole process
+
+    The users are read again when the size or modification time of the
+    dump file changes. Once loaded, the reload happens on a background
+    thread and the previous users are returned until it is done; until
+    then, one request reads them while the others wait.
+    """
+
+    def __init__(self, loader=load_users):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+        self._key = None
+        self._users = None
+        self._reloading = None
+
+    def _file_key(self, db_path):
+        stat = os.stat(db_path)
+
+        return (db_path, stat.st_mtime, stat.st_size)
+
+    def users(self, db_path=None):
+        """ The `DumpUser` tuples of the dump at `db_path` """
+        db_path = db_path or dump_db_path()
+        key = self._file_key(db_path)
+
+        with self._lock:
+            if self._key == key:
+                return self._users
+
+            if self._users is not None and self._key[0] == db_path:
+                if self._reloading != key:
+                    self._reloading = key
+                    thread = threading.Thread(target=self._reload,
+                                              args=(key,))
+                    thread.daemon = True
+                    thread.start()
+
+                return self._users
+
+        with self._loading:
+            with self._lock:
+                if self._key == key:
+                    return self._users
+            users = self._loader(db_path)
+            self._store(key, users)
+
+        return users
+
+    def _store(self, key, users):
+        with self._lock:
+            self._key, self._users = key, users
+
+            if self._reloading == key:
+                self._reloading = None
+
+    def _reload(self, key):
+        try:
+            users = self._loader(key[0])
+        except Exception:
+            log.exception("Could not reload the users of %s", key[0])
+
+            with self._lock:
+                self._reloading = None
+        else:
+            self._store(key, users)
+
+    def clear(self):
+        with self._lock:
+            self._key = self._users = self._reloading = None
+
+
+users_cache = DumpCache()
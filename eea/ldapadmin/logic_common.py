@@ -1,6 +1,100 @@
+import ldap
+from ldap.filter import escape_filter_chars
+
+# how many users are looked up with a single LDAP search in `users_info`
+USERS_INFO_CHUNK = 100
+
+USER_ATTRS = ['*', 'uid', 'createTimestamp', 'modifyTimestamp']
+
+
 def _get_user_id(request):
     return request.AUTHENTICATED_USER.getId()
 
 
 def _is_authenticated(request):
     return ('Authenticated' in request.AUTHENTICATED_USER.getRoles())
+
+
+def users_info(agent, user_ids, chunk_size=USERS_INFO_CHUNK):
+    """ Return a dict of user id -> `agent.user_info(user_id)` for all of
+    `user_ids`, making a single LDAP search for each `chunk_size` users.
+
+    Users that do not exist are left out of the result, it's up to the
+    caller to show them as deleted.
+    """
+    user_ids = list(user_ids)
+    unique_ids = sorted(set(uid.lower() for uid in user_ids))
+    found = {}
+
+    for start in range(0, len(unique_ids), chunk_size):
+        chunk = unique_ids[start:start + chunk_size]
+        uid_filters = ''.join(
+            '(uid=%s)' % escape_filter_chars(
+                uid.encode(agent._encoding) if isinstance(uid, unicode)
+                else uid)
+            for uid in chunk)
+        result = agent.conn.search_s(
+            agent._user_dn_suffix, ldap.SCOPE_ONELEVEL,
+            filterstr='(&(objectClass=organizationalPerson)(|%s))' %
+            uid_filters,
+            attrlist=USER_ATTRS)
+
+        for dn, attrs in result:
+            found[agent._user_id(dn).lower()] = agent._unpack_user_info(dn,
+                                                                        attrs)
+
+    return dict((uid, found[uid.lower()]) for uid in user_ids
+                if uid.lower() in found)
+
+
+def orgs_with_members(agent):
+    """ Return a dict of org id -> (`agent.org_info(org_id)`, ids of the
+    members) for all the organisations, from a single LDAP search """
+    result = agent.conn.search_s(
+        agent._org_dn_suffix, ldap.SCOPE_ONELEVEL,
+        filterstr='(objectClass=organizationGroup)', attrlist=['*'])
+    orgs = {}
+
+    for dn, attrs in result:
+        members = [agent._user_id(member_dn)
+                   for member_dn in attrs.get('uniqueMember', [])
+                   if member_dn]
+        orgs[agent._org_id(dn)] = (agent._unpack_org_info(dn, attrs),
+                                   members)
+
+    return orgs
+
+
+def orgs_of_users(agent, user_ids, chunk_size=USERS_INFO_CHUNK):
+    """ Return a dict of user id -> ids of the organisations the user is
+    member of, for all of `user_ids`, making a single LDAP search for each
+    `chunk_size` users. Users without organisations are left out. """
+    wanted = {}
+
+    for user_id in set(user_ids):
+        dn = agent._user_dn(user_id)
+        dn = dn.encode(agent._encoding) if isinstance(dn, unicode) else dn
+        wanted[dn.lower()] = user_id
+    user_dns = sorted(wanted)
+    user_orgs = {}
+
+    for start in range(0, len(user_dns), chunk_size):
+        chunk = set(user_dns[start:start + chunk_size])
+        member_filters = ''.join(
+            '(uniqueMember=%s)' % escape_filter_chars(dn)
+            for dn in sorted(chunk))
+        result = agent.conn.search_s(
+            agent._org_dn_suffix, ldap.SCOPE_ONELEVEL,
+            filterstr='(&(objectClass=organizationGroup)(|%s))' %
+            member_filters,
+            attrlist=['uniqueMember'])
+
+        for dn, attrs in sorted(result):
+            org_id = agent._org_id(dn)
+
+            for member_dn in attrs.get('uniqueMember', []):
+                if member_dn.lower() in chunk:
+                    user_orgs.setdefault(wanted[member_dn.lower()],
+                                         []).append(org_id)
+
+    return user_orgs
@@ -0,0 +1,65 @@
+""" Sending the notification emails
+
+`send_email` hands the message to the site's delivery: the MailHost in
+Plone, the `naaya-mail-delivery` utility otherwise. Both are zope.sendmail
+deliveries, so the message is only sent if the current transaction
+commits. With a queued delivery (the MailHost's `smtp_queue`, or a
+`mail:queuedDelivery`) the message is written to a maildir instead and
+zope.sendmail's queue processor sends it in the background, keeping the
+failed ones for a later try; the request doesn't wait for the SMTP
+server.
+
+`MaildirOutbox` is the same queue for the scripts that run without Zope.
+"""
+from zope.component import getUtility
+from zope.sendmail.delivery import QueuedMailDelivery
+from zope.sendmail.interfaces import IMailDelivery
+from zope.sendmail.mailer import SMTPMailer
+from zope.sendmail.queue import QueueProcessorThread
+
+OUTBOX_DIRNAME = 'mail_outbox'
+
+
+def send_email(addr_from, addrs_to, message):
+    """ Send `message` (an `email.Message`) when the current transaction
+    commits """
+    if isinstance(addrs_to, basestring):
+        addrs_to = [addrs_to]
+    try:
+        from plone import api
+    except ImportError:
+        mailer = getUtility(IMailDelivery, name="naaya-mail-delivery")
+        try:
+            mailer.send(addr_from, addrs_to, message.as_string())
+        except AssertionError:
+            mailer.send(addr_from, addrs_to, message)
+    else:
+        api.portal.send_email(recipient=addrs_to, sender=addr_from,
+                              subject=message.get('subject'), body=message)
+
+
+class MaildirOutbox(object):
+    """ A zope.sendmail queue in the `path` maildir, sent with the `smtp`
+    settings of config.yaml (`host`, `port` and optional `username`,
+    `password`, `force_tls`) """
+
+    def __init__(self, path, smtp):
+        self.delivery = QueuedMailDelivery(path)
+        self.processor = QueueProcessorThread()
+        self.processor.setQueuePath(path)
+        self.processor.setMailer(SMTPMailer(
+            hostname=smtp.get('host', 'localhost'),
+            port=int(smtp.get('port', 25)),
+            username=smtp.get('username'),
+            password=smtp.get('password'),
+            force_tls=bool(smtp.get('force_tls'))))
+
+    def put(self, addr_from, addrs_to, message):
+        """ Queue `message` (a string) when the current transaction commits
+        """
+        self.delivery.send(addr_from, addrs_to, message)
+
+    def flush(self):
+        """ Send the queued messages; the ones that fail stay in the queue
+        for the next run """
+        self.processor.run(forever=False)
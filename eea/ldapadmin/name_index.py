@@ -0,0 +1,128 @@
+""" Blocking index for finding the users with names similar to a given one
+
+A name can only reach the Jaro-Winkler similarity threshold with the names
+it has enough characters in common with. Those are looked up with prefix
+filtering on the characters of the names and only they are scored, so the
+results are the same as scoring every name.
+"""
+import math
+from collections import defaultdict
+
+import jellyfish
+
+
+def _tokens(name):
+    """ The characters of `name`, lowercase, with the repeated ones
+    numbered; two names have as many tokens in common as characters """
+    seen = defaultdict(int)
+    tokens = []
+
+    for char in name.lower():
+        seen[char] += 1
+        tokens.append((char, seen[char]))
+
+    return tokens
+
+
+def overlap_ratio(threshold):
+    """ The least m/len1 + m/len2 two names need for their Jaro-Winkler
+    similarity to reach `threshold`, `m` being their characters in common
+
+    The Winkler bonus is at most 0.4 * (1 - jaro), so jaro must be at least
+    (threshold - 0.4) / 0.6. Jaro is at most (m/len1 + m/len2 + 1) / 3, as
+    the matching characters can't be more than the ones in common.
+    """
+    return 3 * (threshold - 0.4) / 0.6 - 1
+
+
+class NameIndex(object):
+    """ Index of `records`, (dn, name) pairs, for finding those with a
+    name similar to another, above `threshold` """
+
+    def __init__(self, records, threshold):
+        self.records = records
+        self.threshold = threshold
+        self.ratio = overlap_ratio(threshold)
+        self.frequency = defaultdict(int)
+        self.token_ids = {}
+        token_lists = [_tokens(name) for dn, name in records]
+
+        for tokens in token_lists:
+            for token in tokens:
+                self.frequency[token] += 1
+                self.token_ids.setdefault(token, len(self.token_ids))
+
+        self.tokens = [frozenset(self.token_ids[token] for token in tokens)
+                       for tokens in token_lists]
+        self.postings = defaultdict(list)
+        self.unpruned = []
+
+        for position, tokens in enumerate(token_lists):
+            prefix = self._prefix(tokens)
+
+            if prefix is None:
+                self.unpruned.append(position)
+            else:
+                for token in prefix:
+                    self.postings[token].append(position)
+
+    def _min_overlap(self, length):
+        """ The fewest characters a name of `length` must have in common
+        with any name similar to it """
+        if self.ratio <= 1:
+            return 0
+
+        return int(math.ceil((self.ratio - 1) * length - 1e-9))
+
+    def _prefix(self, tokens):
+        """ The rarest tokens, at least one of which is in every similar
+        name; None when the name can't be pruned """
+        overlap = self._min_overlap(len(tokens))
+
+        if overlap <= 0:
+            return None
+        tokens = sorted(
+            tokens, key=lambda token: (self.frequency.get(token, 0), token))
+
+        return tokens[:len(tokens) - overlap + 1]
+
+    def candidates(self, name):
+        """ Positions of the records that may be similar to `name` """
+        tokens = _tokens(name)
+        prefix = self._prefix(tokens)
+
+        if prefix is None:
+            return range(len(self.records))
+        positions = set(self.unpruned)
+
+        for token in prefix:
+            positions.update(self.postings.get(token, ()))
+
+        token_ids = frozenset(self.token_ids[token] for token in tokens
+                              if token in self.token_ids)
+        length = len(tokens)
+        result = []
+
+        for position in sorted(positions):
+            other_length = len(self.records[position][1])
+
+            if not other_length:
+                continue
+            common = float(len(token_ids & self.tokens[position]))
+
+            if common / length + common / other_length >= self.ratio - 1e-9:
+                result.append(position)
+
+        return result
+
+    def similar(self, name):
+        """ The DNs of the records similar to `name`, in dump order """
+        dns = []
+
+        for position in self.candidates(name):
+            dn, other_name = self.records[position]
+
+            if jellyfish.jaro_winkler(name, other_name) >= self.threshold:
+                dns.append(dn)
+
+        return dns
@@ -1,3 +1,4 @@
+import itertools
 import json
 import logging
 import operator
@@ -11,6 +12,8 @@ import deform
 import ldap
 import ldap_config
 import roles_leaders
+import user_roles
+from org_catalogue import catalogue
 from AccessControl import ClassSecurityInfo
 from AccessControl.Permissions import view, view_management_screens
 from AccessControl.unauthorized import Unauthorized
@@ -26,7 +29,8 @@ from eea.ldapadmin.users_admin import (_is_authenticated, _send_email,
                                        get_duplicates_by_name,
                                        user_info_add_schema)
 from eea.usersdb.db_agent import EmailAlreadyExists, NameAlreadyExists
-from logic_common import _get_user_id
+from ldap.filter import escape_filter_chars
+from logic_common import _get_user_id, orgs_of_users, users_info
 from OFS.PropertyManager import PropertyManager
 from OFS.SimpleItem import SimpleItem
 from persistent.mapping import PersistentMapping
@@ -43,6 +47,9 @@ log = logging.getLogger('nfp_nrc')
 
 eionet_access_nfp_nrc = 'Eionet access NFP admin for NRC'
 
+# roles whose members are looked up together in `roles_with_members`
+COUNTRY_ROLES_CHUNK = 10
+
 manage_add_nfp_nrc_html = PageTemplateFile('zpt/nfp_nrc/manage_add.zpt',
                                            globals())
 manage_add_nfp_nrc_html.ldap_config_edit_macro = ldap_config.edit_macro
@@ -244,8 +251,9 @@ def get_top_role_dns(agent, dn_branch):
     ])
 
 
-def get_members(agent, country_code, dn_branch):
-    """ Get the nrc members assigned to this country code
+def get_members(agent, country_code, dn_branch, orgs):
+    """ Get the nrc members assigned to this country code; `orgs` is a dict
+    of org id -> info of all the organisations
     """
 
     out = []
@@ -277,21 +285,110 @@ def get_members(agent, country_code, dn_branch):
                 continue
             else:
                 members = agent.members_in_role(role_id)
-                users = [agent.user_info(user_id) for user_id in
-                         members['users']]
-
-                for user in users:
-                    user['ldap_org'] = get_national_org(agent,
-                                                        user['id'],
-                                                        role_id)
-                orgs = [agent.org_info(org_id) for org_id in members['orgs']]
+                found = users_info(agent, members['users'])
+                users = [found[user_id] for user_id in members['users']
+                         if user_id in found]
+                org_members = [dict(orgs[org_id], id=org_id)
+                               for org_id in members['orgs'] if org_id in orgs]
                 leaders, alternates = agent.role_leaders(role_id)
-                role.set_members_info(users, orgs, leaders, alternates)
+                role.set_members_info(users, org_members, leaders,
+                                      alternates)
                 out.append(role)
 
+    by_user = national_orgs(
+        agent, set(user['id'] for role in out for user in role.users), orgs)
+
+    for role in out:
+        for user in role.users:
+            user['ldap_org'] = national_org(by_user, user['id'], role.role_id)
+
     return sorted(out, key=operator.attrgetter('role_id'))
 
 
+def _role_members(agent, attrs):
+    """ The user ids and org ids in the `uniqueMember` of a role """
+    users, orgs = [], []
+
+    for member_dn in attrs.get('uniqueMember', []):
+        if member_dn.endswith(agent._user_dn_suffix):
+            users.append(agent._user_id(member_dn))
+        elif member_dn.endswith(agent._org_dn_suffix):
+            orgs.append(agent._org_id(member_dn))
+
+    return users, orgs
+
+
+def country_roles(agent, country_code, dn_branch='eionet-nrc'):
+    """ The roles of `country_code` under `dn_branch`, sorted by id, as
+    (SimplifiedRoleDict, LDAP attributes), from a single LDAP search that
+    also reads their members and leaders """
+    result = agent.conn.search_s(
+        agent._role_dn(dn_branch), ldap.SCOPE_SUBTREE,
+        filterstr="(&(objectClass=groupOfUniqueNames)(cn=%s-*-%s))"
+        % (dn_branch, escape_filter_chars(country_code)),
+        attrlist=['description', 'uniqueMember', 'leaderMember',
+                  'alternateLeader'])
+    roles = []
+
+    for role_dn, attrs in result:
+        role_id = agent._role_id(role_dn)
+
+        try:
+            description = attrs.get('description', ('',))[0]
+            role = SimplifiedRoleDict(role_id, description)
+        except ValueError:
+            continue
+        roles.append((role, attrs))
+
+    return sorted(roles, key=lambda item: item[0]['role_id'])
+
+
+def roles_with_members(agent, roles, orgs):
+    """ Yield the `roles` of `country_roles` with their members info, json
+    ready. The users and their national organisations are looked up for
+    `COUNTRY_ROLES_CHUNK` roles at a time, the organisations are taken from
+    `orgs` (org id -> info). """
+    for start in range(0, len(roles), COUNTRY_ROLES_CHUNK):
+        chunk = [(role, attrs, _role_members(agent, attrs))
+                 for role, attrs in roles[start:start + COUNTRY_ROLES_CHUNK]]
+        chunk_users = set(itertools.chain.from_iterable(
+            user_ids for role, attrs, (user_ids, org_ids) in chunk))
+        found = users_info(agent, chunk_users)
+        by_user = national_orgs(agent, chunk_users, orgs)
+
+        for role, attrs, (user_ids, org_ids) in chunk:
+            users = []
+
+            for user_id in user_ids:
+                if user_id not in found:
+                    continue
+                user = dict(found[user_id])
+                user['ldap_org'] = national_org(by_user, user_id,
+                                                role['role_id'])
+                user.pop('createTimestamp', None)
+                user.pop('modifyTimestamp', None)
+                users.append(user)
+            role.set_members_info(
+                users, [dict(orgs[org_id], id=org_id)
+                        for org_id in org_ids if org_id in orgs],
+                [agent._user_id(dn) for dn in attrs.get('leaderMember', [])],
+                [agent._user_id(dn)
+                 for dn in attrs.get('alternateLeader', [])])
+            role['naming'] = roles_leaders.naming(role['role_id'])
+
+            yield role
+
+
+def _role_country(role_id):
+    """ The country code of the organisations national for `role_id` """
+    country_code = role_id.split('-')[-1]
+
+    if country_code == "eea":
+        country_code = 'eu'
+
+    return country_code
+
+
 def get_national_org(agent, user_id, role_id):
     """ Get the "canonical" national organisation for the given user_id
 
@@ -300,10 +397,7 @@ def get_national_org(agent, user_id, role_id):
     """
     # test if the user is member of a national organisation
     # for that role
-    country_code = role_id.split('-')[-1]
-
-    if country_code == "eea":
-        country_code = 'eu'
+    country_code = _role_country(role_id)
     user_orgs = agent._search_user_in_orgs(user_id)
 
     for org_id in user_orgs:
@@ -314,14 +408,38 @@ def get_national_org(agent, user_id, role_id):
             return org_info
 
 
+def national_orgs(agent, user_ids, orgs):
+    """ A dict of user id -> {country code: org info} with the first
+    organisation of each country the users are members of, for
+    `national_org`. The memberships of all `user_ids` are read in bulk,
+    the organisations are taken from `orgs` (org id -> info). """
+    by_user = {}
+
+    for user_id, org_ids in orgs_of_users(agent, user_ids).iteritems():
+        by_country = by_user[user_id] = {}
+
+        for org_id in org_ids:
+            info = orgs.get(org_id)
+
+            if info is not None:
+                by_country.setdefault(info['country'],
+                                      dict(info, id=org_id))
+
+    return by_user
+
+
+def national_org(by_user, user_id, role_id):
+    """ `get_national_org`, looked up in the result of `national_orgs` """
+    return by_user.get(user_id, {}).get(_role_country(role_id))
+
+
 def role_members(agent, role_id):
     """ Return the member and organisations for the given role
     """
     members = agent.members_in_role(role_id)
 
     return {
-        'users': dict((user_id, agent.user_info(user_id))
-                      for user_id in members['users']),
+        'users': users_info(agent, members['users']),
         'orgs': dict((org_id, agent.org_info(org_id))
                      for org_id in members['orgs']),
     }
@@ -366,18 +484,13 @@ class NfpNrc(SimpleItem, PropertyManager):
     def _allowed(self, agent, request, country_code):
         """
         Tests if logged in user is allowed to manage NRC members for
-        `country` (whether he is an NFP member for country)
+        `country` (whether he is an NFP member for country). The roles of
+        the user in the directory of this tool are kept by `user_roles` for
+        a short while, so moving around the pages of the country doesn't
+        search LDAP each time.
 
         """
-        uid = _get_user_id(request)
-        filterstr = ("(&(objectClass=groupOfUniqueNames)(uniqueMember=%s))" %
-                     agent._user_dn(uid))
-        nfp_roles = agent.filter_roles("eionet-nfp-*-%s" % country_code,
-                                       prefix_dn="cn=eionet-nfp,cn=eionet",
-                                       filterstr=filterstr,
-                                       attrlist=("description",))
-
-        if not (bool(nfp_roles) or self.checkPermissionZopeManager()):
+        if not self._may_manage(request, country_code):
             msg = u"You are not allowed to manage NRC members for %s" \
                 % code_to_name(country_code)
             IStatusMessage(request).add(msg, type='error')
@@ -387,6 +500,16 @@ class NfpNrc(SimpleItem, PropertyManager):
         else:
             return True
 
+    security.declarePrivate('_may_manage')
+
+    def _may_manage(self, request, country_code):
+        """ Whether the logged in user is a manager or an NFP member for
+        `country_code`; `_allowed` without the redirect """
+        uid = _get_user_id(request)
+
+        return (self.checkPermissionZopeManager() or
+                user_roles.is_nfp(self, uid, country_code))
+
     security.declareProtected(view_management_screens, 'get_config')
 
     def get_config(self):
@@ -400,8 +523,13 @@ class NfpNrc(SimpleItem, PropertyManager):
         REQUEST.RESPONSE.redirect(self.absolute_url() + '/manage_edit')
 
     def _get_ldap_agent(self, bind=True, secondary=False):
-        agent = ldap_config.ldap_agent_with_config(self._config, bind,
-                                                   secondary=secondary)
+        return ldap_config.request_agent(self, self._new_ldap_agent, bind,
+                                         secondary)
+
+    def _new_ldap_agent(self, bind=True, secondary=False):
+        agent = ldap_config.ldap_agent_with_config(
+            self._config, bind, secondary=secondary,
+            request=getattr(self, 'REQUEST', None))
         try:
             agent._author = logged_in_user(self.REQUEST)
         except AttributeError:
@@ -423,57 +551,30 @@ class NfpNrc(SimpleItem, PropertyManager):
 
         return self._render_template('zpt/nfp_nrc/index.zpt', **options)
 
-    def get_top_role_members(self, role_dn, country_code):
-        """ """
-        agent = self._get_ldap_agent()
-        has_problematic_users = False
-        top_role_id = agent._role_id(role_dn)
-        filter_country = "%s-*-%s" % (top_role_id, country_code)
-        roles = []
+    security.declareProtected(eionet_access_nfp_nrc, 'get_nrc_roles')
 
-        for (role_dn, attr) in agent.conn.search_s(
-                role_dn,
-                ldap.SCOPE_SUBTREE,
-                filterstr="(&(objectClass=groupOfUniqueNames)(cn=%s))"
-                % filter_country, attrlist=['description']):
+    def get_nrc_roles(self, REQUEST):
+        """ The NRC roles of a country with their members, streamed as
+        newline delimited JSON: a line with the number of roles, then one
+        line for each role """
+        country_code = REQUEST.form.get("nfp")
+        RESPONSE = REQUEST.RESPONSE
 
-            role_id = agent._role_id(role_dn)
+        if not self._may_manage(REQUEST, country_code):
+            # requested by the page script, a redirect is of no use there
+            RESPONSE.setStatus(403)
 
-            try:
-                description = attr.get('description', ('',))[0]
-                role = SimplifiedRoleDict(role_id, description)
-            except ValueError:
-                continue
-            else:
-                members = agent.members_in_role(role_id)
-                users = [agent.user_info(user_id) for user_id in
-                         members['users']]
-
-                for user in users:
-                    user['ldap_org'] = get_national_org(agent,
-                                                        user['id'],
-                                                        role_id)
-
-                    if not user['ldap_org']:
-                        has_problematic_users = True
-                    del(user['createTimestamp'])
-                    del(user['modifyTimestamp'])
-                orgs = [agent.org_info(org_id) for org_id in members['orgs']]
-                leaders, alternates = agent.role_leaders(role_id)
-                role.set_members_info(users, orgs, leaders, alternates)
+            return ''
+        agent = self._get_ldap_agent()
+        roles = country_roles(agent, country_code)
+        RESPONSE.setHeader('Content-Type', 'application/x-ndjson')
+        RESPONSE.write(json.dumps({'count': len(roles)}) + '\n')
 
-                roles.append(role)
+        for role in roles_with_members(agent, roles,
+                                       catalogue.all_organisations(self)):
+            RESPONSE.write(json.dumps(role) + '\n')
 
-        if roles:
-            return json.dumps(
-                {'roles': sorted(roles, key=lambda k: k['role_id']),
-                 'has_problematic_users': has_problematic_users,
-                 'naming': roles_leaders.naming(roles[0]['role_id'])})
-        else:
-            return json.dumps(
-                {'roles': [],
-                 'has_problematic_users': has_problematic_users,
-                 'naming': ''})
+        return ''
 
     security.declareProtected(eionet_access_nfp_nrc, 'nrcs')
 
@@ -516,7 +617,8 @@ class NfpNrc(SimpleItem, PropertyManager):
         if not self._allowed(agent, REQUEST, country_code):
             return None
 
-        roles = get_members(agent, country_code, 'reportnet-awp')
+        roles = get_members(agent, country_code, 'reportnet-awp',
+                            catalogue.all_organisations(self))
 
         options = {'roles': roles,
                    'country': country_code,
@@ -584,6 +686,7 @@ class NfpNrc(SimpleItem, PropertyManager):
 
         with agent.new_action():
             role_id_list = agent.add_to_role(role_id, 'user', user_id)
+        user_roles.invalidate(user_id)
 
         role_msg = get_role_name(agent, role_id)
         msg = "User %r added to role %s. \n" % (user_id, role_msg)
@@ -669,6 +772,7 @@ class NfpNrc(SimpleItem, PropertyManager):
                                                            user_id)
                     log.info("%s REMOVED USER %s FROM ROLES %r",
                              logged_in_user(REQUEST), user_id, roles_id_list)
+            user_roles.invalidate(*user_id_list)
 
             msg = "Users %r removed from role %s" % (user_id_list, role_name)
             IStatusMessage(REQUEST).add(msg, type='info')
@@ -706,7 +810,7 @@ class NfpNrc(SimpleItem, PropertyManager):
             form_data = user
             form_data['user_id'] = user['uid']
 
-        orgs = agent.all_organisations()
+        orgs = catalogue.all_organisations(self)
         orgs = [{'id': k, 'text': v['name'], 'text_native': v['name_native'],
                  'ldap': True} for k, v in orgs.items()]
 
@@ -1022,22 +1126,8 @@ class CreateUser(BrowserView):
 
     def orgs_in_country(self, country):
         """ """
-        agent = self.context._get_ldap_agent()
-        try:
-            orgs_by_id = agent.all_organisations()
-        except ldap.SIZELIMIT_EXCEEDED:
-            agent = self.context._get_ldap_agent(secondary=True)
-            orgs_by_id = agent.all_organisations()
-        countries = dict(get_country_options(country=country))
-        orgs = {}
-
-        for org_id, info in orgs_by_id.iteritems():
-            country_info = countries.get(info['country'])
-
-            if country_info:
-                orgs[org_id] = info
-
-        return orgs
+        return catalogue.orgs_in_countries(
+            self.context, dict(get_country_options(country=country)))
 
     def __call__(self):
 
@@ -1211,22 +1301,8 @@ class CreateUser(BrowserView):
     def nfp_for_country(self):
         """ Return country code for which the current user has NFP role
         or None otherwise"""
-        user_id = self.request.AUTHENTICATED_USER.getId()
-
-        if user_id:
-            ldap_groups = self.get_ldap_user_groups(user_id)
-
-            for group in ldap_groups:
-                if ('eionet-nfp-mc-' in group[0] or
-                    'eionet-nfp-cc-' in group[0] or
-                        'eionet-nfp-oc-' in group[0]):
-
-                    return group[0].rsplit('-', 1)[-1]
+        return user_roles.nfp_for_country(self.aq_parent, self.request)
 
     def get_ldap_user_groups(self, user_id):
         """ """
-        agent = self.aq_parent._get_ldap_agent(bind=True, secondary=True)
-        ldap_roles = sorted(
-            agent.member_roles_info('user', user_id, ('description',)))
-
-        return ldap_roles
+        return user_roles.member_roles(self.aq_parent, user_id)
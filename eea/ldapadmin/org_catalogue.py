@@ -0,0 +1,160 @@
+""" The organisations of LDAP, grouped by country
+
+The forms and listings need all the organisations, or the ones of a
+country, on almost every page. They are read from LDAP once per
+`ORGS_TTL` seconds and directory, by one request while the others wait
+for it, and read again after the organisations editor changes one of them.
+
+They are read with the primary agent, like the forms did, also for the
+organisations index, which used the secondary one: the entry read right
+after an edit must have the change. The secondary agent is only used when
+the primary one hits the size limit.
+"""
+import threading
+import time
+
+import ldap
+from ldap_config import defaults
+
+# seconds the organisations are reused
+ORGS_TTL = 300
+
+
+def _directory(tool):
+    """ The LDAP server and branch the organisations of `tool` are in """
+    config = getattr(tool, '_config', {})
+
+    return (config.get('ldap_server', defaults['ldap_server']),
+            config.get('orgs_dn', defaults['orgs_dn']))
+
+
+def _fetch(tool):
+    """ `all_organisations`, with the secondary agent if the primary one
+    hits the size limit """
+    try:
+        return tool._get_ldap_agent().all_organisations()
+    except ldap.SIZELIMIT_EXCEEDED:
+        return tool._get_ldap_agent(secondary=True).all_organisations()
+
+
+def _sort_text(value):
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+
+    return (value or u'').lower()
+
+
+class OrgCatalogue(object):
+    """ The organisations of each directory, by id and by country """
+
+    def __init__(self, ttl=ORGS_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._loading = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self, key, now):
+        entry = self._entries.get(key)
+
+        if entry is not None and entry['expires'] > now:
+            return entry
+
+    def _entry(self, tool, now=None):
+        now = now or time.time()
+        key = _directory(tool)
+
+        with self._lock:
+            entry = self._fresh(key, now)
+
+            if entry is not None:
+                return entry
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            with self._lock:
+                entry = self._fresh(key, now)
+
+                if entry is not None:
+                    return entry
+                generation = self._generation
+            try:
+                orgs = _fetch(tool)
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+            by_country = {}
+
+            for org_id, info in orgs.iteritems():
+                by_country.setdefault(info['country'], {})[org_id] = info
+            entry = {'expires': now + self.ttl, 'orgs': orgs,
+                     'by_country': by_country, 'sorted': {}}
+
+            with self._lock:
+                # organisations changed while they were read are read again
+                if generation == self._generation:
+                    self._entries[key] = entry
+
+        return entry
+
+    def all_organisations(self, tool):
+        """ A dict of org id -> info, as `all_organisations` of the agent;
+        shared, not to be changed """
+        return self._entry(tool)['orgs']
+
+    def orgs_in_countries(self, tool, countries):
+        """ A dict of org id -> info of the organisations in `countries`
+        (country codes) """
+        by_country = self._entry(tool)['by_country']
+        orgs = {}
+
+        for code in countries:
+            orgs.update(by_country.get(code, {}))
+
+        return orgs
+
+    def sorted_orgs(self, tool, countries, key='name'):
+        """ A list of (org id, info) of the organisations in `countries` (a
+        dict of country code -> {'name': ...}), sorted by `key`: 'name' or
+        'country' (name). Sorted once for as long as the organisations are
+        kept; shared, not to be changed """
+        entry = self._entry(tool)
+        sorted_key = (tuple(sorted(countries)), key)
+
+        with self._lock:
+            orgs = entry['sorted'].get(sorted_key)
+
+        if orgs is not None:
+            return orgs
+        orgs = []
+
+        for code in countries:
+            orgs.extend(entry['by_country'].get(code, {}).iteritems())
+
+        if key == 'country':
+            def sort_key(org):
+                return (_sort_text(countries[org[1]['country']]['name']),
+                        org[0])
+        else:
+            def sort_key(org):
+                return (_sort_text(org[1]['name']), org[0])
+        orgs.sort(key=sort_key)
+
+        with self._lock:
+            entry['sorted'][sorted_key] = orgs
+
+        return orgs
+
+    def invalidate(self, tool):
+        """ Read the organisations of `tool` again, they were changed """
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(_directory(tool), None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+catalogue = OrgCatalogue()
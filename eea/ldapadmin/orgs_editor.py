@@ -1,19 +1,23 @@
 import codecs
+import csv
 import itertools
 import logging
 import operator
 import re
+import urllib
 from datetime import datetime
 from email.mime.text import MIMEText
 from StringIO import StringIO
 
-from zope.component import getUtility
-from zope.sendmail.interfaces import IMailDelivery
-
+import datatables
 import deform
 import eea.usersdb
 import ldap
 import ldap_config
+import ldapdump
+import mail_outbox
+import user_roles
+from org_catalogue import catalogue
 import xlwt
 from AccessControl import ClassSecurityInfo
 from AccessControl.Permissions import view, view_management_screens
@@ -25,6 +29,7 @@ from countries import get_country, get_country_options
 from deform.widget import SelectWidget
 from ldap import NO_SUCH_OBJECT
 from ldap import INVALID_DN_SYNTAX
+from logic_common import orgs_with_members, users_info
 from OFS.PropertyManager import PropertyManager
 from OFS.SimpleItem import SimpleItem
 from persistent.mapping import PersistentMapping
@@ -38,6 +43,9 @@ log = logging.getLogger('orgs_editor')
 eionet_edit_orgs = 'Eionet edit organisations'
 eionet_edit_users = 'Eionet edit users'
 
+# organisations whose members are looked up together in demo_members
+REPORT_ORGS_CHUNK = 20
+
 manage_add_orgs_editor_html = PageTemplateFile('zpt/orgs_manage_add.zpt',
                                                globals())
 manage_add_orgs_editor_html.ldap_config_edit_macro = ldap_config.edit_macro
@@ -169,14 +177,20 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
         REQUEST.RESPONSE.redirect(self.absolute_url() + '/manage_edit')
 
     def _get_ldap_agent(self, bind=True, secondary=False):
-        agent = ldap_config.ldap_agent_with_config(self._config, bind,
-                                                   secondary=secondary)
+        return ldap_config.request_agent(self, self._new_ldap_agent, bind,
+                                         secondary)
+
+    def _new_ldap_agent(self, bind=True, secondary=False):
+        agent = ldap_config.ldap_agent_with_config(
+            self._config, bind, secondary=secondary, request=self.REQUEST)
         agent._author = logged_in_user(self.REQUEST)
 
         return agent
 
-    def index_html(self, REQUEST):
-        """ Index of organisations """
+    def _listed_countries(self, REQUEST):
+        """ The countries whose organisations are shown in the index, the
+        one in the request or the one of the NFP, as a dict of country code
+        -> {'name', 'pub_code'} """
         country = REQUEST.get('country')
         nfp_country = self.nfp_for_country()
 
@@ -185,26 +199,54 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
 
         if not (self.checkPermissionView() or nfp_country):
             raise Unauthorized
-        agent = self._get_ldap_agent(secondary=True)
-        orgs_by_id = agent.all_organisations()
-        countries = dict(get_country_options(country=nfp_country or country))
-        orgs = []
 
-        for org_id, info in orgs_by_id.iteritems():
-            country = countries.get(info['country'])
+        return dict(get_country_options(country=nfp_country or country))
 
-            if country:
-                orgs.append({'id': org_id,
-                             'name': info['name'],
-                             'country': country['name'],
-                             'country_pub_code': country['pub_code']})
-        orgs.sort(key=operator.itemgetter('id'))
+    def index_html(self, REQUEST):
+        """ Index of organisations; the rows are loaded page by page from
+        `organisations_datatable` """
+        nfp_country = self.nfp_for_country()
+
+        if self.title != 'National Organisations':
+            nfp_country = None
+
+        if not (self.checkPermissionView() or nfp_country):
+            raise Unauthorized
+        datatable_url = self.absolute_url() + '/organisations_datatable'
+
+        if REQUEST.get('country'):
+            datatable_url += '?country=' + urllib.quote(REQUEST['country'])
         options = {
-            'sorted_organisations': orgs,
+            'datatable_url': datatable_url,
         }
 
         return self._render_template('zpt/orgs_index.zpt', **options)
 
+    def organisations_datatable(self, REQUEST):
+        """ A page of the organisations index, for DataTables; only the
+        rows of the page are built, from the organisations the catalogue
+        keeps sorted """
+        params = datatables.read_params(REQUEST.form)
+        countries = self._listed_countries(REQUEST)
+        key = datatables.sort_key(params, ['country', 'name']) or 'name'
+        orgs = catalogue.sorted_orgs(self, countries, key)
+
+        def matches(org, search):
+            return datatables.contains(
+                search, org[1]['name'], countries[org[1]['country']]['name'])
+        page, filtered = datatables.page_sorted(orgs, params, matches)
+        rows = []
+
+        for org_id, info in page:
+            country = countries[info['country']]
+            rows.append({'id': org_id,
+                         'name': info['name'],
+                         'country': country['name'],
+                         'country_pub_code': country['pub_code']})
+
+        return datatables.render_json(
+            REQUEST, datatables.response(params, rows, len(orgs), filtered))
+
     def export_organisations(self, REQUEST):
         """ Export of organisations """
 
@@ -212,7 +254,6 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
             raise Unauthorized
 
         agent = self._get_ldap_agent()
-        orgs_by_id = agent.all_organisations()
 
         if self.checkPermissionEditOrganisations():
             countries = dict(get_country_options())
@@ -224,21 +265,23 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
                 raise Unauthorized
             countries = dict(get_country_options(country=nfp_country))
 
+        try:
+            orgs_by_id = orgs_with_members(agent)
+        except ldap.SIZELIMIT_EXCEEDED:
+            orgs_by_id = orgs_with_members(
+                self._get_ldap_agent(secondary=True))
         orgs = []
 
-        for org_id, info in orgs_by_id.iteritems():
+        for org_id, (info, members) in orgs_by_id.iteritems():
             country = countries.get(info['country'])
 
             if country:
-                orgs.append({'id': org_id,
-                             'name': info['name'],
-                             'country': country['name'],
-                             'country_pub_code': country['pub_code']})
+                orgs.append(dict(info, id=org_id, members=members,
+                                 country=country['name'],
+                                 country_pub_code=country['pub_code']))
         orgs.sort(key=operator.itemgetter('id'))
-
-        for d in orgs:
-            org_info = agent.org_info(d['id'])
-            d.update(org_info)
+        found = users_info(agent, set(itertools.chain.from_iterable(
+            org['members'] for org in orgs)))
 
         wb = xlwt.Workbook()
         org_sheet = wb.add_sheet("Organisations")
@@ -273,79 +316,53 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
 
         org_sheet.write(0, 6, "Members count", style_header)
 
-        for i, row in enumerate(orgs):
-            org_sheet.write(i + 2, 0, row['id'], style_normal)
-            org_sheet.write(i + 2, 1, row['name'], style_normal)
-            org_sheet.write(i + 2, 2, row['locality'], style_normal)
-            org_sheet.write(i + 2, 3, row['postal_address'], style_normal)
-            org_sheet.write(i + 2, 4, row['fax'], style_normal)
-            org_sheet.write(i + 2, 5, row['email'], style_normal)
-            members = agent.members_in_org(row['id'])   # TODO: optimize
-            org_sheet.write(i + 2, 6, len(members), style_normal)
-
         org_sheet.col(1).set_width(9000)
         org_sheet.col(2).set_width(5000)
         org_sheet.col(3).set_width(9000)
         org_sheet.col(4).set_width(4000)
         org_sheet.col(5).set_width(5000)
+        users_sheet.col(0).set_width(4000)
+        users_sheet.col(1).set_width(6000)
+        users_sheet.col(2).set_width(9000)
 
         row_counter = 0
 
-        for org in orgs:
-            org_id, org_name = org['id'], org['name']
+        for i, org in enumerate(orgs):
+            for j, col in enumerate(cols):
+                org_sheet.write(i + 2, j, org[col], style_normal)
+            org_sheet.write(i + 2, 6, len(org['members']), style_normal)
 
-            users_sheet.write(row_counter, 0, org_name, style_org_header)
+            users_sheet.write(row_counter, 0, org['name'], style_org_header)
             row = users_sheet.row(row_counter)
             row.height = int(row.height * 1.3)
             row_counter += 2
 
-            org_members = []
-
-            members = agent.members_in_org(org_id)
-
-            for user_id in members:
-                try:
-                    org_members.append(agent.user_info(user_id))
-                except (NO_SUCH_OBJECT, eea.usersdb.UserNotFound):
-                    pass
+            org_members = [found[user_id] for user_id in org['members']
+                           if user_id in found]
             org_members.sort(key=operator.itemgetter('first_name'))
 
-            cols = [
-                'user id',
-                'fullname',
-                'email',
-            ]
-
-            for i, col in enumerate(cols):
-                users_sheet.write(row_counter, i, col, style_header)
+            for j, col in enumerate(['user id', 'fullname', 'email']):
+                users_sheet.write(row_counter, j, col, style_header)
 
-            for i, member in enumerate(org_members, 1):
-                users_sheet.write(row_counter + i, 0, member['uid'])
-                users_sheet.write(row_counter + i, 1, member['full_name'])
-                users_sheet.write(row_counter + i, 2, member['email'])
+            for j, member in enumerate(org_members, 1):
+                users_sheet.write(row_counter + j, 0, member['uid'])
+                users_sheet.write(row_counter + j, 1, member['full_name'])
+                users_sheet.write(row_counter + j, 2, member['email'])
 
-            users_sheet.col(0).set_width(4000)
-            users_sheet.col(1).set_width(6000)
-            users_sheet.col(2).set_width(9000)
-
-            row_counter += i + 2
-
-        out = StringIO()
-        wb.save(out)
-        out.seek(0)
-        out = out.read()
+            row_counter += len(org_members) + 2
 
         RESPONSE = REQUEST.RESPONSE
 
         RESPONSE.setHeader('Content-Type', "application/vnd.ms-excel")
-        RESPONSE.setHeader('Content-Length', len(out))
         RESPONSE.setHeader('Pragma', 'public')
         RESPONSE.setHeader('Cache-Control', 'max-age=0')
         RESPONSE.addHeader("content-disposition",
                            "attachment; filename=%s-organisations.xls" %
                            nfp_country)
+        # written to the response as it is serialized
+        wb.save(RESPONSE)
 
-        return out
+        return ''
 
     def export_org(self, REQUEST):
         """ Export of one organisation """
@@ -388,14 +405,8 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
         org_sheet.col(4).set_width(4000)
         org_sheet.col(5).set_width(5000)
 
-        org_members = []
         members = agent.members_in_org(org_id)
-
-        for user_id in members:
-            try:
-                org_members.append(agent.user_info(user_id))
-            except (NO_SUCH_OBJECT, eea.usersdb.UserNotFound):
-                pass
+        org_members = users_info(agent, members).values()
 
         org_members.sort(key=operator.itemgetter('first_name'))
 
@@ -523,6 +534,7 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
         try:
             with agent.new_action():
                 agent.create_org(org_id, org_info)
+            catalogue.invalidate(self)
         except ldap.ALREADY_EXISTS:
             msg = "Organisation not created. Please correct the errors below."
             msgs.add(msg, type='error')
@@ -611,6 +623,7 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
         agent = self._get_ldap_agent(bind=True)
         with agent.new_action():
             agent.set_org_info(org_id, org_info)
+        catalogue.invalidate(self)
 
         when = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         msgs.add("Organisation saved (%s)" % when, type='info')
@@ -670,8 +683,12 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
         agent = self._get_ldap_agent(bind=True)
 
         try:
-            with agent.new_action():
-                agent.rename_org(org_id, new_org_id)
+            try:
+                with agent.new_action():
+                    agent.rename_org(org_id, new_org_id)
+            finally:
+                # a failed rename may have changed some of the entries
+                catalogue.invalidate(self)
         except eea.usersdb.NameAlreadyExists:
             msg = ('Organisation "%s" could not be renamed because "%s" '
                    'already exists.' % (org_id, new_org_id))
@@ -735,6 +752,7 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
         agent = self._get_ldap_agent(bind=True)
         with agent.new_action():
             agent.delete_org(org_id)
+        catalogue.invalidate(self)
 
         msgs.add('Organisation "%s" has been deleted.' % org_id, type='info')
 
@@ -742,28 +760,16 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
 
         return REQUEST.RESPONSE.redirect(self.absolute_url() + '/')
 
-    security.declarePublic('members_html')
-
-    def members_html(self, REQUEST):
-        """ view """
-
-        org_id = REQUEST.form.get('id')
-
-        if not org_id:
-            IStatusMessage(REQUEST).add("The organisation id is mandatory",
-                                        type='error')
-
-            return REQUEST.RESPONSE.redirect(self.absolute_url())
-        agent = self._get_ldap_agent()
-
+    def _members_info(self, agent, members):
+        """ Infos of the users with the ids in `members`, in the same order;
+        the ones that no longer exist are listed as former members """
         org_members = []
-        members = agent.members_in_org(org_id)
+        found = users_info(agent, members)
 
         for user_id in members:
-            try:
-                org_members.append(agent.user_info(user_id))
-            except (NO_SUCH_OBJECT, INVALID_DN_SYNTAX,
-                    eea.usersdb.UserNotFound):
+            if user_id in found:
+                org_members.append(found[user_id])
+            else:
                 deleted_user_info = dict((prop, '') for prop in USER_INFO_KEYS)
                 deleted_user_info['first_name'] = 'Former'
                 deleted_user_info['last_name'] = 'Eionet member'
@@ -774,10 +780,57 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
                 deleted_user_info['dn'] = agent._user_dn(user_id)
                 org_members.append(deleted_user_info)
 
-        org_members.sort(key=operator.itemgetter('first_name'))
+        return org_members
+
+    security.declarePublic('members_datatable')
+
+    def members_datatable(self, REQUEST):
+        """ A page of the members of an organisation, for DataTables. The
+        members are searched and sorted in the LDAP dump; only the ones on
+        the page are read from LDAP. """
+        params = datatables.read_params(REQUEST.form)
+        org_id = REQUEST.form.get('id')
+
+        if not org_id:
+            return datatables.render_json(
+                REQUEST, datatables.response(params, [], 0, 0))
+        agent = self._get_ldap_agent()
+        members = dict((user_id, agent._user_dn(user_id))
+                       for user_id in agent.members_in_org(org_id))
+        disabled = {'no_disabled': False, 'only_disabled': True}.get(
+            REQUEST.form.get('disabled', 'no_disabled'))
+        sort = datatables.sort_key(params, ['id', 'full_name', 'status'])
+        page, total, filtered = ldapdump.users_page(
+            params['search'], sort or 'full_name', params['sort_desc'],
+            params['start'], params['length'],
+            search_columns=['id', 'full_name'], members=members,
+            disabled=disabled)
+        rows = [
+            dict((key, member.get(key)) for key in
+                 ['id', 'first_name', 'last_name', 'full_name', 'status'])
+            for member in self._members_info(
+                agent, [row['id'] for row in page])]
+
+        return datatables.render_json(
+            REQUEST, datatables.response(params, rows, total, filtered))
+
+    security.declarePublic('members_html')
+
+    def members_html(self, REQUEST):
+        """ view """
+
+        org_id = REQUEST.form.get('id')
+
+        if not org_id:
+            IStatusMessage(REQUEST).add("The organisation id is mandatory",
+                                        type='error')
+
+            return REQUEST.RESPONSE.redirect(self.absolute_url())
+        agent = self._get_ldap_agent()
         options = {
             'organisation': agent.org_info(org_id),
-            'org_members': org_members,
+            'datatable_url': '%s/members_datatable?id=%s' % (
+                self.absolute_url(), urllib.quote(org_id)),
         }
         self._set_breadcrumbs([(org_id,
                                 self.absolute_url() + '/organisation?id=%s' %
@@ -808,91 +861,69 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
         message['From'] = addr_from
         message['To'] = user_info['email']
         message['Subject'] = subject
-
-        try:
-            from plone import api
-            api.portal.send_email(recipient=[addr_to], sender=addr_from,
-                                  subject=subject, body=message)
-        except ImportError:
-            mailer = getUtility(IMailDelivery, name="naaya-mail-delivery")
-            mailer.send(addr_from, [addr_to], message)
+        mail_outbox.send_email(addr_from, [addr_to], message)
 
     security.declareProtected(eionet_edit_orgs, 'demo_members')
 
     def demo_members(self, REQUEST):
         """ view """
-        from ldap import NO_SUCH_OBJECT
-
         format = REQUEST.form.get('format', 'html')
         agent = self._get_ldap_agent()
-        orgs_by_id = agent.all_organisations()
-
-        orgs = []
-
-        for org_id, info in orgs_by_id.iteritems():
-            org_members = agent.members_in_org(org_id)
-            members = []
-
-            for user_id in org_members:
-                try:
-                    user_info = agent.user_info(user_id)
-                    members.append(user_info)
-                except (NO_SUCH_OBJECT, eea.usersdb.UserNotFound):
-                    pass
-
-            org = {
-                'id': org_id,
-                'name': info['name'],
-                'country': info['country'],
-                'members': members
-            }
-            orgs.append(org)
-
-        orgs.sort(key=operator.itemgetter('name'))
-        options = {
-            'agent': agent,
-            'orgs': orgs
-        }
+        orgs = self._report_orgs(agent)
 
         if format == 'csv':
-            from StringIO import StringIO
-            import csv
-
+            RESPONSE = REQUEST.RESPONSE
+            RESPONSE.setHeader('Content-Type', 'text/csv')
+            RESPONSE.setHeader('Content-Disposition',
+                               "attachment;filename=ldap_users.csv")
             output = StringIO()
-            header = ('Organisation ID', 'Organisation name', 'Member ID',
-                      'Member full name', 'Member email')
-
-            REQUEST.RESPONSE.setHeader('Content-Type', 'text/csv')
-            REQUEST.RESPONSE.setHeader('Content-Disposition',
-                                       "attachment;filename=ldap_users.csv")
-
             csv_writer = csv.writer(output)
-            csv_writer.writerow(header)
-
-            rows = []
+            csv_writer.writerow(('Organisation ID', 'Organisation name',
+                                 'Member ID', 'Member full name',
+                                 'Member email'))
+            RESPONSE.write(codecs.BOM_UTF8 + output.getvalue())
 
             for org in orgs:
+                output = StringIO()
+                csv_writer = csv.writer(output)
+
                 if not org['members']:
-                    row = [org['id'], org['name'], 'NO MEMEBRS', '', '']
-                    rows.append(row)
+                    rows = [[org['id'], org['name'], 'NO MEMEBRS', '', '']]
                 else:
-                    user_data = org['members'][0]
-                    first_row = [org['id'], org['name'], user_data['id'],
-                                 user_data['full_name'], user_data['email']]
-                    rows.append(first_row)
-                    org['members'].pop(0)
-
-                    for user_data in org['members']:
-                        row = ['', '', user_data['id'], user_data['full_name'],
-                               user_data['email']]
-                        rows.append(row)
-
-            for item in rows:
-                csv_writer.writerow([value.encode('utf-8') for value in item])
-
-            return codecs.BOM_UTF8 + output.getvalue()
-
-        return self._render_template('zpt/orgs_html_report.zpt', **options)
+                    rows = [['', '', user_data['id'], user_data['full_name'],
+                             user_data['email']]
+                            for user_data in org['members']]
+                    rows[0][:2] = [org['id'], org['name']]
+
+                for item in rows:
+                    csv_writer.writerow([value.encode('utf-8')
+                                         for value in item])
+                RESPONSE.write(output.getvalue())
+
+            return ''
+
+        return self._render_template('zpt/orgs_html_report.zpt', orgs=orgs)
+
+    def _report_orgs(self, agent):
+        """ Yield the organisations, sorted by name, with the user info of
+        their members; the members are looked up for a few organisations
+        at a time """
+        orgs = sorted(orgs_with_members(agent).iteritems(),
+                      key=lambda item: item[1][0]['name'])
+
+        for start in range(0, len(orgs), REPORT_ORGS_CHUNK):
+            chunk = orgs[start:start + REPORT_ORGS_CHUNK]
+            found = users_info(agent, set(itertools.chain.from_iterable(
+                members for org_id, (info, members) in chunk)))
+
+            for org_id, (info, members) in chunk:
+                yield {
+                    'id': org_id,
+                    'name': info['name'],
+                    'country': info['country'],
+                    'members': [found[user_id] for user_id in members
+                                if user_id in found],
+                }
 
     def remove_members(self, REQUEST):
         """ view """
@@ -1075,7 +1106,7 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
         else:
             form_data = data
 
-        orgs = agent.all_organisations()
+        orgs = catalogue.all_organisations(self)
         orgs = [{'id': k, 'text': v['name'], 'ldap': True} for
                 k, v in orgs.items()]
         user_orgs = list(agent.user_organisations(user_id))
@@ -1212,29 +1243,11 @@ class OrganisationsEditor(SimpleItem, PropertyManager):
 
     def nfp_for_country(self):
         """ """
-        user_id = self.REQUEST.AUTHENTICATED_USER.getId()
-
-        if user_id:
-            ldap_groups = self.get_ldap_user_groups(user_id)
-
-            for group in ldap_groups:
-                if 'eionet-nfp-cc-' in group[0]:
-                    return group[0].replace('eionet-nfp-cc-', '')
-
-                if 'eionet-nfp-mc-' in group[0]:
-                    return group[0].replace('eionet-nfp-mc-', '')
-
-                if 'eionet-nfp-oc-' in group[0]:
-                    return group[0].replace('eionet-nfp-oc-', '')
+        return user_roles.nfp_for_country(self, self.REQUEST)
 
     def get_ldap_user_groups(self, user_id):
         """ """
-        agent = self._get_ldap_agent(bind=True, secondary=True)
-        ldap_roles = sorted(agent.member_roles_info('user',
-                                                    user_id,
-                                                    ('description',)))
-
-        return ldap_roles
+        return user_roles.member_roles(self, user_id)
 
 
 InitializeClass(OrganisationsEditor)
@@ -6,13 +6,10 @@ from collections import namedtuple
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 
-from zope.component import getUtility
-from zope.sendmail.interfaces import IMailDelivery
-
 from AccessControl import ClassSecurityInfo
 from AccessControl.Permissions import view, view_management_screens
 from App.class_init import InitializeClass
-from eea.ldapadmin import ldap_config, query
+from eea.ldapadmin import ldap_config, mail_outbox, query
 from eea.ldapadmin.constants import NETWORK_NAME
 from eea.ldapadmin.ui_common import (CommonTemplateLogic, TemplateRenderer,
                                      load_template)
@@ -108,8 +105,14 @@ class PasswordResetTool(SimpleItem):
         self._config.update(new_config)
         REQUEST.RESPONSE.redirect(self.absolute_url() + '/manage_edit')
 
-    def _get_ldap_agent(self, bind=True):
-        return ldap_config.ldap_agent_with_config(self._config, bind)
+    def _get_ldap_agent(self, bind=True, secondary=False):
+        return ldap_config.request_agent(self, self._new_ldap_agent, bind,
+                                         secondary)
+
+    def _new_ldap_agent(self, bind=True, secondary=False):
+        return ldap_config.ldap_agent_with_config(
+            self._config, bind, secondary=secondary,
+            request=getattr(self, 'REQUEST', None))
 
     def _predefined_filters(self):
         return sorted(self.objectValues([query.Query.meta_type]),
@@ -148,17 +151,7 @@ class PasswordResetTool(SimpleItem):
         message['To'] = addr_to
         subject = "%s account password recovery" % NETWORK_NAME
         message['Subject'] = subject
-
-        try:
-            from plone import api
-            api.portal.send_email(recipient=[addr_to], sender=addr_from,
-                                  subject=subject, body=message)
-        except ImportError:
-            mailer = getUtility(IMailDelivery, name="naaya-mail-delivery")
-            try:
-                mailer.send(addr_from, [addr_to], message.as_string())
-            except AssertionError:
-                mailer.send(addr_from, [addr_to], message)
+        mail_outbox.send_email(addr_from, [addr_to], message)
 
     security.declareProtected(view, 'ask_for_password_reset')
 
@@ -4,7 +4,7 @@ import logging
 import operator
 import re
 import sys
-from collections import defaultdict
+import urllib
 from string import ascii_lowercase, digits
 from StringIO import StringIO
 
@@ -23,8 +23,10 @@ from AccessControl.Permissions import view, view_management_screens
 from App.class_init import InitializeClass
 from DateTime import DateTime
 from eea import usersdb
-from eea.ldapadmin import ldap_config, roles_leaders
+from eea.ldapadmin import (datatables, ldap_config, ldapdump, roles_leaders,
+                           user_roles)
 from eea.ldapadmin.import_export import generate_excel
+from eea.ldapadmin.logic_common import users_info
 from eea.ldapadmin.ui_common import (CommonTemplateLogic,
                                      NaayaViewPageTemplateFile,
                                      TemplateRenderer, get_role_name,
@@ -132,147 +134,78 @@ class RoleCreationError(Exception):
         self.messages = messages
 
 
-def role_members(agent, role_id, subroles=False, filter_date=None):
+def role_member_roles(agent, role_id, subroles=False, filter_date=None):
     """
-    Return members of specified role.
-    If subroles is True return all members of specified role and its subroles.
+    Return the ids of the members of specified role, mapped to their roles
+    if subroles is True (then the members of its subroles are included) or
+    to None. With filter_date, the users that had the role then are added.
 
     """
-    from ldap import NO_SUCH_OBJECT
-
-    users = {}
-    leaders, alternates = agent.role_leaders(role_id)
-
     if subroles:
-        members = agent.members_in_subroles_with_source(role_id)
-
-        for user_id, roles in members['users']:
-            try:
-                users[user_id] = agent.user_info(user_id)
-                users[user_id].update({'roles': roles})
-            except (NO_SUCH_OBJECT, usersdb.UserNotFound):
-                users[user_id] = {'id': user_id, 'deleted': True}
-            else:
-                users[user_id]['leader'] = user_id in leaders
-                users[user_id]['alternate'] = user_id in alternates
+        members = dict(agent.members_in_subroles_with_source(role_id)['users'])
     else:
-        members = agent.members_in_role(role_id)
-
-        for user_id in members['users']:
-            try:
-                users[user_id] = agent.user_info(user_id)
-            except (NO_SUCH_OBJECT, usersdb.UserNotFound):
-                users[user_id] = {'id': user_id, 'deleted': True}
-            else:
-                users[user_id]['leader'] = user_id in leaders
-                users[user_id]['alternate'] = user_id in alternates
+        members = dict.fromkeys(agent.members_in_role(role_id)['users'])
 
     # We need to look at the archival records of all users
     # to be able to determine if, at that date, some other
-    # users also had the role
+    # users also had the role. The role changes from the users' changelogs
+    # are indexed in the LDAP dump when it is made, because the LDAP server
+    # can't tell us the roles a user had, e.g. when the user is disabled.
 
-    # First, we load a dump of the LDAP data from sqlite db
-    # We do this because regular admin LDAP accounts are not
-    # allowed to fetch a large number of results
+    if filter_date:
+        roles_to_check = [role_id]
 
-    # Next, we look at the (reversed) changelog for each user.
-    # If the user has a changelog entry in the period from
-    # filter_date -> today, we record that change as _reversed_,
-    # because we want to find out which roles the user had at the
-    # desired date. This is important because, for example, the LDAP
-    # server can't tell us the roles a user has when the user is disabled.
+        if subroles:
+            roles_to_check += [agent._role_id(x)
+                               for x in agent._sub_roles(role_id)]
+        filter_date = DateTime(filter_date).asdatetime().date()
+        former = ldapdump.former_role_members(roles_to_check, filter_date)
 
-    # this keeps track of how many roles are added/removed to the user
-    extra_users = defaultdict(lambda: 0)
-    _user_roles = defaultdict(set)    # a mapping of user>set of roles,
-    # to track of what roles that user had
+        if former is None:
+            # dump made before the membership events were introduced;
+            # regular admin LDAP accounts are not allowed to fetch a large
+            # number of results, so the dump is scanned instead
+            former = ldapdump.former_role_members_from_dump(
+                agent.get_all_users_from_dump(), roles_to_check, filter_date)
+        members.update(former)
 
-    # TODO: is extra_users needed?
+    return members
 
-    roles_to_check = set([role_id])
 
-    if subroles:
-        roles_to_check = set([role_id] + [agent._role_id(x)
-                                          for x in agent._sub_roles(role_id)])
+def members_info(agent, role_id, member_roles):
+    """
+    Return the infos of the users in member_roles (see role_member_roles),
+    by id, with their roles and whether they lead role_id.
 
-    if filter_date:
-        filter_date = DateTime(filter_date).asdatetime().date()
-        ldap_data = agent.get_all_users_from_dump()
+    """
+    users = {}
+    leaders, alternates = agent.role_leaders(role_id)
+    found = users_info(agent, member_roles)
 
-        for rec in ldap_data:
-            changelog = rec[1].get('registeredAddress')
+    for user_id, roles in member_roles.iteritems():
+        if user_id not in found:
+            users[user_id] = {'id': user_id, 'deleted': True}
 
-            if not changelog:
-                continue
-            try:
-                changelog = json.loads(changelog)
-            except:
-                changelog = []
-                log.warning("Invalid changelog for user %r", rec)
+            continue
+        users[user_id] = found[user_id]
+        users[user_id]['leader'] = user_id in leaders
+        users[user_id]['alternate'] = user_id in alternates
 
-            try:
-                user_dn = rec[0]
-                uid = agent._user_id(user_dn)
-            except KeyError:
-                uid = [x.split('=')[1]
-                       for x in user_dn.split(',') if x.startswith('cn')]
+        if roles is not None:
+            users[user_id]['roles'] = roles
 
-            changelog = reversed(changelog)  # go by last changes first
+    return users
 
-            for entry in changelog:
-                if not entry.get('timestamp'):
-                    continue    # this is due to some API changes
 
-                entry_date = DateTime(entry['timestamp']).\
-                    toZone("CET").asdatetime().date()
+def role_members(agent, role_id, subroles=False, filter_date=None):
+    """
+    Return members of specified role.
+    If subroles is True return all members of specified role and its subroles.
 
-                try:
-                    if entry_date > filter_date:
-                        if entry['action'] in ['ADDED_TO_ROLE',
-                                               'ADDED_AS_ROLE_OWNER']:
-                            role = entry.get('data', {}).get('role')
-
-                            if role in roles_to_check:
-                                extra_users[uid] -= 1
-                                _user_roles[uid].remove(role)
-
-                        if entry['action'] in ["REMOVED_FROM_ROLE",
-                                               "REMOVED_AS_ROLE_OWNER"]:
-                            role = entry.get('data', {}).get('role')
-
-                            if role in roles_to_check:
-                                extra_users[uid] += 1
-                                _user_roles[uid].add(role)
-
-                        if entry['action'] == 'ENABLE_ACCOUNT':
-                            roles = entry.get('data', {}).get('roles')
-
-                            for role in roles:
-                                if role in roles_to_check:
-                                    extra_users[uid] -= 1
-                                    _user_roles[uid].remove(role)
-
-                        if entry['action'] == "DISABLE_ACCOUNT":
-                            roles = entry.get('data', {}).get('roles')
-
-                            for role in roles:
-                                if role in roles_to_check:
-                                    extra_users[uid] += 1
-                                    _user_roles[uid].add(role)
-                except KeyError:
-                    log.warning("Changelog Entries out of order for %s", uid)
-
-    for user_id in [k for k in extra_users.keys() if extra_users[k] > 0]:
-        try:
-            users[user_id] = agent.user_info(user_id)
-        except (NO_SUCH_OBJECT, usersdb.UserNotFound):
-            users[user_id] = {'id': user_id, 'deleted': True}
-        else:
-            users[user_id]['leader'] = user_id in leaders
-            users[user_id]['alternate'] = user_id in alternates
-            users[user_id]['roles'] = _user_roles.get(user_id, [])
+    """
+    member_roles = role_member_roles(agent, role_id, subroles, filter_date)
 
-    return {'users': users}
+    return {'users': members_info(agent, role_id, member_roles)}
 
 
 class RolesEditor(Folder):
@@ -310,8 +243,13 @@ class RolesEditor(Folder):
         self._config.update(ldap_config.read_form(REQUEST.form, edit=True))
         REQUEST.RESPONSE.redirect(self.absolute_url() + '/manage_edit')
 
-    def _get_ldap_agent(self, bind=True):
-        agent = ldap_config.ldap_agent_with_config(self._config, bind)
+    def _get_ldap_agent(self, bind=True, secondary=False):
+        return ldap_config.request_agent(self, self._new_ldap_agent, bind,
+                                         secondary)
+
+    def _new_ldap_agent(self, bind=True, secondary=False):
+        agent = ldap_config.ldap_agent_with_config(
+            self._config, bind, secondary=secondary, request=self.REQUEST)
         agent._author = logged_in_user(self.REQUEST)
 
         return agent
@@ -320,6 +258,24 @@ class RolesEditor(Folder):
         return sorted(self.objectValues([query.Query.meta_type]),
                       key=operator.methodcaller('getId'))
 
+    def _role_info(self, agent, role_id):
+        """ `agent.role_info`, memoized for the current request """
+        cache = ldap_config.request_cache(self, 'role_info')
+
+        if cache is None:
+            return agent.role_info(role_id)
+
+        if role_id not in cache:
+            cache[role_id] = agent.role_info(role_id)
+
+        return cache[role_id]
+
+    def _forget_role_info(self, role_id):
+        cache = ldap_config.request_cache(self, 'role_info')
+
+        if cache is not None:
+            cache.pop(role_id, None)
+
     def _get_permitted_senders_info(self, mail_info):
         """ Returns permittedSender-s as {'patterns': [..], 'emails': [..]} """
         result = {'patterns': [], 'emails': []}
@@ -340,7 +296,7 @@ class RolesEditor(Folder):
         agent = self._get_ldap_agent()
 
         try:
-            role_info = agent.role_info(role_id)
+            role_info = self._role_info(agent, role_id)
         except usersdb.RoleNotFound:
             REQUEST.RESPONSE.setStatus(404)
             options = {'message': "Role %s does not exist." % role_id}
@@ -627,6 +583,7 @@ class RolesEditor(Folder):
 
         for role_source, role_destination in roles.items():
             agent.merge_roles(role_source, role_destination)
+        user_roles.clear()
 
     def _prefill_roles(self, roles):
         agent = self._get_ldap_agent(bind=True)
@@ -705,7 +662,7 @@ class RolesEditor(Folder):
             return False
 
         agent = self._get_ldap_agent()
-        role_info = agent.role_info(role_id)
+        role_info = self._role_info(agent, role_id)
 
         return agent._user_dn(user.getId()) in role_info['owner']
 
@@ -733,7 +690,7 @@ class RolesEditor(Folder):
 
             return False
         agent = self._get_ldap_agent()
-        role_info = agent.role_info(role_id)
+        role_info = self._role_info(agent, role_id)
 
         if agent._user_dn(user.getId()) not in role_info['owner']:
             return False
@@ -952,6 +909,7 @@ class RolesEditor(Folder):
         agent = self._get_ldap_agent(bind=True)
         with agent.new_action():
             role_id_list = agent.add_to_role(role_id, 'user', user_id)
+        user_roles.invalidate(user_id)
         roles_msg = roles_list_to_text(agent, role_id_list)
         msg = "User %r added to roles %s." % (user_id, roles_msg)
         IStatusMessage(REQUEST).add(msg, type='info')
@@ -1002,6 +960,7 @@ class RolesEditor(Folder):
                                                            user_id)
                     log.info("%s REMOVED USER %s FROM ROLES %r",
                              logged_in_user(REQUEST), user_id, roles_id_list)
+            user_roles.invalidate(*user_id_list)
 
             msg = "Users %r removed from role %r" % (user_id_list, role_name)
             IStatusMessage(REQUEST).add(msg, type='info')
@@ -1038,6 +997,7 @@ class RolesEditor(Folder):
         agent = self._get_ldap_agent(bind=True)
         with agent.new_action():
             role_id_list = agent.remove_from_role(role_id, 'user', user_id)
+        user_roles.invalidate(user_id)
         log.info("%s REMOVED USER %r FROM ROLE(S) %r",
                  logged_in, user_id, role_id_list)
 
@@ -1196,6 +1156,8 @@ class RolesEditor(Folder):
                             log.info("%s ADDED OWNER %r FOR ROLES %r",
                                      logged_in_user(REQUEST), owner, updated)
                         msgs.add(msg, type=t)
+            # the owners may have changed
+            self._forget_role_info(role_id)
 
         mailgroup_info = agent.mail_group_info(role_id)
 
@@ -1441,24 +1403,25 @@ class RolesEditor(Folder):
 
         agent = self._get_ldap_agent()
         try:
-            role_info = agent.role_info(role_id)
+            role_info = self._role_info(agent, role_id)
         except usersdb.RoleNotFound:
             REQUEST.RESPONSE.setStatus(404)
             options = {'message': "Role %s does not exist." % role_id}
 
             return self._render_template('zpt/generic_error.zpt', **options)
 
-        filter_date = REQUEST.form.get('filter_date', None)
-        users_in_role = role_members(agent,
-                                     role_id,
-                                     True,
-                                     filter_date)['users']
+        # the members are loaded page by page from `all_members_datatable`
+        query = [('role_id', role_id)]
+
+        if REQUEST.form.get('filter_date'):
+            query.append(('filter_date', REQUEST.form['filter_date']))
 
         options = {
             'role_id':          role_id,
-            'users':            users_in_role,
+            'datatable_url':    '%s/all_members_datatable?%s' % (
+                self.absolute_url(), urllib.urlencode(query)),
             'role_info':        role_info,
-            'members_count':    len(role_members(agent, role_id)['users']),
+            'members_count':    len(agent.members_in_role(role_id)['users']),
             'can_edit':         self.can_edit_roles(
                 REQUEST.AUTHENTICATED_USER),
             'can_edit_members': self.can_edit_members(
@@ -1470,6 +1433,52 @@ class RolesEditor(Folder):
 
         return self._render_template('zpt/roles_all_members.zpt', **options)
 
+    security.declareProtected(view, 'all_members_datatable')
+
+    def all_members_datatable(self, REQUEST):
+        """ A page of the users of a role and its subroles, for DataTables.
+        The users are searched and sorted in the LDAP dump; only the ones on
+        the page are read from LDAP. """
+        role_id = REQUEST.form.get('role_id', None)
+        params = datatables.read_params(REQUEST.form)
+        agent = self._get_ldap_agent()
+        member_roles = role_member_roles(agent, role_id, True,
+                                         REQUEST.form.get('filter_date'))
+        is_authenticated = _is_authenticated(REQUEST)
+
+        if is_authenticated:
+            columns = ['full_name', 'id', 'email', 'organisation']
+            fields = ['id', 'full_name', 'email', 'phone', 'fax',
+                      'organisation', 'leader', 'alternate', 'deleted']
+        else:
+            # the users that no longer exist are not listed
+            columns = ['full_name']
+            fields = ['full_name', 'leader', 'alternate']
+        page, total, filtered = ldapdump.users_page(
+            params['search'],
+            datatables.sort_key(params, columns) or 'full_name',
+            params['sort_desc'], params['start'], params['length'],
+            search_columns=columns,
+            members=dict((user_id, agent._user_dn(user_id))
+                         for user_id in member_roles),
+            missing=is_authenticated)
+        page_ids = [row['id'] for row in page]
+        users = members_info(agent, role_id, dict(
+            (user_id, member_roles[user_id]) for user_id in page_ids))
+        rows = []
+
+        for user_id in page_ids:
+            info = users[user_id]
+
+            if info.get('deleted') and not is_authenticated:
+                continue
+            row = dict((name, info.get(name)) for name in fields)
+            row['roles'] = sorted(info.get('roles') or [])
+            rows.append(row)
+
+        return datatables.render_json(
+            REQUEST, datatables.response(params, rows, total, filtered))
+
     security.declareProtected(view, 'edit_role_name')
 
     def edit_role_name(self, REQUEST):
@@ -1618,6 +1627,7 @@ class ExtendedManagementEditor(BrowserView):
 
                 for user_id in user_ids:
                     agent.remove_from_role(role_id, "user", user_id)
+                user_roles.invalidate(*user_ids)
 
         return export
 
@@ -1820,6 +1830,7 @@ class EditMembersOfOneRole(BrowserView):
 
             for user_id in removed_users:
                 agent.remove_from_role(role_id, 'user', user_id)
+        user_roles.invalidate(*(new_users | removed_users))
 
         if not (new_users or removed_users):
             msg = u"No changes."
@@ -1941,6 +1952,7 @@ class EditRolesOfOneMember(BrowserView):
 
             for role_id in new_roles:
                 agent.add_to_role(role_id, 'user', user_id)
+        user_roles.invalidate(user_id)
 
         if not (new_roles or removed_roles):
             msg = u"No changes."
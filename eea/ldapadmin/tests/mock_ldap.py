@@ -1,3 +1,4 @@
+import re
 from ldap import (SCOPE_BASE, SCOPE_ONELEVEL, SCOPE_SUBTREE,
                   NO_SUCH_OBJECT, ALREADY_EXISTS, NOT_ALLOWED_ON_NONLEAF,
                   NO_SUCH_ATTRIBUTE, OBJECT_CLASS_VIOLATION,
@@ -87,3 +88,19 @@ class MockConnection(object):
 
     def simple_bind_s(self, bind_dn, bind_pw):
         return (RES_BIND, [])
+
+
+def mock_users_search(agent, user_map):
+    """ Make the user searches of `logic_common.users_info` on a `Mock`
+    agent return the infos in `user_map` """
+
+    def search_s(base, scope, filterstr=None, attrlist=None):
+        uids = re.findall(r'\(uid=([^)]+)\)', filterstr)
+
+        return [('uid=%s,ou=Users' % uid, user_map[uid])
+                for uid in uids if uid in user_map]
+
+    agent._encoding = 'utf-8'
+    agent.conn.search_s.side_effect = search_s
+    agent._user_id.side_effect = lambda dn: dn.split(',')[0].split('=', 1)[1]
+    agent._unpack_user_info.side_effect = lambda dn, attrs: dict(attrs)
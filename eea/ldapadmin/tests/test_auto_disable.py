@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import ldap
+from mock import Mock, patch
+from eea.ldapadmin import auto_disable
+from eea.ldapadmin.ldapdump import DumpUser
+
+CONFIG = """
+ldap:
+    host: ldap.example.com
+    port: 636
+    dn: cn=dump
+    password: secret
+auto_disable:
+    admin_dn: cn=admin
+    admin_pw: admin
+"""
+
+
+def dump_user(uid, mail='x@example.com', status='', pending_disable=None):
+    return DumpUser('uid=%s,ou=Users,o=EIONET,l=Europe' % uid, uid,
+                    uid.title(), uid.title(), mail, status, pending_disable)
+
+
+class AutoDisableRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        with open(os.path.join(self.path, 'config.yaml'), 'w') as f:
+            f.write(CONFIG)
+        self.settings = auto_disable.read_config(self.path)
+        self.runner = auto_disable.OfflineDisabler(self.settings)
+        self.agent = Mock()
+        self.agent.conn.modify_s.return_value = (ldap.RES_MODIFY, [])
+        self.agent._user_dn.side_effect = lambda uid: uid
+        self.live = {'idle': {},
+                     'warned': {'employeeNumber': ['2020-01-01T00:00:00']}}
+        self.agent.conn.search_s.side_effect = (
+            lambda dn, scope, attrlist: [(dn, self.live[dn])])
+        self.runner.connect = Mock(return_value=self.agent)
+        self.runner.render = Mock(return_value=u'body')
+        self.runner.outbox = Mock()
+
+        users = [dump_user('idle'), dump_user('system', mail=None),
+                 dump_user('warned', pending_disable='2020-01-01T00:00:00')]
+        patcher = patch.object(auto_disable.ldapdump, 'load_users',
+                               return_value=users)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(auto_disable, 'login_statistics',
+                               return_value={'idle': '2017-01-01',
+                                             'system': '2017-01-01',
+                                             'warned': '2017-01-01'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_config(self):
+        self.assertEqual(self.settings['ldap_server'], 'ldap.example.com')
+        self.assertEqual(self.settings['admin_dn'], 'cn=admin')
+        self.assertTrue(self.settings['start_tls'])
+        self.assertEqual(self.settings['db_path'],
+                         os.path.join(self.path, 'ldap_eionet_europa_eu.db'))
+
+    def test_dry_run(self):
+        report = self.runner.run(dry_run=True, now=datetime(2020, 3, 2))
+
+        self.assertEqual(report.splitlines()[1:],
+                         ["predisable idle (last login 2017-01-01)",
+                          "disable warned (last login 2017-01-01)"])
+        self.assertFalse(self.runner.connect.called)
+        self.assertFalse(self.runner.outbox.put.called)
+
+    def test_run(self):
+        self.runner.run(now=datetime(2020, 3, 2))
+
+        (dn, mods), _ = self.agent.conn.modify_s.call_args
+        self.assertEqual(mods[0][1], 'employeeNumber')
+        self.agent.disable_user.assert_called_once_with('warned')
+        # the two users and the helpdesk report
+        self.assertEqual(self.runner.outbox.put.call_count, 3)
+        self.assertTrue(self.runner.outbox.flush.called)
+        self.assertTrue(self.agent.conn.unbind_s.called)
+
+    def test_stale_dump(self):
+        # idle was warned by the previous run, after the dump was made
+        self.live['idle'] = {'employeeNumber': ['2020-01-01T00:00:00']}
+
+        report = self.runner.run(now=datetime(2020, 3, 2))
+
+        self.assertEqual(report.splitlines()[1:],
+                         ["disable idle (last login 2017-01-01)",
+                          "disable warned (last login 2017-01-01)"])
+        self.assertFalse(self.agent.conn.modify_s.called)
+
+    def test_nothing_left_to_do(self):
+        # both were disabled by hand after the dump was made
+        self.live = {'idle': {'employeeType': ['disabled']},
+                     'warned': {'employeeType': ['disabled']}}
+
+        self.runner.run(now=datetime(2020, 3, 2))
+
+        self.assertFalse(self.agent.disable_user.called)
+        # no report on nothing
+        self.assertFalse(self.runner.outbox.put.called)
+
+    @patch.object(auto_disable, 'UsersDB')
+    def test_connect_with_tls(self, UsersDB):
+        agent = auto_disable.OfflineDisabler(self.settings).connect()
+
+        self.assertTrue(agent.conn.start_tls_s.called)
+        agent.perform_bind.assert_called_once_with('cn=admin', 'admin')
+
+
+class LoginStatisticsTest(unittest.TestCase):
+
+    @patch.object(auto_disable.requests, 'get')
+    def test_timeout(self, get):
+        auto_disable.login_statistics('http://stats.example.com')
+
+        get.assert_called_once_with('http://stats.example.com',
+                                    timeout=auto_disable.SERVICE_TIMEOUT)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from eea.ldapadmin.bulk_jobs import (DONE, FAILED, STALE_AFTER, JobRunner,
+                                     JobStore)
+
+
+class JobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = JobStore(os.path.join(self.tmp, 'jobs.db'))
+        self.users = [{'id': 'user%d' % i} for i in range(3)]
+        self.job_id = self.store.add_job(('', 'site', 'users'), 'admin',
+                                         zip([2, 4, 5], self.users),
+                                         ['Duplicate email'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_claim(self):
+        job, rows = self.store.claim(size=2, now=1000)
+
+        self.assertEqual(job, {'id': self.job_id, 'author': 'admin',
+                               'tool_path': ['', 'site', 'users']})
+        self.assertEqual(rows, [(2, self.users[0]), (4, self.users[1])])
+        self.assertEqual(self.store.claim(size=2, now=1000)[1],
+                         [(5, self.users[2])])
+        self.assertTrue(self.store.claim(now=1000) is None)
+
+    def test_stale_rows_claimed_again(self):
+        self.store.claim(now=1000)
+
+        self.assertTrue(self.store.claim(now=1000 + STALE_AFTER - 1) is None)
+        job, rows = self.store.claim(now=1000 + STALE_AFTER + 1)
+        self.assertEqual(len(rows), 3)
+
+    def test_renewed_rows_not_claimed_again(self):
+        self.store.claim(now=1000)
+        self.store.finish(self.job_id, 2, DONE)
+        self.store.renew(self.job_id, [4, 5], now=1000 + STALE_AFTER - 1)
+
+        self.assertTrue(self.store.claim(now=1000 + STALE_AFTER + 1) is None)
+
+    def test_progress(self):
+        self.store.claim(size=2)
+        self.store.finish(self.job_id, 2, DONE, 'user0 created')
+        self.store.finish(self.job_id, 4, FAILED, 'Error creating user1')
+
+        progress = self.store.progress(self.job_id)
+
+        self.assertEqual((progress['queued'], progress['running'],
+                          progress['done'], progress['failed']), (1, 0, 1, 1))
+        self.assertEqual(progress['errors'], ['Duplicate email'])
+        self.assertEqual(progress['messages'][1], {
+            'row': 4, 'status': FAILED, 'message': 'Error creating user1'})
+        self.assertFalse(progress['finished'])
+        self.assertTrue(self.store.progress(self.job_id + 1) is None)
+
+    def test_runner(self):
+        def processor(job, rows, report):
+            report(rows[0][0], DONE, 'created')
+            raise ValueError
+
+        runner = JobRunner(self.store, processor)
+
+        self.assertTrue(runner.run_once())
+        self.assertFalse(runner.run_once())
+        progress = self.store.progress(self.job_id)
+        self.assertEqual((progress['done'], progress['failed']), (1, 2))
+        self.assertTrue(progress['finished'])
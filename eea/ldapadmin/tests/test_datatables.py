@@ -0,0 +1,73 @@
+import unittest
+from eea.ldapadmin import datatables
+
+
+rows_fixture = [
+    {'id': 'anne', 'full_name': u"Anne Tester"},
+    {'id': 'jsmith', 'full_name': u"Joe Smith"},
+    {'id': 'ogunnar', 'full_name': u"\xd8ystein Gunnar"},
+]
+
+
+class DataTablesTest(unittest.TestCase):
+
+    def test_read_params(self):
+        params = datatables.read_params({
+            'draw': '2', 'start': '20', 'length': '-1',
+            'order[0][column]': '1', 'order[0][dir]': 'desc',
+            'search[value]': ' Smith ',
+            'columns[0][data]': 'id', 'columns[1][data]': 'full_name'})
+
+        self.assertEqual(params['draw'], 2)
+        self.assertEqual(params['start'], 20)
+        self.assertEqual(params['length'], datatables.MAX_PAGE_LENGTH)
+        self.assertEqual(params['sort_column'], 1)
+        self.assertTrue(params['sort_desc'])
+        self.assertEqual(params['search'], u'smith')
+        self.assertEqual(params['columns'], ['id', 'full_name'])
+        self.assertFalse(params['legacy'])
+
+    def test_legacy_protocol(self):
+        params = datatables.read_params({
+            'sEcho': '4', 'iDisplayStart': '1', 'iDisplayLength': '1',
+            'iSortCol_0': '0', 'sSortDir_0': 'asc', 'sSearch': ''})
+        result = datatables.page_rows(rows_fixture, ['id', 'full_name'],
+                                      params)
+
+        self.assertEqual(result, {'sEcho': 4, 'iTotalRecords': 3,
+                                  'iTotalDisplayRecords': 3,
+                                  'aaData': [rows_fixture[1]]})
+
+    def test_search_and_sort(self):
+        params = datatables.read_params({
+            'draw': '1', 'start': '0', 'length': '10',
+            'order[0][column]': '0', 'order[0][dir]': 'desc',
+            'search[value]': 'e', 'columns[0][data]': 'full_name'})
+        result = datatables.page_rows(rows_fixture, ['id', 'full_name'],
+                                      params)
+
+        self.assertEqual(result['recordsTotal'], 3)
+        self.assertEqual(result['recordsFiltered'], 3)
+        self.assertEqual([row['id'] for row in result['data']],
+                         ['ogunnar', 'jsmith', 'anne'])
+
+        params['search'] = u'\xf8y'
+        result = datatables.page_rows(rows_fixture, ['id', 'full_name'],
+                                      params)
+        self.assertEqual(result['data'], [rows_fixture[2]])
+
+    def test_page_sorted(self):
+        params = datatables.read_params({
+            'draw': '1', 'start': '0', 'length': '2',
+            'order[0][column]': '0', 'order[0][dir]': 'desc'})
+
+        self.assertEqual(datatables.page_sorted(rows_fixture, params),
+                         ([rows_fixture[2], rows_fixture[1]], 3))
+
+        params['search'] = u'smith'
+        self.assertEqual(
+            datatables.page_sorted(
+                rows_fixture, params,
+                lambda row, search: datatables.contains(
+                    search, row['id'], row['full_name'])),
+            ([rows_fixture[1]], 1))
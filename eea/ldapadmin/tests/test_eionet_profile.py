@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+from eea.ldapadmin.eionet_profile import CACHE_TTL, ProfileCache
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Answers /roles with the roles of the user, waits first on /slow and
+    fails on /broken """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(url.path)
+
+        if url.path == '/broken':
+            self.send_response(500)
+            self.end_headers()
+
+            return
+
+        if url.path == '/slow':
+            time.sleep(1)
+        userid = parse_qs(url.query)['userid'][0]
+        body = json.dumps({userid: [{'roles': ['Owner'], 'ob_url': 'url',
+                                     'ob_title': 'Folder'}]})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass    # the clients that timed out are gone
+
+
+class ProfileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        base = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.forum, self.cdr, self.projects = [
+            {'title': title, 'url': base + path, 'user': 'u',
+             'password': 'p', 'timeout': 0.3}
+            for title, path in [('Forum', '/roles'), ('CDR', '/slow'),
+                                ('Projects', '/broken')]]
+        self.cache = ProfileCache()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_answers(self):
+        forum = self.cache.answer(self.forum, 'anne')
+
+        self.assertEqual(forum['data']['anne'][0]['roles'], ['Owner'])
+        self.assertEqual(forum['error'], None)
+
+        # the slow service times out
+        started = time.time()
+        self.assertTrue(self.cache.answer(self.cdr, 'anne')['error'])
+        self.assertTrue(time.time() - started < 0.9)
+
+        projects = self.cache.answer(self.projects, 'anne')
+        self.assertEqual(projects['data'], {})
+        self.assertEqual(projects['error'], 'HTTP 500')
+
+    def test_cached_per_user(self):
+        self.cache.answer(self.forum, 'anne')
+        self.cache.answer(self.forum, 'anne')
+        self.cache.answer(self.forum, 'john')
+
+        self.assertEqual(self.server.requests, ['/roles', '/roles'])
+
+    def test_expired(self):
+        self.cache.answer(self.forum, 'anne', now=1000)
+        self.cache.answer(self.forum, 'anne', now=1000 + CACHE_TTL + 1)
+
+        self.assertEqual(self.server.requests, ['/roles', '/roles'])
+
+    def test_failures_not_cached(self):
+        self.cache.answer(self.cdr, 'anne')
+        self.cdr['timeout'] = 5
+        answer = self.cache.answer(self.cdr, 'anne')
+
+        self.assertEqual(answer['error'], None)
+        self.assertEqual(self.server.requests, ['/slow', '/slow'])
+
+    def test_error_answers_not_cached(self):
+        self.cache.answer(self.projects, 'anne')
+        self.cache.answer(self.projects, 'anne')
+
+        self.assertEqual(self.server.requests, ['/broken', '/broken'])
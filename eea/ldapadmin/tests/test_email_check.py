@@ -0,0 +1,50 @@
+import unittest
+
+import colander
+from mock import Mock
+from eea.ldapadmin import email_check
+
+
+class EmailCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = Mock()
+        self.agent.existing_emails.side_effect = (
+            lambda emails: [e for e in emails if e == 'taken@example.com'])
+        self.node = colander.SchemaNode(colander.String(),
+                                        validator=colander.Email())
+
+    def test_split_emails(self):
+        self.assertEqual(email_check.split_emails(
+            u' a@example.com,b@example.com\n\nc@example.com '),
+            [u'a@example.com', u'b@example.com', u'c@example.com'])
+        self.assertEqual(email_check.split_emails(None), [])
+
+    def test_find_duplicates(self):
+        self.assertEqual(email_check.find_duplicates(
+            ['A@example.com', 'b@example.com', 'a@EXAMPLE.com']),
+            (['A@example.com', 'b@example.com'], ['a@EXAMPLE.com']))
+
+    def test_repeated(self):
+        self.assertEqual(email_check.repeated(
+            ['A@example.com', 'b@example.com', 'a@example.com']),
+            {'a@example.com': 2})
+
+    def test_existing_in_chunks(self):
+        emails = ['user%d@example.com' % i for i in range(5)]
+        emails.append('taken@example.com')
+
+        self.assertEqual(email_check.existing(self.agent.existing_emails,
+                                              emails, chunk=2),
+                         ['taken@example.com'])
+        self.assertEqual(self.agent.existing_emails.call_count, 3)
+
+    def test_check_emails(self):
+        options = email_check.check_emails(
+            self.agent, ['Anne@example.com', 'not an email',
+                         'TAKEN@example.com', 'anne@example.com'], self.node)
+
+        self.assertEqual(options['valid'], ['anne@example.com'])
+        self.assertEqual(options['invalid'], ['not an email'])
+        self.assertEqual(options['taken'], ['taken@example.com'])
+        self.assertEqual(options['duplicates'], ['anne@example.com'])
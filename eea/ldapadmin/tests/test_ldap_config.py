@@ -0,0 +1,102 @@
+import unittest
+from mock import Mock, patch
+import ldap
+from eea.ldapadmin.ldap_config import (AgentPool, request_agent,
+                                      request_cache)
+
+
+class AgentPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+
+        def factory():
+            agent = Mock()
+            self.created.append(agent)
+
+            return agent
+        self.pool = AgentPool(factory, size=2, max_idle=60, check_interval=10)
+
+    def test_reuse_released_agent(self):
+        agent = self.pool.acquire()
+        self.pool.release(agent)
+
+        self.assertTrue(self.pool.acquire() is agent)
+        self.assertEqual(len(self.created), 1)
+
+    def test_overflow_agents_are_closed(self):
+        agents = [self.pool.acquire() for i in range(3)]
+        for agent in agents:
+            self.pool.release(agent)
+
+        self.assertEqual(len(self.created), 3)
+        agents[2].conn.unbind_s.assert_called_once_with()
+        self.assertFalse(agents[0].conn.unbind_s.called)
+
+    def test_author_is_reset_on_release(self):
+        agent = self.pool.acquire()
+        agent._author = 'john'
+        self.pool.release(agent)
+
+        self.assertFalse('_author' in vars(agent))
+
+    @patch('eea.ldapadmin.ldap_config.time')
+    def test_stale_agent_is_replaced(self, mock_time):
+        mock_time.time.return_value = 1000
+        agent = self.pool.acquire()
+        self.pool.release(agent)
+
+        mock_time.time.return_value = 1020
+        agent.conn.search_s.side_effect = ldap.SERVER_DOWN
+        new_agent = self.pool.acquire()
+
+        self.assertFalse(new_agent is agent)
+        agent.conn.unbind_s.assert_called_once_with()
+
+    @patch('eea.ldapadmin.ldap_config.time')
+    def test_idle_agents_are_evicted(self, mock_time):
+        mock_time.time.return_value = 1000
+        agent = self.pool.acquire()
+        self.pool.release(agent)
+
+        self.pool.evict_idle(now=1100)
+
+        agent.conn.unbind_s.assert_called_once_with()
+        mock_time.time.return_value = 1100
+        self.assertFalse(self.pool.acquire() is agent)
+
+
+class RequestAgentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tool = Mock()
+        self.tool.getPhysicalPath.return_value = ('', 'roles')
+        self.tool.REQUEST.other = {}
+        self.factory = Mock(side_effect=lambda bind, secondary: Mock())
+
+    def test_agent_reused_within_request(self):
+        agent = request_agent(self.tool, self.factory, True, False)
+
+        self.assertTrue(request_agent(self.tool, self.factory, True) is agent)
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_agents_keyed_by_bind_and_secondary(self):
+        bound = request_agent(self.tool, self.factory, True)
+        secondary = request_agent(self.tool, self.factory, True, True)
+
+        self.assertFalse(bound is secondary)
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_new_request_gets_new_agent(self):
+        agent = request_agent(self.tool, self.factory, True)
+        self.tool.REQUEST.other.clear()
+
+        self.assertFalse(request_agent(self.tool, self.factory, True) is agent)
+
+    def test_no_request(self):
+        del self.tool.REQUEST
+
+        self.assertTrue(request_cache(self.tool, 'agents') is None)
+        request_agent(self.tool, self.factory, True)
+        request_agent(self.tool, self.factory, True)
+        self.assertEqual(self.factory.call_count, 2)
@@ -0,0 +1,429 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date, datetime
+from ldap.controls import SimplePagedResultsControl
+from mock import Mock, patch
+from eea.ldapadmin.ldapdump import (DumpCache, apply_changes,
+                                    build_membership_events,
+                                    changelog_events, fetch_changes,
+                                    former_role_members,
+                                    former_role_members_from_dump, index_dump,
+                                    last_run, load_users, org_member_emails,
+                                    registration_stats, users_page)
+
+
+def changelog(*entries):
+    return json.dumps([
+        {'action': action, 'timestamp': timestamp, 'data': data}
+        for action, timestamp, data in entries])
+
+
+dump_fixture = [
+    ('uid=anne,ou=Users,o=EIONET,l=Europe', {
+        'registeredAddress': changelog(
+            ('ADDED_TO_ROLE', '2018-01-10T10:00:00+00:00', {'role': 'a'}),
+            ('REMOVED_FROM_ROLE', '2018-06-10T10:00:00+00:00',
+             {'role': 'a'}),
+        )}),
+    ('uid=jsmith,ou=Users,o=EIONET,l=Europe', {
+        'registeredAddress': changelog(
+            ('ADDED_TO_ROLE', '2018-01-10T10:00:00+00:00', {'role': 'a-b'}),
+            ('DISABLE_ACCOUNT', '2018-03-01T10:00:00+00:00',
+             {'roles': ['a-b', 'c']}),
+            ('EDITED_USER', '2018-03-02T10:00:00+00:00', {}),
+        )}),
+    ('uid=ghost,ou=Users,o=EIONET,l=Europe', {
+        'registeredAddress': "not json"}),
+]
+
+
+class ChangelogEventsTest(unittest.TestCase):
+
+    def test_events(self):
+        dn, attrs = dump_fixture[1]
+        events = list(changelog_events(dn, attrs['registeredAddress']))
+
+        self.assertEqual(events, [
+            ('jsmith', 'a-b', 'added', '2018-01-10'),
+            ('jsmith', 'a-b', 'removed', '2018-03-01'),
+            ('jsmith', 'c', 'removed', '2018-03-01'),
+        ])
+
+    def test_dates_in_cet(self):
+        events = list(changelog_events('uid=anne,ou=Users', changelog(
+            ('ADDED_TO_ROLE', '2018-01-10T23:30:00+00:00', {'role': 'a'}))))
+
+        self.assertEqual(events[0][3], '2018-01-11')
+
+    def test_invalid_changelog(self):
+        self.assertEqual(list(changelog_events('uid=ghost', "not json")), [])
+
+
+class FormerRoleMembersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, 'dump.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE ldapmapping (dn, attr, value)")
+        conn.executemany("INSERT INTO ldapmapping VALUES (?, ?, ?)", [
+            (dn, name, value) for dn, attrs in dump_fixture
+            for name, value in attrs.items()])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_no_events_table(self):
+        self.assertTrue(
+            former_role_members(['a'], date(2018, 2, 1), self.db_path) is None)
+
+    def test_former_members(self):
+        build_membership_events(self.db_path)
+
+        self.assertEqual(
+            former_role_members(['a', 'a-b'], date(2018, 2, 1), self.db_path),
+            {'anne': set(['a']), 'jsmith': set(['a-b'])})
+        self.assertEqual(
+            former_role_members(['a', 'a-b'], date(2018, 4, 1), self.db_path),
+            {'anne': set(['a'])})
+        self.assertEqual(
+            former_role_members(['a'], date(2017, 1, 1), self.db_path), {})
+
+    def test_same_result_from_dump(self):
+        build_membership_events(self.db_path)
+
+        for day in [date(2017, 1, 1), date(2018, 2, 1), date(2018, 4, 1)]:
+            self.assertEqual(
+                former_role_members(['a', 'a-b', 'c'], day, self.db_path),
+                former_role_members_from_dump(dump_fixture,
+                                              ['a', 'a-b', 'c'], day))
+
+
+class DumpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, 'dump.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE ldapmapping (dn, attr, value)")
+        conn.executemany("INSERT INTO ldapmapping VALUES (?, ?, ?)", [
+            ('uid=jsmith,ou=Users', 'cn', u'J\xf6rg Smith'),
+            ('uid=jsmith,ou=Users', 'uid', 'jsmith'),
+            ('uid=jsmith,ou=Users', 'mail', 'jsmith@example.com'),
+            ('cn=eionet,ou=Roles', 'cn', 'eionet'),
+            ('uid=anne,ou=Users', 'uid', 'anne'),
+            ('uid=anne,ou=Users', 'employeeType', 'disabled'),
+        ])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_load_users(self):
+        jsmith, anne = load_users(self.db_path)
+
+        self.assertEqual(jsmith.uid, 'jsmith')
+        self.assertEqual(jsmith.ascii_cn, 'Jorg Smith')
+        self.assertEqual(jsmith.status, 'enabled')
+        self.assertEqual(anne.status, 'disabled')
+        self.assertEqual(anne.mail, None)
+
+    def test_users_loaded_once(self):
+        loader = Mock(side_effect=load_users)
+        cache = DumpCache(loader)
+
+        users = cache.users(self.db_path)
+
+        self.assertTrue(cache.users(self.db_path) is users)
+        self.assertEqual(loader.call_count, 1)
+
+    def test_first_load_by_one_request(self):
+        def slow_load(db_path):
+            time.sleep(0.1)
+
+            return load_users(db_path)
+        loader = Mock(side_effect=slow_load)
+        cache = DumpCache(loader)
+        threads = [threading.Thread(target=cache.users, args=(self.db_path,))
+                   for i in range(5)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(loader.call_count, 1)
+
+    @patch('eea.ldapadmin.ldapdump.threading.Thread')
+    def test_reload_in_background(self, mock_thread):
+        cache = DumpCache()
+        users = cache.users(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO ldapmapping VALUES "
+                     "('uid=xavier,ou=Users', 'uid', 'xavier')")
+        conn.commit()
+        conn.close()
+
+        # the previous users are returned while the reload is running
+        self.assertTrue(cache.users(self.db_path) is users)
+        self.assertEqual(mock_thread.call_count, 1)
+
+        kwargs = mock_thread.call_args[1]
+        kwargs['target'](*kwargs['args'])
+        self.assertEqual([user.uid for user in cache.users(self.db_path)],
+                         ['jsmith', 'anne', 'xavier'])
+
+
+class IncrementalDumpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, 'dump.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE ldapmapping (dn, attr, value)")
+        conn.executemany("INSERT INTO ldapmapping VALUES (?, ?, ?)", [
+            (dn, name, value) for dn, attrs in dump_fixture
+            for name, value in attrs.items()])
+        conn.commit()
+        conn.close()
+        build_membership_events(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_fetch_changes(self):
+        def page(cookie):
+            return Mock(controlType=SimplePagedResultsControl.controlType,
+                        cookie=cookie)
+
+        conn = Mock()
+        conn.result3.side_effect = [
+            (None, [('uid=anne,ou=Users', {'cn': ['Anne'],
+                                           'mail': ['a@x.org'],
+                                           'jpegPhoto': ['\xff\xd8']})],
+             None, [page('')]),
+            (None, [('ou=Users', {}), ('uid=anne,ou=Users', {})], None,
+             [page('next')]),
+            (None, [('uid=jsmith,ou=Users', {})], None, [page('')]),
+        ]
+
+        changed, dns = fetch_changes(conn, ['ou=Users'],
+                                     datetime(2018, 1, 2, 3, 4, 5))
+
+        # the binary photo is left out
+        self.assertEqual(sorted(changed['uid=anne,ou=Users']),
+                         [('cn', 'Anne'), ('mail', 'a@x.org')])
+        # the DNs come in two pages
+        self.assertEqual(dns, set(['ou=Users', 'uid=anne,ou=Users',
+                                   'uid=jsmith,ou=Users']))
+        self.assertEqual(conn.search_ext.call_args_list[0][0][2],
+                         '(modifyTimestamp>=20180102030405Z)')
+        self.assertEqual(conn.search_ext.call_count, 3)
+
+    def test_changed_entry_keeps_operational_attrs(self):
+        anne_dn = dump_fixture[0][0]
+        entry = {'cn': ['Anne']}
+        operational = {'createTimestamp': ['20180110100000Z']}
+
+        def search_ext(root_dn, scope, filterstr, attrlist=None, **kwargs):
+            # like the server, the operational attributes only when asked
+            if attrlist == ['1.1']:
+                return [(anne_dn, {})]
+            attrs = dict(entry)
+
+            if '+' in (attrlist or []):
+                attrs.update(operational)
+
+            return [(anne_dn, attrs)]
+
+        conn = Mock()
+        conn.search_ext.side_effect = search_ext
+        conn.result3.side_effect = lambda results: (None, results, None, [])
+
+        changed, dns = fetch_changes(conn, ['ou=Users'],
+                                     datetime(2018, 1, 2, 3, 4, 5))
+        apply_changes(self.db_path, changed, dns,
+                      datetime(2018, 7, 1, 12, 0, 0))
+
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT attr, value FROM ldapmapping "
+                            "WHERE dn = ? ORDER BY attr",
+                            (anne_dn,)).fetchall()
+        conn.close()
+        self.assertEqual(rows, [('cn', 'Anne'),
+                                ('createTimestamp', '20180110100000Z')])
+
+    def test_apply_changes(self):
+        anne_dn, jsmith_dn = dump_fixture[0][0], dump_fixture[1][0]
+        changed = {anne_dn: [
+            ('cn', 'Anne'),
+            ('registeredAddress', changelog(
+                ('ADDED_TO_ROLE', '2018-01-10T10:00:00+00:00',
+                 {'role': 'a'}))),
+        ]}
+
+        apply_changes(self.db_path, changed, set([anne_dn, jsmith_dn]),
+                      datetime(2018, 7, 1, 12, 0, 0))
+
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT dn, attr FROM ldapmapping "
+                            "ORDER BY dn, attr").fetchall()
+        conn.close()
+        self.assertEqual(rows, [(anne_dn, 'cn'),
+                                (anne_dn, 'registeredAddress'),
+                                (jsmith_dn, 'registeredAddress')])
+        # anne was never removed from 'a' in the new changelog
+        self.assertEqual(
+            former_role_members(['a', 'a-b'], date(2018, 2, 1), self.db_path),
+            {'jsmith': set(['a-b'])})
+        self.assertEqual(last_run(self.db_path), datetime(2018, 7, 1, 12))
+
+    def test_no_last_run(self):
+        self.assertTrue(last_run(self.db_path) is None)
+        self.assertTrue(last_run(os.path.join(self.tmp, 'none.db')) is None)
+
+
+class RegistrationStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, 'dump.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE ldapmapping (dn, attr, value)")
+        conn.executemany("INSERT INTO ldapmapping VALUES (?, ?, ?)", [
+            ('uid=anne,ou=Users', 'createTimestamp', '20170105101010Z'),
+            ('uid=jsmith,ou=Users', 'createTimestamp', '20170120101010Z'),
+            ('uid=jsmith,ou=Users', 'employeeType', 'disabled'),
+            ('uid=xavier,ou=Users', 'createTimestamp', '20180301101010Z'),
+            ('cn=eionet,ou=Roles', 'createTimestamp', '20180301101010Z'),
+        ])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_no_stats_table(self):
+        self.assertTrue(registration_stats(self.db_path) is None)
+
+    def test_stats(self):
+        index_dump(self.db_path)
+
+        stats = registration_stats(self.db_path)
+
+        self.assertEqual(stats['yearly'], {2017: 2, 2018: 1})
+        self.assertEqual(stats['monthly'], {(2017, 1): 2, (2018, 3): 1})
+        self.assertEqual(stats['by_status'], {
+            2017: {'enabled': 1, 'disabled': 1},
+            2018: {'enabled': 1, 'disabled': 0}})
+
+
+class OrgMemberEmailsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, 'dump.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE ldapmapping (dn, attr, value)")
+        conn.executemany("INSERT INTO ldapmapping VALUES (?, ?, ?)", [
+            ('uid=anne,ou=Users', 'mail', 'anne@example.com'),
+            ('uid=anne,ou=Users', 'o', 'eu_eea'),
+            ('uid=jsmith,ou=Users', 'mail', 'jsmith@example.com'),
+            ('uid=jsmith,ou=Users', 'o', ''),
+            ('uid=xavier,ou=Users', 'mail', 'anne@example.com'),
+            ('uid=xavier,ou=Users', 'o', 'dk_ministry'),
+            ('uid=bob,ou=Users', 'o', 'dk_ministry'),
+            ('uid=carl,ou=Users', 'o', 'dk_ministry'),
+            ('uid=carl,ou=Users', 'mail', 'carl@example.com'),
+            ('cn=eionet,ou=Roles', 'mail', 'eionet@example.com'),
+            ('cn=eionet,ou=Roles', 'o', 'eu_eea'),
+        ])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_members_once(self):
+        self.assertEqual(list(org_member_emails(self.db_path)),
+                         ['anne@example.com', 'carl@example.com'])
+
+
+class UsersPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, 'dump.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE ldapmapping (dn, attr, value)")
+        conn.executemany("INSERT INTO ldapmapping VALUES (?, ?, ?)", [
+            (dn, attr, value)
+            for dn, attrs in [
+                ('uid=anne,ou=Users', {'uid': 'anne', 'cn': u'Anne Tester',
+                                       'mail': 'anne@example.com',
+                                       'o': 'EEA'}),
+                ('uid=jsmith,ou=Users', {'uid': 'jsmith', 'cn': u'Joe Smith',
+                                         'mail': 'joe_smith@example.com',
+                                         'employeeType': 'disabled'}),
+                ('uid=ogunnar,ou=Users', {'uid': 'ogunnar',
+                                          'cn': u'\xd8ystein Gunnar',
+                                          'mail': 'og@example.com',
+                                          'telephoneNumber': '+45 555'}),
+            ]
+            for attr, value in attrs.items()])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_page(self):
+        users, total, filtered = users_page(
+            sort='email', sort_desc=True, start=1, length=1,
+            db_path=self.db_path)
+
+        self.assertEqual((total, filtered), (3, 3))
+        self.assertEqual(users, [{'id': 'jsmith', 'full_name': u'Joe Smith',
+                                  'email': 'joe_smith@example.com',
+                                  'organisation': None,
+                                  'status': 'disabled'}])
+
+    def test_search(self):
+        users, total, filtered = users_page(search='_smith',
+                                            db_path=self.db_path)
+        self.assertEqual([user['id'] for user in users], ['jsmith'])
+        self.assertEqual((total, filtered), (3, 1))
+
+        users, _, _ = users_page(search='example', search_columns=['id'],
+                                 db_path=self.db_path)
+        self.assertEqual(users, [])
+
+        users, _, _ = users_page(name='555', lookup=['telephoneNumber'],
+                                 db_path=self.db_path)
+        self.assertEqual([user['id'] for user in users], ['ogunnar'])
+
+    def test_members(self):
+        members = {'jsmith': 'uid=jsmith,ou=Users',
+                   'anne': 'uid=anne,ou=Users',
+                   'new': 'uid=new,ou=Users'}
+
+        users, total, _ = users_page(sort='id', members=members,
+                                     db_path=self.db_path)
+        self.assertEqual([user['id'] for user in users],
+                         ['anne', 'jsmith', 'new'])
+        self.assertEqual(total, 3)
+        self.assertEqual(users[2]['full_name'], None)
+
+        users, _, _ = users_page(sort='id', members=members, missing=False,
+                                 disabled=False, db_path=self.db_path)
+        self.assertEqual([user['id'] for user in users], ['anne'])
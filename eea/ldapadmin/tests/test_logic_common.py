@@ -0,0 +1,94 @@
+import unittest
+from mock import Mock
+from eea.ldapadmin.logic_common import (orgs_of_users, orgs_with_members,
+                                        users_info)
+from eea.ldapadmin.tests.mock_ldap import mock_users_search
+
+
+class UsersInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = Mock()
+        self.users = {
+            'anne': {'id': 'anne', 'first_name': "Anne"},
+            'jsmith': {'id': 'jsmith', 'first_name': "Joe"},
+            'xavier': {'id': 'xavier', 'first_name': "Xavier"},
+        }
+        mock_users_search(self.agent, self.users)
+
+    def test_missing_users_left_out(self):
+        found = users_info(self.agent, ['jsmith', 'ghost', 'anne'])
+
+        self.assertEqual(found, {'jsmith': self.users['jsmith'],
+                                 'anne': self.users['anne']})
+        self.assertFalse(self.agent.user_info.called)
+
+    def test_one_search_per_chunk(self):
+        found = users_info(self.agent, ['xavier', 'anne', 'jsmith', 'anne'],
+                           chunk_size=2)
+
+        self.assertEqual(sorted(found), ['anne', 'jsmith', 'xavier'])
+        self.assertEqual(self.agent.conn.search_s.call_count, 2)
+
+    def test_filter_is_escaped(self):
+        users_info(self.agent, ['a*)(uid=b'])
+
+        filterstr = self.agent.conn.search_s.call_args[1]['filterstr']
+        self.assertTrue('(uid=a\\2a\\29\\28uid=b)' in filterstr)
+
+    def test_no_users(self):
+        self.assertEqual(users_info(self.agent, []), {})
+        self.assertFalse(self.agent.conn.search_s.called)
+
+
+class OrgsWithMembersTest(unittest.TestCase):
+
+    def test_one_search(self):
+        agent = Mock()
+        agent.conn.search_s.return_value = [
+            ('cn=dk_agency,ou=Organisations', {
+                'cn': ['dk_agency'],
+                'uniqueMember': ['', 'uid=anne,ou=Users',
+                                 'uid=jsmith,ou=Users']}),
+            ('cn=eu_eea,ou=Organisations', {'cn': ['eu_eea']}),
+        ]
+        agent._org_id.side_effect = (
+            lambda dn: dn.split(',')[0].split('=', 1)[1])
+        agent._user_id.side_effect = (
+            lambda dn: dn.split(',')[0].split('=', 1)[1])
+        agent._unpack_org_info.side_effect = (
+            lambda dn, attrs: {'id': attrs['cn'][0]})
+
+        orgs = orgs_with_members(agent)
+
+        self.assertEqual(orgs, {
+            'dk_agency': ({'id': 'dk_agency'}, ['anne', 'jsmith']),
+            'eu_eea': ({'id': 'eu_eea'}, []),
+        })
+        self.assertEqual(agent.conn.search_s.call_count, 1)
+        self.assertFalse(agent.members_in_org.called)
+
+
+class OrgsOfUsersTest(unittest.TestCase):
+
+    def test_one_search_per_chunk(self):
+        agent = Mock()
+        agent._encoding = 'utf-8'
+        agent._user_dn.side_effect = (
+            lambda user_id: 'uid=%s,ou=Users' % user_id)
+        agent._org_id.side_effect = (
+            lambda dn: dn.split(',')[0].split('=', 1)[1])
+        agent.conn.search_s.return_value = [
+            ('cn=eu_eea,ou=Organisations', {
+                'uniqueMember': ['uid=Anne,ou=Users', 'uid=other,ou=Users']}),
+            ('cn=dk_agency,ou=Organisations', {
+                'uniqueMember': ['', 'uid=anne,ou=Users']}),
+        ]
+
+        user_orgs = orgs_of_users(agent, ['anne', 'jsmith'], chunk_size=2)
+
+        self.assertEqual(user_orgs, {'anne': ['dk_agency', 'eu_eea']})
+        self.assertEqual(agent.conn.search_s.call_count, 1)
+        filterstr = agent.conn.search_s.call_args[1]['filterstr']
+        self.assertTrue('(uniqueMember=uid=anne,ou=users)' in filterstr)
+        self.assertTrue('(uniqueMember=uid=jsmith,ou=users)' in filterstr)
@@ -0,0 +1,119 @@
+import asyncore
+import os
+import shutil
+import smtpd
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from email.mime.text import MIMEText
+
+import transaction
+from mock import Mock, patch
+from zope.sendmail.queue import MAX_SEND_TIME
+
+from eea.ldapadmin import mail_outbox
+from eea.ldapadmin.mail_outbox import MaildirOutbox
+
+
+class StandInSMTPServer(smtpd.SMTPServer):
+    """ Collects the messages it receives """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((mailfrom, rcpttos, data))
+
+
+def message(addr_to):
+    message = MIMEText('Hello')
+    message['From'] = 'no-reply@example.com'
+    message['To'] = addr_to
+    message['Subject'] = 'Test'
+
+    return message
+
+
+class MaildirOutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'outbox')
+        self.server = StandInSMTPServer()
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.1})
+        self.thread.start()
+        self.smtp = {'host': '127.0.0.1',
+                     'port': self.server.socket.getsockname()[1]}
+
+    def tearDown(self):
+        transaction.abort()
+        self.server.close()
+        self.thread.join()
+        shutil.rmtree(self.tmp)
+
+    def put(self, outbox, addr_to):
+        outbox.put('no-reply@example.com', [addr_to],
+                   message(addr_to).as_string())
+
+    def test_sent_after_commit(self):
+        outbox = MaildirOutbox(self.path, self.smtp)
+        for addr_to in ['anne@example.com', 'john@example.com']:
+            self.put(outbox, addr_to)
+        outbox.flush()
+        self.assertEqual(self.server.received, [])
+
+        transaction.commit()
+        outbox.flush()
+
+        self.assertEqual(sorted(rcpttos for _, rcpttos, _
+                                in self.server.received),
+                         [['anne@example.com'], ['john@example.com']])
+
+    def test_dropped_on_abort(self):
+        outbox = MaildirOutbox(self.path, self.smtp)
+        self.put(outbox, 'anne@example.com')
+
+        transaction.abort()
+        outbox.flush()
+
+        self.assertEqual(self.server.received, [])
+
+    def test_kept_until_sent(self):
+        # nothing listens on port 1
+        outbox = MaildirOutbox(self.path, dict(self.smtp, port=1))
+        self.put(outbox, 'anne@example.com')
+        transaction.commit()
+        outbox.flush()
+        self.assertEqual(self.server.received, [])
+
+        # the next run, hours later, with the server back
+        for folder, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.startswith('.sending-'):
+                    then = time.time() - MAX_SEND_TIME - 1
+                    os.utime(os.path.join(folder, filename), (then, then))
+        MaildirOutbox(self.path, self.smtp).flush()
+
+        self.assertEqual([rcpttos for _, rcpttos, _ in self.server.received],
+                         [['anne@example.com']])
+
+
+class SendEmailTest(unittest.TestCase):
+
+    @patch.dict(sys.modules, {'plone': None})
+    @patch('eea.ldapadmin.mail_outbox.getUtility')
+    def test_site_delivery(self, getUtility):
+        delivery = getUtility.return_value = Mock()
+
+        mail_outbox.send_email('no-reply@example.com', 'anne@example.com',
+                               message('anne@example.com'))
+
+        self.assertEqual(getUtility.call_args[1],
+                         {'name': 'naaya-mail-delivery'})
+        addr_from, addrs_to, text = delivery.send.call_args[0]
+        self.assertEqual(addrs_to, ['anne@example.com'])
+        self.assertTrue('Subject: Test' in text)
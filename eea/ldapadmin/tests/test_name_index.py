@@ -0,0 +1,36 @@
+import unittest
+import jellyfish
+from eea.ldapadmin.name_index import NameIndex
+
+NAMES = ["John Smith", "Jon Smith", "John Smyth", "Jane Smith", "Joan Smit",
+         "Anne Andersen", "Ana Anderson", "Anna Andersen", "Mihai Popescu",
+         "Mihaela Popesku", "Lars Larsen", "Laura Larson", "Peter Muller",
+         "Pieter Mueller", "Petra Moller", "Sven Jensen", "Svein Hansen",
+         "x", ""]
+
+
+class NameIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [('uid=user%d,ou=Users' % i, name)
+                        for i, name in enumerate(NAMES)]
+
+    def scan(self, name, threshold):
+        return [dn for dn, other_name in self.records
+                if jellyfish.jaro_winkler(name, other_name) >= threshold]
+
+    def test_same_as_full_scan(self):
+        for threshold in (0.939999, 0.9, 0.8, 0.5):
+            index = NameIndex(self.records, threshold)
+
+            for name in NAMES + ["Jonh Smith", "Lars Muller", "Popescu"]:
+                self.assertEqual(index.similar(name),
+                                 self.scan(name, threshold))
+
+    def test_few_candidates_scored(self):
+        index = NameIndex(self.records, 0.939999)
+
+        candidates = index.candidates("John Smith")
+
+        self.assertTrue(0 in candidates)
+        self.assertTrue(len(candidates) < len(self.records) / 2)
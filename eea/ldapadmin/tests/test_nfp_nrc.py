@@ -0,0 +1,86 @@
+import unittest
+
+from mock import Mock, patch
+from eea.ldapadmin import nfp_nrc
+
+USER_SUFFIX = 'ou=Users,o=EIONET,l=Europe'
+ORG_SUFFIX = 'ou=Organisations,o=EIONET,l=Europe'
+
+
+def user_dn(user_id):
+    return 'uid=%s,%s' % (user_id, USER_SUFFIX)
+
+
+def role_dn(role_id):
+    return ('cn=%s,cn=eionet-nrc,cn=eionet,ou=Roles,o=EIONET,l=Europe' %
+            role_id)
+
+
+class CountryRolesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = Mock()
+        self.agent._user_dn_suffix = USER_SUFFIX
+        self.agent._org_dn_suffix = ORG_SUFFIX
+        self.agent._user_id = lambda dn: dn.split(',')[0].split('=')[1]
+        self.agent._org_id = self.agent._user_id
+        self.agent._role_id = self.agent._user_id
+        self.agent.conn.search_s.return_value = [
+            (role_dn('eionet-nrc-water-mc-dk'), {
+                'description': ['Water'],
+                'uniqueMember': [user_dn('anne'), user_dn('gone'),
+                                 'o=dk_agency,' + ORG_SUFFIX],
+                'leaderMember': [user_dn('anne')],
+            }),
+            (role_dn('eionet-nrc-air-mc-dk'), {
+                'description': ['Air'],
+                'uniqueMember': [user_dn('anne'), ''],
+            }),
+            (role_dn('eionet-nrc-air'), {'description': ['Air']}),
+        ]
+        self.orgs = {'dk_agency': {'name': u"Agency", 'country': 'dk'}}
+        self.dk_agency = dict(self.orgs['dk_agency'], id='dk_agency')
+
+    @patch('eea.ldapadmin.nfp_nrc.orgs_of_users')
+    @patch('eea.ldapadmin.nfp_nrc.users_info')
+    def test_roles_with_members(self, users_info, orgs_of_users):
+        users_info.return_value = {
+            'anne': {'id': 'anne', 'createTimestamp': 'x',
+                     'modifyTimestamp': 'x'}}
+        orgs_of_users.return_value = {'anne': ['gone_org', 'dk_agency']}
+
+        roles = nfp_nrc.country_roles(self.agent, 'dk')
+        listed = list(nfp_nrc.roles_with_members(self.agent, roles,
+                                                 self.orgs))
+
+        self.assertEqual(self.agent.conn.search_s.call_count, 1)
+        self.assertEqual(users_info.call_count, 1)
+        self.assertEqual(orgs_of_users.call_count, 1)
+        self.assertEqual(sorted(users_info.call_args[0][1]), ['anne', 'gone'])
+        self.assertEqual([role['role_id'] for role in listed],
+                         ['eionet-nrc-air-mc-dk', 'eionet-nrc-water-mc-dk'])
+        water = listed[1]
+        self.assertEqual(water['users'], [
+            {'id': 'anne', 'ldap_org': self.dk_agency}])
+        self.assertEqual(water['orgs'], [self.dk_agency])
+        self.assertEqual(water['leaders'], ['anne'])
+        self.assertEqual(water['naming']['leader']['short'], 'PCP')
+        self.assertEqual(listed[0]['orgs'], [])
+
+    def test_national_org(self):
+        orgs = dict(self.orgs, eu_eea={'name': u"EEA", 'country': 'eu'})
+
+        with patch('eea.ldapadmin.nfp_nrc.orgs_of_users') as orgs_of_users:
+            orgs_of_users.return_value = {'anne': ['eu_eea', 'dk_agency'],
+                                          'john': []}
+            by_user = nfp_nrc.national_orgs(self.agent, ['anne', 'john'],
+                                            orgs)
+
+        self.assertEqual(nfp_nrc.national_org(by_user, 'anne',
+                                              'eionet-nrc-air-mc-dk'),
+                         self.dk_agency)
+        self.assertEqual(nfp_nrc.national_org(by_user, 'anne',
+                                              'reportnet-awp-x-reporter-eea'),
+                         dict(orgs['eu_eea'], id='eu_eea'))
+        self.assertEqual(nfp_nrc.national_org(by_user, 'john',
+                                              'eionet-nrc-air-mc-dk'), None)
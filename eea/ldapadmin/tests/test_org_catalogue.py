@@ -0,0 +1,101 @@
+import threading
+import time
+import unittest
+
+import ldap
+from mock import Mock
+from eea.ldapadmin.org_catalogue import OrgCatalogue
+
+
+class OrgCatalogueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = Mock()
+        self.agent.all_organisations.return_value = {
+            'dk_ministry': {'name': "Ministry", 'country': 'dk'},
+            'dk_agency': {'name': "Agency", 'country': 'dk'},
+            'eu_eea': {'name': "EEA", 'country': 'eu'},
+        }
+        self.tool = Mock()
+        self.tool._config = {'ldap_server': 'ldap.example.com'}
+        self.tool._get_ldap_agent.return_value = self.agent
+        self.catalogue = OrgCatalogue(ttl=60)
+
+    def test_by_country(self):
+        self.assertEqual(sorted(self.catalogue.orgs_in_countries(
+            self.tool, ['dk'])), ['dk_agency', 'dk_ministry'])
+        self.assertEqual(sorted(self.catalogue.orgs_in_countries(
+            self.tool, ['eu', 'int'])), ['eu_eea'])
+        self.assertEqual(len(self.catalogue.all_organisations(self.tool)), 3)
+        self.assertEqual(self.agent.all_organisations.call_count, 1)
+
+    def test_sorted_orgs(self):
+        countries = {'dk': {'name': "Denmark"}, 'eu': {'name': "Europe"}}
+        by_name = self.catalogue.sorted_orgs(self.tool, countries)
+
+        self.assertEqual([org_id for org_id, _ in by_name],
+                         ['dk_agency', 'eu_eea', 'dk_ministry'])
+        self.assertEqual(
+            [org_id for org_id, _ in self.catalogue.sorted_orgs(
+                self.tool, countries, 'country')],
+            ['dk_agency', 'dk_ministry', 'eu_eea'])
+        # sorted once
+        self.assertTrue(
+            self.catalogue.sorted_orgs(self.tool, countries) is by_name)
+
+    def test_invalidate(self):
+        self.catalogue.all_organisations(self.tool)
+        self.catalogue.invalidate(self.tool)
+        self.catalogue.all_organisations(self.tool)
+
+        self.assertEqual(self.agent.all_organisations.call_count, 2)
+
+    def test_expired(self):
+        self.catalogue._entry(self.tool, now=1000)
+        self.catalogue._entry(self.tool, now=1059)
+        self.catalogue._entry(self.tool, now=1061)
+
+        self.assertEqual(self.agent.all_organisations.call_count, 2)
+
+    def test_size_limit(self):
+        secondary_agent = Mock()
+        secondary_agent.all_organisations.return_value = {}
+        self.agent.all_organisations.side_effect = ldap.SIZELIMIT_EXCEEDED
+        self.tool._get_ldap_agent.side_effect = (
+            lambda bind=True, secondary=False:
+            secondary_agent if secondary else self.agent)
+
+        self.assertEqual(self.catalogue.all_organisations(self.tool), {})
+
+    def test_read_once_by_concurrent_requests(self):
+        orgs = self.agent.all_organisations.return_value
+
+        def read_orgs():
+            time.sleep(0.1)
+
+            return orgs
+        self.agent.all_organisations.side_effect = read_orgs
+        threads = [threading.Thread(target=self.catalogue.all_organisations,
+                                    args=(self.tool,))
+                   for i in range(5)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.agent.all_organisations.call_count, 1)
+
+    def test_invalidated_while_reading(self):
+        orgs = self.agent.all_organisations.return_value
+
+        def read_orgs():
+            self.catalogue.invalidate(self.tool)
+
+            return orgs
+        self.agent.all_organisations.side_effect = read_orgs
+        self.catalogue.all_organisations(self.tool)
+        self.catalogue.all_organisations(self.tool)
+
+        self.assertEqual(self.agent.all_organisations.call_count, 2)
@@ -1,3 +1,4 @@
+import json
 import unittest
 import logging
 from StringIO import StringIO
@@ -5,8 +6,10 @@ from lxml.html.soupparser import fromstring
 from mock import Mock, patch
 from eea.ldapadmin.orgs_editor import OrganisationsEditor, CommonTemplateLogic
 from eea.ldapadmin.orgs_editor import validate_org_info, VALIDATION_ERRORS
+from eea.ldapadmin.org_catalogue import catalogue
 from eea.ldapadmin.ui_common import TemplateRenderer
 from eea import usersdb
+from eea.ldapadmin.tests.mock_ldap import mock_users_search
 
 org_info_fixture = {
     'name': u"Ye olde bridge club",
@@ -58,6 +61,7 @@ def session_messages(request):
 class OrganisationsUITest(unittest.TestCase):
     def setUp(self):
         self.ui = StubbedOrganisationsEditor('organisations')
+        catalogue.clear()
         self.mock_agent = Mock()
         self.mock_agent.all_organisations.return_value = {}
         self.ui._get_ldap_agent = Mock(return_value=self.mock_agent)
@@ -229,21 +233,32 @@ class OrganisationsUITest(unittest.TestCase):
         org_info = dict(org_info_fixture, id='bridge_club')
         self._verify_org_form_submit_error(page, org_info, errors)
 
-    def test_list_organisations(self):
+    @patch('eea.ldapadmin.orgs_editor.get_country_options')
+    def test_list_organisations(self, mock_country_options):
+        mock_country_options.return_value = [
+            ('ro', {'name': "Romania", 'pub_code': 'RO'})]
+        self.ui.nfp_for_country = Mock(return_value=None)
         self.mock_agent.all_organisations.return_value = {
-            'bridge_club': "Bridge club",
-            'poker_club': u"P\xf8ker club",
+            'bridge_club': {'name': "Bridge club", 'country': 'ro'},
+            'poker_club': {'name': u"P\xf8ker club", 'country': 'ro'},
+            'chess_club': {'name': "Chess club", 'country': 'xx'},
         }
+        self.request.form = {'draw': '3', 'start': '0', 'length': '10',
+                             'order[0][column]': '1', 'order[0][dir]': 'desc'}
 
-        page = parse_html(self.ui.index_html(self.request))
+        result = json.loads(self.ui.organisations_datatable(self.request))
+
+        self.assertEqual(result['draw'], 3)
+        self.assertEqual(result['recordsTotal'], 2)
+        self.assertEqual([org['name'] for org in result['data']],
+                         [u"P\xf8ker club", "Bridge club"])
+        self.assertEqual(result['data'][0]['country_pub_code'], 'RO')
+
+        self.request.form['search[value]'] = 'bridge'
+        result = json.loads(self.ui.organisations_datatable(self.request))
 
-        orgs_ul = page.xpath('//ul[@class="organisations"]')[0]
-        org_0 = orgs_ul.xpath('li')[0]
-        org_1 = orgs_ul.xpath('li')[1]
-        self.assertTrue("Bridge club" in org_0.text_content())
-        self.assertTrue(u"P\xf8ker club" in org_1.text_content())
-        self.assertEqual(org_0.xpath('a')[0].attrib['href'],
-                         'URL/organisation?id=bridge_club')
+        self.assertEqual(result['recordsFiltered'], 1)
+        self.assertEqual(result['data'][0]['id'], 'bridge_club')
 
     def test_org_info_page(self):
         self.request.form = {'id': 'bridge_club'}
@@ -366,6 +381,7 @@ class OrganisationsUITest(unittest.TestCase):
 class OrganisationsUIMembersTest(unittest.TestCase):
     def setUp(self):
         self.ui = StubbedOrganisationsEditor('organisations')
+        catalogue.clear()
         self.mock_agent = Mock()
         self.ui._get_ldap_agent = Mock(return_value=self.mock_agent)
         self.request = mock_request()
@@ -381,6 +397,7 @@ class OrganisationsUIMembersTest(unittest.TestCase):
         }
         self.mock_agent.members_in_org.return_value = sorted(user_list.keys())
         self.mock_agent.user_info.side_effect = user_list.get
+        mock_users_search(self.mock_agent, user_list)
         self.mock_agent.org_info.return_value = dict(org_info_fixture,
                                                      id='bridge_club')
 
@@ -402,22 +419,39 @@ class OrganisationsUIMembersTest(unittest.TestCase):
 
         page = parse_html(self.ui.members_html(self.request))
 
-        self.mock_agent.members_in_org.assert_called_once_with('bridge_club')
-        self.mock_agent.user_info.assert_called_with('jsmith')
-
+        self.assertFalse(self.mock_agent.members_in_org.called)
         form = page.xpath('//form')[0]
         self.assertEqual(form.attrib['action'],
                          'URL/remove_members')
         self.assertEqual(form.xpath('.//input[@name="id"]')[0].attrib['value'],
                          'bridge_club')
+        table = form.xpath('.//table')[0]
+        self.assertEqual(table.attrib['data-source'],
+                         'URL/members_datatable?id=bridge_club')
 
-        members_li = page.xpath('.//ul[@class="organisation-members"]/li')
-        self.assertTrue("Anne Tester" in members_li[0].text_content())
-        self.assertTrue("Joe Smith" in members_li[1].text_content())
+    @patch('eea.ldapadmin.orgs_editor.ldapdump.users_page')
+    def test_members_datatable(self, users_page):
+        self.mock_agent._user_dn.side_effect = (
+            lambda user_id: 'uid=%s,ou=Users' % user_id)
+        users_page.return_value = ([{'id': 'jsmith'}, {'id': 'gone'}], 3, 2)
+        self.request.form = {'id': 'bridge_club', 'draw': '1', 'start': '0',
+                             'length': '10', 'disabled': 'include_disabled'}
 
-        anne_checkbox = members_li[0].xpath('.//input')[0]
-        self.assertEqual(anne_checkbox.attrib['name'], 'user_id:list')
-        self.assertEqual(anne_checkbox.attrib['value'], 'anne')
+        result = json.loads(self.ui.members_datatable(self.request))
+
+        self.mock_agent.members_in_org.assert_called_once_with('bridge_club')
+        kwargs = users_page.call_args[1]
+        self.assertEqual(kwargs['members'],
+                         {'anne': 'uid=anne,ou=Users',
+                          'jsmith': 'uid=jsmith,ou=Users'})
+        self.assertTrue(kwargs['disabled'] is None)
+        self.assertEqual((result['recordsTotal'], result['recordsFiltered']),
+                         (3, 2))
+        self.assertEqual([(row['id'], row['first_name'])
+                          for row in result['data']],
+                         [('jsmith', "Joe"), ('gone', 'Former')])
+        # only the users of the page are read
+        self.assertEqual(self.mock_agent.conn.search_s.call_count, 1)
 
     @patch('eea.ldapadmin.orgs_editor.logged_in_user')
     def test_remove_members_submit(self, logged_user):
@@ -482,6 +516,32 @@ class OrganisationsUIMembersTest(unittest.TestCase):
         self.assertEqual(page.xpath('//div[@class="system-msg"]')[0].text,
                          'Added 1 members to organisation "bridge_club".')
 
+    @patch('eea.ldapadmin.orgs_editor.users_info')
+    @patch('eea.ldapadmin.orgs_editor.orgs_with_members')
+    def test_demo_members_csv(self, orgs_with_members, users_info):
+        orgs_with_members.return_value = {
+            'bridge_club': ({'name': u"Bridge club", 'country': u"dk"},
+                            ['anne', 'jsmith']),
+            'chess_club': ({'name': u"Chess club", 'country': u"dk"}, []),
+        }
+        users_info.return_value = dict(
+            (user_id, {'id': user_id, 'full_name': name,
+                       'email': user_id + u'@example.com'})
+            for user_id, name in [('anne', u"Anne Tester"),
+                                  ('jsmith', u"Joe Smith")])
+        self.request.form = {'format': 'csv'}
+
+        self.assertEqual(self.ui.demo_members(self.request), '')
+
+        self.assertEqual(users_info.call_count, 1)
+        written = ''.join(call[0][0] for call in
+                          self.request.RESPONSE.write.call_args_list)
+        self.assertEqual(written.splitlines()[1:], [
+            'bridge_club,Bridge club,anne,Anne Tester,anne@example.com',
+            ',,jsmith,Joe Smith,jsmith@example.com',
+            'chess_club,Chess club,NO MEMEBRS,,',
+        ])
+
 
 class OrganisationsValidationTest(unittest.TestCase):
     def _test_bad_values(self, name, values, msg):
@@ -1,8 +1,6 @@
 import unittest
 import re
 from datetime import datetime, timedelta
-from zope.component import getGlobalSiteManager
-from zope.sendmail.interfaces import IMailDelivery
 from mock import Mock, patch
 from webob import Response
 from webob.exc import HTTPNotFound, HTTPSeeOther
@@ -103,11 +101,11 @@ class BrowseTest(unittest.TestCase):
         self.mock_agent.search_user_by_email.side_effect = filter_users
 
         self.mail = []
-        self.mail_delivery = Mock()
-        self.mail_delivery.send = lambda afrom, ato, msg: self.mail.append(msg)
-
-        gsm = getGlobalSiteManager()
-        gsm.registerUtility(self.mail_delivery, IMailDelivery, "Mail")
+        self.send_patch = patch('eea.ldapadmin.pwreset_tool.mail_outbox.'
+                                'send_email')
+        send_email = self.send_patch.start()
+        send_email.side_effect = (
+            lambda afrom, ato, msg: self.mail.append(msg.as_string()))
 
         app = WsgiApp(self.ui)
 
@@ -119,8 +117,7 @@ class BrowseTest(unittest.TestCase):
         import wsgi_intercept
         wsgi_intercept.remove_wsgi_intercept('test', 80)
 
-        gsm = getGlobalSiteManager()
-        gsm.unregisterUtility(self.mail_delivery, IMailDelivery, "Mail")
+        self.send_patch.stop()
 
     def test_welcome_page(self):
         br = self.browser
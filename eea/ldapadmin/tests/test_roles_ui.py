@@ -4,6 +4,7 @@ import re
 import logging
 from copy import deepcopy
 import csv
+import json
 from StringIO import StringIO
 from mock import Mock, patch
 import lxml.cssselect
@@ -12,6 +13,7 @@ from eea.ldapadmin.roles_editor import RolesEditor
 from eea.ldapadmin.roles_editor import CommonTemplateLogic
 from eea.ldapadmin.ui_common import TemplateRenderer
 from eea import usersdb
+from eea.ldapadmin.tests.mock_ldap import mock_users_search
 
 
 def plaintext(element):
@@ -90,6 +92,57 @@ def session_messages(request):
     return request.SESSION.get('eea.ldapadmin.roles_editor.messages')
 
 
+class AllMembersDatatableTest(unittest.TestCase):
+    def setUp(self):
+        self.ui = StubbedRolesEditor()
+        self.mock_agent = Mock()
+        self.ui._get_ldap_agent = Mock(return_value=self.mock_agent)
+        self.mock_agent.members_in_subroles_with_source.return_value = {
+            'users': [('jsmith', ['places']), ('anne', ['places-bg']),
+                      ('gone', ['places'])]}
+        self.mock_agent.role_leaders.return_value = (['anne'], [])
+        self.mock_agent._user_dn.side_effect = (
+            lambda user_id: 'uid=%s,ou=Users' % user_id)
+        mock_users_search(self.mock_agent, user_map_fixture)
+        self.request = mock_request()
+        self.request.form = {'role_id': 'places', 'draw': '1',
+                             'start': '0', 'length': '2'}
+
+    @patch('eea.ldapadmin.roles_editor.ldapdump.users_page')
+    def test_page(self, users_page):
+        self.request.AUTHENTICATED_USER.getRoles.return_value = [
+            'Authenticated']
+        users_page.return_value = ([{'id': 'anne'}, {'id': 'gone'}], 3, 3)
+
+        result = json.loads(self.ui.all_members_datatable(self.request))
+
+        self.assertEqual(sorted(users_page.call_args[1]['members']),
+                         ['anne', 'gone', 'jsmith'])
+        self.assertEqual(result['recordsTotal'], 3)
+        self.assertEqual([row['id'] for row in result['data']],
+                         ['anne', 'gone'])
+        self.assertEqual(result['data'][0]['email'], "anne@example.com")
+        self.assertEqual(result['data'][0]['roles'], ['places-bg'])
+        self.assertTrue(result['data'][0]['leader'])
+        self.assertTrue(result['data'][1]['deleted'])
+        # only the users of the page are read
+        self.assertEqual(self.mock_agent.conn.search_s.call_count, 1)
+
+    @patch('eea.ldapadmin.roles_editor.ldapdump.users_page')
+    def test_anonymous(self, users_page):
+        self.request.AUTHENTICATED_USER.getRoles.return_value = ['Anonymous']
+        users_page.return_value = ([{'id': 'anne'}, {'id': 'gone'}], 3, 3)
+
+        result = json.loads(self.ui.all_members_datatable(self.request))
+
+        self.assertEqual(users_page.call_args[1]['search_columns'],
+                         ['full_name'])
+        self.assertFalse(users_page.call_args[1]['missing'])
+        self.assertEqual(result['data'], [
+            {'full_name': "Anne Tester", 'leader': True, 'alternate': False,
+             'roles': ['places-bg']}])
+
+
 class BrowseTest(unittest.TestCase):
     def setUp(self):
         self.ui = StubbedRolesEditor()
@@ -137,12 +190,14 @@ class BrowseTest(unittest.TestCase):
         self.mock_agent.members_in_role.return_value = {
             'users': ['jsmith'], 'orgs': [],
         }
-        self.mock_agent.user_info.return_value = dict(user_info_fixture)
+        mock_users_search(self.mock_agent,
+                          {'jsmith': dict(user_info_fixture)})
 
         page = parse_html(self.ui.index_html(self.request))
 
         self.mock_agent.members_in_role.assert_called_once_with('places')
-        self.mock_agent.user_info.assert_called_once_with('jsmith')
+        self.assertEqual(self.mock_agent.conn.search_s.call_count, 1)
+        self.assertFalse(self.mock_agent.user_info.called)
 
         cells = page.xpath(
             'table[@class="account-datatable dataTable"]/tbody/tr/td')
@@ -431,8 +486,8 @@ class AddRemoveRoleMembersTest(unittest.TestCase):
         self.mock_agent.role_info.return_value = {
             'description': "Various places",
         }
-        self.mock_agent.user_info.return_value = dict(user_info_fixture,
-                                                      id='jsmith')
+        mock_users_search(self.mock_agent,
+                          {'jsmith': dict(user_info_fixture, id='jsmith')})
         self.request.form = {'role_id': 'places'}
 
         page = parse_html(self.ui.remove_members_html(self.request))
@@ -599,6 +654,7 @@ class FilterTest(unittest.TestCase):
             (x, {}) for x in role_membership.keys()]
         self.mock_agent.members_in_role.side_effect = role_membership.get
         self.mock_agent.user_info.side_effect = deepcopy(user_map_fixture).get
+        mock_users_search(self.mock_agent, deepcopy(user_map_fixture))
         self.mock_agent.org_info.side_effect = deepcopy(org_map_fixture).get
 
     def check_query_results(self, page):
@@ -644,6 +700,7 @@ class UserInfoTest(unittest.TestCase):
         self.ui.REQUEST = self.request
         self.users = deepcopy(user_map_fixture)
         self.mock_agent.user_info.side_effect = self.users.get
+        mock_users_search(self.mock_agent, self.users)
         self.mock_agent.role_info.return_value = {
             'description': "The bank",
         }
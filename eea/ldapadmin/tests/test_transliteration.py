@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import unittest
+from transliterate import get_available_language_codes, translit
+from unidecode import unidecode
+from eea.ldapadmin import transliteration
+
+NAMES = [
+    (u'J\xf6rg', u'M\xfcller-Stra\xdfe', u'', u''),
+    (u'Иван', u'Петров',
+     u'Иван Петров', u''),
+    (u'Anne  Marie', u'Smith', u'', u'helper'),
+    (u'', u'', u'', u''),
+]
+
+
+def reference(first_name, last_name, full_name_native, search_helper):
+    """ transliterate every word with `translit` for every language """
+    values = []
+
+    for name in (first_name.split(' ') + last_name.split(' ') +
+                 full_name_native.split(' ') + search_helper.split(' ')):
+        values.append(unidecode(name))
+
+        for lang in get_available_language_codes():
+            try:
+                values.append(str(translit(name, lang, reversed=True)))
+            except UnicodeEncodeError:
+                pass
+        try:
+            values.append(str(name.replace(u'\xdf', 'ss').translate(
+                transliteration.GERMAN_TABLE)))
+        except UnicodeEncodeError:
+            pass
+
+    return ' '.join(sorted(set(values))).strip()
+
+
+class TransliterateTest(unittest.TestCase):
+
+    def test_same_as_translit(self):
+        for names in NAMES:
+            self.assertEqual(transliteration.transliterate(*names),
+                             reference(*names))
+
+    def test_batch(self):
+        self.assertEqual(transliteration.transliterate_all(NAMES),
+                         [reference(*names) for names in NAMES])
+
+    def test_cache_size(self):
+        size = transliteration.CACHE_SIZE
+        transliteration.CACHE_SIZE = 2
+        try:
+            transliteration.transliterate(u'a b c', u'd', u'', u'')
+            self.assertEqual(len(transliteration._spellings), 2)
+        finally:
+            transliteration.CACHE_SIZE = size
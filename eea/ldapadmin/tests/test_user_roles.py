@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+
+from mock import Mock
+from eea.ldapadmin import user_roles
+
+
+class UserRolesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = Mock()
+        self.agent.member_roles_info.return_value = [
+            ('eionet-nfp-mc-dk', {}), ('eionet-nfp', {}), ('eionet', {})]
+        self.tool = Mock()
+        self.tool._config = {'ldap_server': 'ldap.example.com'}
+        self.tool._get_ldap_agent.return_value = self.agent
+        self.request = Mock()
+        self.request.AUTHENTICATED_USER.getId.return_value = 'anne'
+        user_roles.clear()
+        self.addCleanup(user_roles.clear)
+
+    def test_nfp_country(self):
+        self.assertEqual(user_roles.nfp_for_country(self.tool, self.request),
+                         'dk')
+        self.assertEqual(user_roles.nfp_country(
+            [('eionet-nfp-oc-ch', {})], user_roles.NFP_PREFIXES[:2]), None)
+
+    def test_anonymous(self):
+        self.request.AUTHENTICATED_USER.getId.return_value = None
+
+        self.assertEqual(user_roles.nfp_for_country(self.tool, self.request),
+                         None)
+        self.assertFalse(self.agent.member_roles_info.called)
+
+    def test_roles_searched_once(self):
+        for i in range(3):
+            roles = user_roles.member_roles(self.tool, 'anne')
+
+        self.assertEqual([role_id for role_id, info in roles],
+                         ['eionet', 'eionet-nfp', 'eionet-nfp-mc-dk'])
+        self.assertEqual(self.agent.member_roles_info.call_count, 1)
+        self.tool._get_ldap_agent.assert_called_once_with(bind=True,
+                                                          secondary=True)
+
+    def test_invalidate(self):
+        user_roles.member_roles(self.tool, 'anne')
+        self.agent.member_roles_info.return_value = [('eionet', {})]
+        user_roles.invalidate('anne')
+
+        self.assertEqual(user_roles.nfp_for_country(self.tool, self.request),
+                         None)
+
+    def test_expired(self):
+        cache = user_roles.RolesCache(ttl=60)
+        factory = Mock(return_value=self.agent)
+        cache.member_roles('ldap', 'anne', factory, now=1000)
+        cache.member_roles('ldap', 'anne', factory, now=1059)
+        cache.member_roles('ldap', 'anne', factory, now=1061)
+
+        self.assertEqual(self.agent.member_roles_info.call_count, 2)
+
+    def test_is_nfp(self):
+        for i in range(3):
+            self.assertTrue(user_roles.is_nfp(self.tool, 'anne', 'dk'))
+        self.assertFalse(user_roles.is_nfp(self.tool, 'anne', 'ro'))
+        self.assertFalse(user_roles.is_nfp(self.tool, None, 'dk'))
+
+        self.assertEqual(self.agent.member_roles_info.call_count, 1)
+
+        self.agent.member_roles_info.return_value = [('eionet', {})]
+        user_roles.invalidate('anne')
+
+        self.assertFalse(user_roles.is_nfp(self.tool, 'anne', 'dk'))
+
+    def test_per_directory(self):
+        other_agent = Mock()
+        other_agent.member_roles_info.return_value = [('eionet', {})]
+        other_tool = Mock()
+        other_tool._config = {'ldap_server': 'test-ldap.example.com'}
+        other_tool._get_ldap_agent.return_value = other_agent
+
+        self.assertTrue(user_roles.is_nfp(self.tool, 'anne', 'dk'))
+        self.assertFalse(user_roles.is_nfp(other_tool, 'anne', 'dk'))
+
+        user_roles.invalidate('anne')
+        user_roles.member_roles(self.tool, 'anne')
+        user_roles.member_roles(other_tool, 'anne')
+
+        self.assertEqual(self.agent.member_roles_info.call_count, 2)
+        self.assertEqual(other_agent.member_roles_info.call_count, 2)
+
+    def test_invalidated_while_reading(self):
+        cache = user_roles.RolesCache(ttl=60)
+
+        def read_roles(*args):
+            cache.invalidate('anne')
+
+            return [('eionet-nfp-mc-dk', {})]
+        self.agent.member_roles_info.side_effect = read_roles
+        factory = Mock(return_value=self.agent)
+        cache.member_roles('ldap', 'anne', factory)
+        cache.member_roles('ldap', 'anne', factory)
+
+        self.assertEqual(self.agent.member_roles_info.call_count, 2)
+
+    def test_read_once_by_concurrent_requests(self):
+        cache = user_roles.RolesCache(ttl=60)
+
+        def read_roles(*args):
+            time.sleep(0.1)
+
+            return [('eionet', {})]
+        self.agent.member_roles_info.side_effect = read_roles
+        factory = Mock(return_value=self.agent)
+        threads = [threading.Thread(target=cache.member_roles,
+                                    args=('ldap', 'anne', factory))
+                   for i in range(5)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.agent.member_roles_info.call_count, 1)
@@ -0,0 +1,144 @@
+import unittest
+from datetime import datetime
+
+import ldap
+from mock import Mock, patch
+from eea.ldapadmin.users_admin import (AutomatedUserDisabler, generate_user_id,
+                                       start_bulk_jobs)
+
+
+class GenerateUserIdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.existing = set(['smithjoh', 'smithjoa'])
+        self.agent = Mock()
+        self.agent.existing_usernames.side_effect = (
+            lambda uids: [uid for uid in uids if uid in self.existing])
+
+    def test_base_id(self):
+        self.assertEqual(generate_user_id(u'Anne', u'Jensen', self.agent, []),
+                         'jenseann')
+        self.assertEqual(self.agent.existing_usernames.call_count, 1)
+
+    def test_one_search_per_position(self):
+        self.assertEqual(generate_user_id(u'John', u'Smith', self.agent, []),
+                         'smithjob')
+        self.assertEqual(self.agent.existing_usernames.call_count, 2)
+
+    def test_taken_ids_shared_by_an_import(self):
+        taken = {}
+        ids = set()
+
+        for i in range(3):
+            ids.add(generate_user_id(u'John', u'Smith', self.agent, ids,
+                                     taken))
+
+        self.assertEqual(ids, set(['smithjob', 'smithjoc', 'smithjod']))
+        self.assertEqual(self.agent.existing_usernames.call_count, 2)
+
+
+class StartBulkJobsTest(unittest.TestCase):
+
+    @patch('eea.ldapadmin.users_admin.RESUME_BULK_JOBS', '')
+    @patch('eea.ldapadmin.users_admin.bulk_runner')
+    def test_not_resumed_by_default(self, bulk_runner):
+        start_bulk_jobs(None)
+
+        self.assertFalse(bulk_runner.called)
+
+    @patch('eea.ldapadmin.users_admin.RESUME_BULK_JOBS', 'on')
+    @patch('eea.ldapadmin.users_admin.bulk_runner')
+    def test_missing_storage_logged(self, bulk_runner):
+        bulk_runner.side_effect = ValueError("LDAP_DISK_STORAGE is not set")
+
+        start_bulk_jobs(None)
+
+        self.assertTrue(bulk_runner.called)
+
+
+def dump_user(uid, pending_disable=None, disabled=False):
+    return {'id': uid, 'username': uid, 'dn': 'uid=%s,ou=Users' % uid,
+            'email': '%s@example.com' % uid, 'full_name': uid.title(),
+            'pending_disable': pending_disable, 'disabled': disabled}
+
+
+class AutomatedUserDisablerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = Mock()
+        self.request = Mock()
+        self.request.form = {}
+        self.view = AutomatedUserDisabler(self.context, self.request)
+        self.users = [
+            dump_user('active'),
+            dump_user('idle'),
+            dump_user('warned', pending_disable='2020-01-01T00:00:00'),
+            dump_user('returned', pending_disable='2020-01-01T00:00:00'),
+            dump_user('gone', disabled=True),
+            dump_user('unknown'),
+        ]
+        self.stats = {
+            'active': '2020-03-01T00:00:00',
+            'idle': '2017-01-01T00:00:00',
+            'warned': '2017-01-01T00:00:00',
+            'returned': '2020-02-01T00:00:00',
+            'gone': '2017-01-01T00:00:00',
+        }
+
+    def test_decide(self):
+        decisions = list(self.view.decide(self.users, self.stats,
+                                          datetime(2020, 3, 2)))
+
+        self.assertEqual([(action, user['id']) for action, user in decisions],
+                         [('predisable', 'idle'), ('disable', 'warned'),
+                          ('remove_pending', 'returned')])
+
+    @patch.object(AutomatedUserDisabler, 'get_login_statistics')
+    @patch.object(AutomatedUserDisabler, 'get_ldap_users')
+    def test_dry_run(self, get_ldap_users, get_login_statistics):
+        get_ldap_users.return_value = iter(self.users)
+        get_login_statistics.return_value = self.stats
+        self.request.form['dry_run'] = '1'
+
+        report = self.view()
+
+        self.assertTrue(report.startswith("DRY RUN: "))
+        self.assertTrue("predisable idle (last login 2017-01-01)" in report)
+        self.assertFalse(self.context.restrictedTraverse.called)
+
+    @patch.object(AutomatedUserDisabler, 'get_login_statistics')
+    @patch.object(AutomatedUserDisabler, 'get_ldap_users')
+    def test_stale_dump_rechecked(self, get_ldap_users, get_login_statistics):
+        get_ldap_users.return_value = iter(self.users)
+        get_login_statistics.return_value = dict(
+            (user_id, self.stats[user_id])
+            for user_id in ['idle', 'warned', 'returned'])
+        live = {
+            # warned by the previous run, after the dump was made
+            'idle': {'employeeNumber': ['2020-01-01T00:00:00']},
+            # disabled by hand since
+            'warned': {'employeeNumber': ['2020-01-01T00:00:00'],
+                       'employeeType': ['disabled']},
+            'returned': {'employeeNumber': ['2020-01-01T00:00:00']},
+        }
+        agent = self.context.restrictedTraverse.return_value.\
+            _get_ldap_agent.return_value
+        agent._user_dn.side_effect = lambda uid: uid
+        agent.conn.search_s.side_effect = (
+            lambda dn, scope, attrlist: [(dn, live[dn])])
+        agent.conn.modify_s.return_value = (ldap.RES_MODIFY, [])
+        notifier = Mock()
+        self.view.notifier = Mock(return_value=notifier)
+
+        with patch('eea.ldapadmin.users_admin.user_roles') as user_roles:
+            report = self.view()
+
+        self.assertEqual(report.splitlines()[1:],
+                         ["disable idle (last login 2017-01-01)",
+                          "remove_pending returned (last login 2020-02-01)"])
+        agent.disable_user.assert_called_once_with('idle')
+        user_roles.invalidate.assert_called_once_with('idle')
+        self.assertFalse(notifier.predisabled.called)
+        self.assertEqual(notifier.disabled.call_args[0][0]['username'],
+                         'idle')
+        self.assertTrue(notifier.report.called)
@@ -0,0 +1,109 @@
+""" ASCII spellings of the names of the users, for their search helper
+
+The spellings of each word are cached, the language packs of
+`transliterate` are built once for the process.
+"""
+import threading
+from collections import OrderedDict
+
+from transliterate import get_available_language_codes
+from transliterate.base import registry
+from unidecode import unidecode
+
+# how many words have their spellings cached
+CACHE_SIZE = 10000
+
+GERMAN_TABLE = {
+    0xe4: ord('a'),
+    0xc4: ord('A'),
+    0xf6: ord('o'),
+    0xd6: ord('O'),
+    0xfc: ord('u'),
+    0xdc: ord('U'),
+}
+
+_lock = threading.Lock()
+_packs = []
+_spellings = OrderedDict()
+
+
+def _language_packs():
+    """ An instance of each language pack, in the order of
+    `get_available_language_codes` """
+    with _lock:
+        if not _packs:
+            _packs.extend(registry.get(lang)()
+                          for lang in get_available_language_codes())
+
+        return _packs
+
+
+def _spell(word):
+    values = [unidecode(word)]
+
+    for pack in _language_packs():
+        try:
+            values.append(str(pack.translit(word, reversed=True)))
+        except UnicodeEncodeError:
+            # if we encounter other characters = other languages
+            # than German
+            pass
+    try:
+        values.append(str(word.replace(u'\xdf', 'ss').translate(GERMAN_TABLE)))
+    except UnicodeEncodeError:
+        # if we encounter other characters = other languages than German
+        pass
+
+    return tuple(values)
+
+
+def spellings(word):
+    """ The ASCII spellings of `word`, from `unidecode`, every language
+    pack and the German umlauts """
+    with _lock:
+        if word in _spellings:
+            _spellings[word] = values = _spellings.pop(word)
+
+            return values
+    values = _spell(word)
+
+    with _lock:
+        _spellings[word] = values
+
+        while len(_spellings) > CACHE_SIZE:
+            _spellings.popitem(last=False)
+
+    return values
+
+
+def _vocabulary(first_name, last_name, full_name_native, search_helper):
+    return set(first_name.split(' ') + last_name.split(' ') +
+               full_name_native.split(' ') + search_helper.split(' '))
+
+
+def _join(values):
+    return ' '.join(sorted(set(values))).strip()
+
+
+def transliterate(first_name, last_name, full_name_native, search_helper):
+    """ The search helper of a user: the ASCII spellings of all the words
+    in the names and in the helper entered """
+    return _join(value for word in _vocabulary(first_name, last_name,
+                                                full_name_native,
+                                                search_helper)
+                 for value in spellings(word))
+
+
+def transliterate_all(names):
+    """ `transliterate` for each (first name, last name, native name,
+    search helper) in `names`, spelling each distinct word once """
+    vocabularies = [_vocabulary(*row) for row in names]
+    known = {}
+
+    for vocabulary in vocabularies:
+        for word in vocabulary:
+            if word not in known:
+                known[word] = spellings(word)
+
+    return [_join(value for word in vocabulary for value in known[word])
+            for vocabulary in vocabularies]
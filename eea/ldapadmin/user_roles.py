@@ -0,0 +1,145 @@
+""" The roles a user is member of, and the country the user is NFP for
+
+The roles of a user are asked from LDAP once and kept for `ROLES_TTL`
+seconds, separately for each LDAP server and branch, so the access checks
+made several times per page don't search LDAP each time. The tools forget
+a user's roles when they change the user's memberships; changes made
+elsewhere (or by another Zope instance) are seen when the roles expire.
+"""
+import threading
+import time
+
+from ldap_config import defaults
+
+# seconds the roles of a user are reused
+ROLES_TTL = 60
+
+# roles of the National Focal Points, followed by the country code
+NFP_PREFIXES = ('eionet-nfp-cc-', 'eionet-nfp-mc-', 'eionet-nfp-oc-')
+
+
+def _directory(tool):
+    """ The LDAP server and branches the roles of `tool` are read from """
+    config = getattr(tool, '_config', {})
+
+    return tuple(config.get(name, defaults[name])
+                 for name in ('ldap_server', 'users_dn', 'roles_dn'))
+
+
+class RolesCache(object):
+    """ The sorted `member_roles_info` of the users of each directory, for
+    `ttl` seconds """
+
+    def __init__(self, ttl=ROLES_TTL):
+        self.ttl = ttl
+        self._roles = {}
+        self._loading = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self, key, now):
+        entry = self._roles.get(key)
+
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+    def member_roles(self, directory, user_id, agent_factory, now=None):
+        """ The (role id, info) of the roles `user_id` is member of in
+        `directory`; `agent_factory()` returns a bound agent, used when the
+        roles of the user aren't known. Only one request reads the roles of
+        a user, the others wait for its answer. """
+        now = now or time.time()
+        key = (directory, user_id)
+
+        with self._lock:
+            roles = self._fresh(key, now)
+
+            if roles is not None:
+                return roles
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            with self._lock:
+                roles = self._fresh(key, now)
+
+                if roles is not None:
+                    return roles
+                generation = self._generation
+            try:
+                roles = sorted(agent_factory().member_roles_info(
+                    'user', user_id, ('description',)))
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+            with self._lock:
+                # roles changed while they were read are read again
+                if generation == self._generation:
+                    for old_key, old_entry in self._roles.items():
+                        if old_entry[0] <= now:
+                            del self._roles[old_key]
+                    self._roles[key] = (now + self.ttl, roles)
+
+        return roles
+
+    def invalidate(self, *user_ids):
+        """ Forget the roles of `user_ids`, in all the directories """
+        with self._lock:
+            self._generation += 1
+
+            for key in self._roles.keys():
+                if key[1] in user_ids:
+                    del self._roles[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._roles.clear()
+
+
+roles_cache = RolesCache()
+
+
+def member_roles(tool, user_id):
+    """ The roles of `user_id`, read with the secondary agent of `tool` """
+    return roles_cache.member_roles(
+        _directory(tool), user_id,
+        lambda: tool._get_ldap_agent(bind=True, secondary=True))
+
+
+def nfp_country(roles, prefixes=NFP_PREFIXES):
+    """ The country of the first NFP role in `roles`, or None """
+    for role_id, info in roles:
+        for prefix in prefixes:
+            if prefix in role_id:
+                return role_id.replace(prefix, '')
+
+
+def nfp_for_country(tool, request, prefixes=NFP_PREFIXES):
+    """ The country the logged in user is NFP for, or None """
+    user_id = request.AUTHENTICATED_USER.getId()
+
+    if user_id:
+        return nfp_country(member_roles(tool, user_id), prefixes)
+
+
+def is_nfp(tool, user_id, country_code):
+    """ Whether `user_id` is member of an NFP role of `country_code`, e.g.
+    eionet-nfp-mc-dk for dk """
+    if not (user_id and country_code):
+        return False
+    suffix = '-' + country_code.lower()
+
+    return any(role_id.startswith('eionet-nfp-') and
+               role_id.lower().endswith(suffix)
+               for role_id, info in member_roles(tool, user_id))
+
+
+def invalidate(*user_ids):
+    """ Forget the roles of `user_ids`, their memberships changed """
+    roles_cache.invalidate(*user_ids)
+
+
+def clear():
+    """ Forget the roles of all the users, e.g. after roles were merged """
+    roles_cache.clear()
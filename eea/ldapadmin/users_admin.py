@@ -2,26 +2,34 @@ import logging
 import os
 import random
 import re
-import sqlite3
 import string
+import threading
+import urllib
+from collections import Counter
 from copy import deepcopy
-from datetime import datetime, timedelta
+from datetime import datetime
 from email.mime.text import MIMEText
 
 import colander
-import jellyfish
-import requests
+import transaction
 import xlrd
-from dateutil import parser
 from unidecode import unidecode
-from zope.component import getUtility
-from zope.sendmail.interfaces import IMailDelivery
 from plone import api
 
+import auto_disable
+import bulk_jobs
+import datatables
+import email_check
 import deform
 import ldap
 import ldap_config
+import ldapdump
+import mail_outbox
+import transliteration
+import user_roles
+from org_catalogue import catalogue
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_chain
 from AccessControl.Permissions import view, view_management_screens
 from AccessControl.unauthorized import Unauthorized
 from App.class_init import InitializeClass
@@ -33,18 +41,16 @@ from eea.ldapadmin import eionet_profile
 from eea.ldapadmin.constants import NETWORK_NAME
 from eea.ldapadmin.help_messages import help_messages
 from eea.ldapadmin.ui_common import NaayaViewPageTemplateFile
-from eea.usersdb.db_agent import (EmailAlreadyExists, NameAlreadyExists,
-                                  UserNotFound)
+from eea.usersdb.db_agent import EmailAlreadyExists, NameAlreadyExists
 from import_export import (excel_headers_to_object, generate_excel,
                            set_response_attachment)
-from naaya.ldapdump.interfaces import IDumpReader
+from name_index import NameIndex
 from OFS.PropertyManager import PropertyManager
 from OFS.SimpleItem import SimpleItem
 from persistent.mapping import PersistentMapping
 from Products.Five.browser import BrowserView
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from Products.statusmessages.interfaces import IStatusMessage
-from transliterate import get_available_language_codes, translit
 from ui_common import CommonTemplateLogic  # load_template,
 from ui_common import TemplateRenderer, TemplateRendererNoWrap, extend_crumbs
 from validate_email import INCORRECT_EMAIL, validate_email
@@ -72,6 +78,9 @@ if hasattr(CONFIG, 'environment'):
     CONFIG.environment.update(os.environ)
 FORUM_URL = getattr(CONFIG, 'environment', {}).get('FORUM_URL', '')
 
+# email addresses written at once by `bulk_get_emails`
+EMAILS_CHUNK = 500
+
 password_letters = '23456789ABCDEFGHIJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
 
@@ -79,7 +88,23 @@ def generate_password():
     return ''.join(random.choice(password_letters) for n in range(8))
 
 
-def generate_user_id(first_name, last_name, agent, id_list):
+def _user_id_candidates(base_uid):
+    """ Yield, in the order they are tried, lists of ids for a new user: the
+    base id, then the ids with one letter replaced at each position """
+    yield [base_uid]
+
+    for i in range(8):
+        yield [base_uid[:8 - i - 1] + letter + base_uid[8 - i:]
+               for letter in string.lowercase]
+
+
+def generate_user_id(first_name, last_name, agent, id_list, taken=None):
+    """ The first free user id made from the names, not in `id_list`
+
+    Each list of candidates is checked with a single LDAP search. `taken`
+    is an optional dict of id -> whether it exists in LDAP, to be shared
+    by the calls made for the same import.
+    """
     first_name = unidecode(first_name).replace(
         '-', '').replace("'", "").replace(" ", "")
     last_name = unidecode(last_name).replace(
@@ -89,17 +114,22 @@ def generate_user_id(first_name, last_name, agent, id_list):
     uid2 = first_name[:8 - len(uid1)]
     base_uid = (uid1 + uid2).lower()
 
-    if not(list(agent.existing_usernames([base_uid])) or base_uid in id_list):
-        return base_uid
+    if taken is None:
+        taken = {}
 
-    for i in range(8):
-        for letter in string.lowercase:
-            new_uid = base_uid[:8 - i - 1] + letter + base_uid[8 - i:]
+    for candidates in _user_id_candidates(base_uid):
+        unknown = [uid for uid in set(candidates) if uid not in taken]
+
+        if unknown:
+            existing = set(uid.lower()
+                           for uid in agent.existing_usernames(unknown))
 
-            if not(list(agent.existing_usernames([new_uid])) or
-                    new_uid in id_list):
+            for uid in unknown:
+                taken[uid] = uid in existing
 
-                return new_uid
+        for uid in candidates:
+            if not (taken[uid] or uid in id_list):
+                return uid
 
 
 def process_url(url):
@@ -138,47 +168,37 @@ def _is_authenticated(request):
     return ('Authenticated' in request.AUTHENTICATED_USER.getRoles())
 
 
-def get_users_by_ldap_dump():
-    LDAP_DISK_STORAGE = getattr(CONFIG, 'environment',
-                                {}).get('LDAP_DISK_STORAGE', '')
-    DB_FILE = os.path.join(LDAP_DISK_STORAGE, 'ldap_eionet_europa_eu.db')
-
-    if not os.path.exists(DB_FILE):
-        from naaya.ldapdump.interfaces import IDumpReader
-        from zope.component import getUtility
-        util = getUtility(IDumpReader)
-        DB_FILE = util.db_path
-        assert os.path.exists(DB_FILE)
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "SELECT a.dn as dn, a.value AS cn "
-        "FROM ldapmapping a WHERE a.attr = 'cn' "
-    )
-
-    ldap_user_records = []
+def get_users_by_ldap_dump(db_path=None):
+    """ The dn and (transliterated) cn of all users in the LDAP dump """
+    return [{'dn': user.dn, 'cn': user.ascii_cn}
+            for user in ldapdump.users_cache.users(db_path)]
 
-    for data in cursor.fetchall():
-        ldap_user_records.append({'dn': data['dn'],
-                                  'cn': unidecode(data['cn'])})
 
-    return ldap_user_records
+# the name index of the cached dump users, rebuilt when they are reloaded
+_name_index = {'users': None, 'threshold': None, 'index': None}
+_name_index_lock = threading.Lock()
 
 
-def get_duplicates_by_name(name):
-    ldap_users = get_users_by_ldap_dump()
+def get_name_index():
+    """ The `NameIndex` of the users in the LDAP dump """
+    users = ldapdump.users_cache.users()
+    threshold = UsersAdmin.similarity_level
 
-    records = []
+    with _name_index_lock:
+        if (_name_index['users'] is not users or
+                _name_index['threshold'] != threshold):
+            _name_index['index'] = NameIndex(
+                [(user.dn, user.ascii_cn) for user in users], threshold)
+            _name_index['users'] = users
+            _name_index['threshold'] = threshold
 
-    for user in ldap_users:
-        distance = jellyfish.jaro_winkler(name, user['cn'])
+        return _name_index['index']
 
-        if distance >= UsersAdmin.similarity_level:
-            records.append(user['dn'])
 
-    return records
+def get_duplicates_by_name(name):
+    """ The DNs of the users with a name similar to `name`, above
+    `UsersAdmin.similarity_level` """
+    return get_name_index().similar(name)
 
 
 def logged_in_user(request):
@@ -227,8 +247,13 @@ class UsersAdmin(SimpleItem, PropertyManager):
         return stack
 
     def _get_ldap_agent(self, bind=True, secondary=False):
-        agent = ldap_config.ldap_agent_with_config(self._config, bind,
-                                                   secondary=secondary)
+        return ldap_config.request_agent(self, self._new_ldap_agent, bind,
+                                         secondary)
+
+    def _new_ldap_agent(self, bind=True, secondary=False):
+        agent = ldap_config.ldap_agent_with_config(
+            self._config, bind, secondary=secondary,
+            request=getattr(self, 'REQUEST', None))
         try:
             agent._author = logged_in_user(self.REQUEST)
         except AttributeError:
@@ -298,54 +323,84 @@ class UsersAdmin(SimpleItem, PropertyManager):
         })
 
         if search_name:
-            agent = self._get_ldap_agent(bind=True)
-            results = sorted(agent.search_user(search_name, lookup),
-                             key=lambda x: x['full_name'])
-            options['search_results'] = results
-
-        for row in options.get('search_results', []):
-            if row.get('status') in ['disabled']:
-                row['email'] = "disabled - %s" % row['email']
+            # the results are loaded page by page from `users_datatable`
+            query = [('name:utf8:ustring', search_name.encode('utf-8'))]
+            query += [('lookup:list', field.encode('utf-8'))
+                      for field in lookup or []]
+            options['datatable_url'] = '%s/users_datatable?%s' % (
+                self.absolute_url(), urllib.urlencode(query))
 
         return self._render_template('zpt/users_index.zpt', **options)
 
+    def users_datatable(self, REQUEST):
+        """ A page of the user accounts found by `index_html`, for
+        DataTables. Read from the LDAP dump, so that large directories are
+        never loaded at once. """
+
+        if not self.checkPermissionEditUsers() and not self.nfp_has_access():
+            raise Unauthorized
+        params = datatables.read_params(REQUEST.form)
+        fields = usersdb.db_agent.ACCEPTED_SEARCH_FIELDS
+        lookup = [field for field in REQUEST.form.get('lookup', [])
+                  if field in fields] or list(fields)
+        sort = datatables.sort_key(params, ['full_name', 'email'])
+        users, total, filtered = ldapdump.users_page(
+            params['search'], sort or 'full_name', params['sort_desc'],
+            params['start'], params['length'],
+            name=REQUEST.form.get('name', ''), lookup=lookup)
+
+        for row in users:
+            if row.pop('status') in ['disabled']:
+                row['email'] = ("disabled - %s" % row['email']
+                                if row['email'] else "disabled")
+
+        return datatables.render_json(
+            REQUEST, datatables.response(params, users, total, filtered))
+
     security.declareProtected(eionet_edit_users, 'get_statistics')
 
     def get_statistics(self, REQUEST):
         """ view a simple table of how many users have been registered,
-        for each year
+        for each year and month
         """
+        stats = ldapdump.registration_stats()
+
+        if stats is None:
+            stats = self._registration_stats_from_ldap()
 
+        return self._render_template('zpt/statistics.zpt', **stats)
+
+    security.declarePrivate('_registration_stats_from_ldap')
+
+    def _registration_stats_from_ldap(self):
+        """ `ldapdump.summarize_registrations`, for when the dump has no
+        creation dates; only the two attributes needed are fetched """
         agent = self._get_ldap_agent(bind=True)
 
         msgid = agent.conn.search_ext(
             agent._user_dn_suffix,
             ldap.SCOPE_ONELEVEL,
             '(objectClass=organizationalPerson)',
-            attrlist=['*', 'uid', 'createTimestamp', 'modifyTimestamp']
+            attrlist=['createTimestamp', 'employeeType']
         )
 
-        all_results = []
+        counts = {}
 
         for res_type, result, res_msgid, res_controls in agent.conn.allresults(
                 msgid):
 
             for rdn, ldap_obj in result:
-                all_results.append(
-                    (rdn, agent._unpack_user_info(rdn, ldap_obj)))
-
-        stats = {}
+                created = ldap_obj.get('createTimestamp', [''])[0]
 
-        for dn, rec in all_results:
-            year = rec['createTimestamp'].year
+                if not created[:6].isdigit():
+                    continue
+                status = ('disabled' if 'disabled' in
+                          ldap_obj.get('employeeType', []) else 'enabled')
+                key = (int(created[:4]), int(created[4:6]), status)
+                counts[key] = counts.get(key, 0) + 1
 
-            if year not in stats:
-                stats[year] = 0
-            stats[year] += 1
-
-        options = {'stats': stats}
-
-        return self._render_template('zpt/statistics.zpt', **options)
+        return ldapdump.summarize_registrations(
+            key + (users,) for key, users in counts.items())
 
     security.declarePrivate('_find_duplicates')
 
@@ -489,11 +544,7 @@ class UsersAdmin(SimpleItem, PropertyManager):
             schema['id'].validator, no_duplicate_id_validator)
 
         if self.checkPermissionEditUsers():
-            try:
-                agent_orgs = agent.all_organisations()
-            except ldap.SIZELIMIT_EXCEEDED:
-                secondary_agent = self._get_ldap_agent(secondary=True)
-                agent_orgs = secondary_agent.all_organisations()
+            agent_orgs = catalogue.all_organisations(self)
         else:
             agent_orgs = self.orgs_in_country(nfp_country)
 
@@ -628,11 +679,7 @@ class UsersAdmin(SimpleItem, PropertyManager):
         else:
             form_data = user
 
-        try:
-            orgs = agent.all_organisations()
-        except ldap.SIZELIMIT_EXCEEDED:
-            secondary_agent = self._get_ldap_agent(secondary=True)
-            orgs = secondary_agent.all_organisations()
+        orgs = catalogue.all_organisations(self)
         orgs = [{'id': k, 'text': v['name'], 'text_native': v['name_native'],
                  'ldap': True} for k, v in orgs.items()]
         user_orgs = list(agent.user_organisations(user_id))
@@ -833,6 +880,7 @@ class UsersAdmin(SimpleItem, PropertyManager):
         agent = self._get_ldap_agent(bind=True)
         with agent.new_action():
             agent.delete_user(id)
+        user_roles.invalidate(id)
 
         IStatusMessage(REQUEST).add('User "%s" has been deleted.' % id,
                                     type='info')
@@ -864,6 +912,7 @@ class UsersAdmin(SimpleItem, PropertyManager):
         agent = self._get_ldap_agent(bind=True)
         with agent.new_action():
             agent.disable_user(id)
+        user_roles.invalidate(id)
 
         when = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         msg = 'User "%s" has been disabled. (%s)' % (id, when)
@@ -896,6 +945,7 @@ class UsersAdmin(SimpleItem, PropertyManager):
         agent = self._get_ldap_agent(bind=True)
         with agent.new_action():
             agent.enable_user(id, restore_roles=restore_roles)
+        user_roles.invalidate(id)
 
         log.info("%s ENABLED USER %s", logged_in_user(REQUEST), id)
 
@@ -912,17 +962,7 @@ class UsersAdmin(SimpleItem, PropertyManager):
         message['To'] = addr_to
         subject = "%s Account - account enabled" % NETWORK_NAME
         message['Subject'] = subject
-
-        try:
-            from plone import api
-            api.portal.send_email(recipient=[addr_to], sender=addr_from,
-                                  subject=subject, body=message)
-        except ImportError:
-            mailer = getUtility(IMailDelivery, name="naaya-mail-delivery")
-            try:
-                mailer.send(addr_from, [addr_to], message.as_string())
-            except AssertionError:
-                mailer.send(addr_from, [addr_to], message)
+        _send_email(addr_from, addr_to, message)
 
         when = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -970,14 +1010,7 @@ class UsersAdmin(SimpleItem, PropertyManager):
         message['To'] = addr_to
         subject = "%s Account - New password" % NETWORK_NAME
         message['Subject'] = subject
-
-        try:
-            from plone import api
-            api.portal.send_email(recipient=[addr_to], sender=addr_from,
-                                  subject=subject, body=message)
-        except ImportError:
-            mailer = getUtility(IMailDelivery, name="naaya-mail-delivery")
-            mailer.send(addr_from, [addr_to], message)
+        _send_email(addr_from, addr_to, message)
 
         IStatusMessage(REQUEST).add('Password changed for "%s".' % id,
                                     type='info')
@@ -1029,32 +1062,27 @@ class UsersAdmin(SimpleItem, PropertyManager):
 
     def bulk_get_emails(self, REQUEST):
         """
-        Return all email addresses
+        Return the email addresses of the members of organisations, as a
+        JSON list written in chunks
         """
-        from ldap import NO_SUCH_OBJECT
-
-        agent = self._get_ldap_agent()
-        bulk_emails = []
-        try:
-            orgs = agent.all_organisations()
-        except ldap.SIZELIMIT_EXCEEDED:
-            secondary_agent = self._get_ldap_agent(secondary=True)
-            orgs = secondary_agent.all_organisations()
+        response = REQUEST.RESPONSE
+        response.setHeader('Content-Type', 'application/json')
+        response.write('[')
+        chunk = []
+        separator = ''
 
-        for org_id, info in orgs.iteritems():
-            members = agent.members_in_org(org_id)
+        for email in ldapdump.org_member_emails():
+            chunk.append(json.dumps(email))
 
-            if members:
-                for user_id in members:
-                    try:
-                        user_info = agent.user_info(user_id)
+            if len(chunk) == EMAILS_CHUNK:
+                response.write(separator + ', '.join(chunk))
+                chunk, separator = [], ', '
 
-                        if user_info not in bulk_emails:
-                            bulk_emails.append(str(user_info['email']))
-                    except (NO_SUCH_OBJECT, usersdb.UserNotFound):
-                        pass
+        if chunk:
+            response.write(separator + ', '.join(chunk))
+        response.write(']')
 
-        return json.dumps(bulk_emails)
+        return ''
 
     security.declareProtected(eionet_edit_users, 'bulk_check_email')
 
@@ -1062,46 +1090,9 @@ class UsersAdmin(SimpleItem, PropertyManager):
         """ Bulk verify emails for conformance """
 
         agent = self._get_ldap_agent(bind=True)
-        emails = []
-        form_data = REQUEST.form.get('emails', None)
-
-        if form_data:
-            emails = re.sub(r'[\s,]+', ' ', form_data).split(' ')
-
-        duplicates = []
-        singles = []
-
-        for email in emails:
-            if email.lower() not in [x.lower() for x in singles]:
-                singles.append(email)
-            else:
-                duplicates.append(email)
-
-        options = {
-            'emails': sorted(singles),
-            'valid': [],
-            'invalid': [],
-            'taken': [],
-            'bulk_emails': [],
-            'duplicates': sorted(duplicates),
-        }
-
-        node = user_info_add_schema['email']
-
-        for email in emails:
-            try:
-                node.validator(node, email)
-            except colander.Invalid:
-                options['invalid'].append(email)
-            else:
-                options['valid'].append(email.lower())
-
-        # search for availability
-
-        if options['valid']:
-            options['taken'] = sorted(agent.existing_emails(options['valid']))
-            options['valid'] = sorted(set(options['valid']) -
-                                      set(options['taken']))
+        emails = email_check.split_emails(REQUEST.form.get('emails'))
+        options = email_check.check_emails(agent, emails,
+                                           user_info_add_schema['email'])
 
         self._set_breadcrumbs([("Bulk Verify Emails", '#')])
 
@@ -1120,19 +1111,22 @@ class UsersAdmin(SimpleItem, PropertyManager):
 
         return self._render_template('zpt/users/eionet_profile.zpt', **options)
 
-    security.declareProtected(eionet_edit_users, 'eionet_profile')
+    security.declareProtected(eionet_edit_users, 'get_endpoint')
 
     def get_endpoint(self, REQUEST):
-        """ Returns call for a service """
+        """ The answer of a service about a user, with its data, error and
+        latency """
         title = REQUEST.form['service']
         userid = REQUEST.form['userid']
+        REQUEST.RESPONSE.setHeader('Content-Type', 'application/json')
 
         for service in eionet_profile.get_endpoints():
             if service['title'] == title:
-                return json.dumps(eionet_profile.get_endpoint_data(service,
-                                                                   userid))
+                return json.dumps(
+                    eionet_profile.profile_cache.answer(service, userid))
+        REQUEST.RESPONSE.setStatus(404)
 
-        return json.dumps({})
+        return json.dumps(None)
 
     def send_confirmation_email(self, user_info):
         """ Sends confirmation email """
@@ -1175,68 +1169,34 @@ class UsersAdmin(SimpleItem, PropertyManager):
 
     def orgs_in_country(self, country):
         """ """
-        agent = self._get_ldap_agent()
-        try:
-            orgs_by_id = agent.all_organisations()
-        except ldap.SIZELIMIT_EXCEEDED:
-            secondary_agent = self._get_ldap_agent(secondary=True)
-            orgs_by_id = secondary_agent.all_organisations()
-        countries = dict(get_country_options(country=country))
-        orgs = {}
-
-        for org_id, info in orgs_by_id.iteritems():
-            country_info = countries.get(info['country'])
-
-            if country_info:
-                orgs[org_id] = info
-
-        return orgs
+        return catalogue.orgs_in_countries(
+            self, dict(get_country_options(country=country)))
 
     def nfp_for_country(self):
         """ Return country code for which the current user has NFP role
         or None otherwise"""
-        user_id = self.REQUEST.AUTHENTICATED_USER.getId()
-
-        if user_id:
-            ldap_groups = self.get_ldap_user_groups(user_id)
-
-            for group in ldap_groups:
-                if 'eionet-nfp-cc-' in group[0]:
-                    return group[0].replace('eionet-nfp-cc-', '')
-
-                if 'eionet-nfp-mc-' in group[0]:
-                    return group[0].replace('eionet-nfp-mc-', '')
+        return user_roles.nfp_for_country(self, self.REQUEST,
+                                          user_roles.NFP_PREFIXES[:2])
 
     def get_ldap_user_groups(self, user_id):
         """ """
-        agent = self._get_ldap_agent(bind=True, secondary=True)
-        ldap_roles = sorted(agent.member_roles_info('user',
-                                                    user_id,
-                                                    ('description',)))
-
-        return ldap_roles
+        return user_roles.member_roles(self, user_id)
 
 
 InitializeClass(UsersAdmin)
 
 
 def _send_email(addr_from, addr_to, message):
-    try:
-        from plone import api
-        api.portal.send_email(recipient=[addr_to], sender=addr_from,
-                              subject=message.get('subject'), body=message)
-    except ImportError:
-        mailer = getUtility(IMailDelivery, name="naaya-mail-delivery")
-        try:
-            mailer.send(addr_from, [addr_to], message.as_string())
-        except AssertionError:
-            mailer.send(addr_from, [addr_to], message)
+    """ Send `message` through the site's mail delivery, after the commit
+    """
+    mail_outbox.send_email(addr_from, [addr_to], message)
 
 
 class BulkUserImporter(BrowserView):
     """ A view to bulk import users from an xls file
     """
-    buttons = ('download_template', 'bulk_create')
+    buttons = ('download_template', 'bulk_create', 'bulk_progress',
+               'bulk_status')
     TEMPLATE_COLUMNS = [
         "First Name*",
         "Last Name*",
@@ -1294,7 +1254,9 @@ class BulkUserImporter(BrowserView):
             rows.append(ws.row_values(i))
 
         result = []
-        id_list = []
+        id_list = set()
+        # ids known to exist in LDAP, or not, for the whole import
+        taken = {}
 
         for record_number, row in enumerate(rows):
             try:
@@ -1310,8 +1272,8 @@ class BulkUserImporter(BrowserView):
             row_data['password'] = generate_password()
             row_data['id'] = generate_user_id(row_data['first_name'],
                                               row_data['last_name'],
-                                              agent, id_list)
-            id_list.append(row_data['id'])
+                                              agent, id_list, taken)
+            id_list.add(row_data['id'])
             row_data['url'] = process_url(row_data['url'])
             if row_data['phone'] is None:
                 row_data['phone'] = ''
@@ -1336,116 +1298,237 @@ class BulkUserImporter(BrowserView):
 
         users_data = []
         errors = []
-        successfully_imported = []
 
         user_form = deform.Form(user_info_add_schema)
 
         for record_number, row_data in enumerate(rows):
             try:
                 user_info = user_form.validate(row_data.items())
-                user_info['password'] = row_data['password']
             except deform.ValidationFailure, e:
                 for field_error in e.error.children:
                     errors.append('%s at row %d: %s' %
                                   (field_error.node.name, record_number + 1,
                                    field_error.msg))
             else:
-                users_data.append(user_info)
-
-        emails = [x['email'] for x in users_data]
-        usernames = [x['id'] for x in users_data]
-
-        if len(emails) != len(set(emails)):
-            for email in set(emails):
-                count = emails.count(email)
-
-                if count > 1:
-                    errors.append('Duplicate email: %s appears %d times'
-                                  % (email, count))
-                    users_data = filter(lambda x: x['email'] != email.lower(),
-                                        users_data)
-
-        if len(usernames) != len(set(usernames)):
-            for username in set(usernames):
-                count = usernames.count(username)
-
-                if count > 1:
-                    errors.append('Duplicate user ID: %s appears %d times'
-                                  % (username, count))
-                    users_data = filter(lambda x: x['id'] != username,
-                                        users_data)
-
-        existing_emails = set(agent.existing_emails(list(set(emails))))
-        existing_users = set(agent.existing_usernames(
-            list(set(usernames))))
-
-        if existing_emails:
-            for email in existing_emails:
-                errors.append("The following email is already in database: %s"
-                              % email)
-
-            for email in existing_emails:
-                users_data = filter(lambda x: x['email'] != email.lower(),
-                                    users_data)
-
-        if existing_users:
-            for user_id in existing_users:
-                errors.append("The following user ID is already registered: %s"
-                              % user_id)
-
-            for username in existing_users:
-                users_data = filter(lambda x: x['id'] != username, users_data)
-
-        for user_info in users_data:
-            user_info['search_helper'] = _transliterate(
-                user_info['first_name'], user_info['last_name'],
-                user_info.get('full_name_native', ''),
-                user_info.get('search_helper', ''))
-            user_id = user_info['id']
-            try:
-                self.context._create_user(agent, user_info,
-                                          send_helpdesk_email=True)
-            except Exception:
-                errors.append("Error creating %s user" % user_id)
-            else:
+                # the worker creating the user makes up its password, it's
+                # not to be kept with the job
+                del user_info['password']
+                users_data.append((record_number + 1, user_info))
+
+        emails = [x['email'] for _, x in users_data]
+        usernames = [x['id'] for _, x in users_data]
+        rejected_emails = set()
+        rejected_ids = set()
+
+        for email, count in sorted(email_check.repeated(emails).items()):
+            errors.append('Duplicate email: %s appears %d times'
+                          % (email, count))
+            rejected_emails.add(email)
+
+        for username, count in sorted(Counter(usernames).items()):
+            if count > 1:
+                errors.append('Duplicate user ID: %s appears %d times'
+                              % (username, count))
+                rejected_ids.add(username)
+
+        for email in email_check.existing(agent.existing_emails, emails):
+            errors.append("The following email is already in database: %s"
+                          % email)
+            rejected_emails.add(email.lower())
+
+        for user_id in email_check.existing(agent.existing_usernames,
+                                            usernames):
+            errors.append("The following user ID is already registered: %s"
+                          % user_id)
+            rejected_ids.add(user_id)
+
+        users_data = [(row, x) for row, x in users_data
+                      if x['email'].lower() not in rejected_emails and
+                      x['id'] not in rejected_ids]
+
+        if not users_data:
+            for err in errors:
+                msgs.add(err, type='error')
+            msgs.add('No user account created', type='error')
 
-                new_org_id = user_info['organisation']
-                new_org_id_valid = agent.org_exists(new_org_id)
+            return self.context._render_template('zpt/users/bulk_create.zpt')
 
-                if new_org_id_valid:
-                    self.context._add_to_org(agent, new_org_id, user_id)
+        helpers = transliteration.transliterate_all(
+            (user_info['first_name'], user_info['last_name'],
+             user_info.get('full_name_native', ''),
+             user_info.get('search_helper', ''))
+            for _, user_info in users_data)
 
-                try:
-                    self.context.send_confirmation_email(user_info)
-                except Exception, e:
-                    msgs.add("Error sending confirmation email to %s"
-                             % user_info['email'], type='error')
-                try:
-                    self.context.send_password_reset_email(user_info)
-                except Exception, e:
-                    msgs.add("Error: %s sending password reset email to %s"
-                             % (e, user_info['email']), type='error')
+        for (_, user_info), search_helper in zip(users_data, helpers):
+            user_info['search_helper'] = search_helper
 
-                msg = u"%s %s (%s)" % \
-                    (user_info['first_name'], user_info['last_name'], user_id)
-                successfully_imported.append(msg)
+        try:
+            runner = bulk_runner()
+        except ValueError, e:
+            log.error("Bulk creation is not available: %s", e)
+            msgs.add('Bulk creation is not available, please contact '
+                     'the helpdesk', type='error')
+            msgs.add('No user account created', type='error')
 
-        if errors:
-            for err in errors:
-                msgs.add(err, type='error')
+            return self.context._render_template('zpt/users/bulk_create.zpt')
+        job_id = runner.store.add_job(
+            self.context.getPhysicalPath(), logged_in_user(self.request),
+            users_data, errors)
+        runner.notify()
+
+        return self.request.RESPONSE.redirect(
+            '%s/@@bulk_create_user?bulk_progress=1&job=%s' % (
+                self.context.absolute_url(), job_id))
+
+    def create_bulk_user(self, agent, user_info):
+        """ Create one user of a bulk creation job; returns a tuple of the
+        status of the row and a message """
+        user_id = user_info['id']
+        user_info = dict(user_info, password=generate_password())
+        try:
+            self.context._create_user(agent, user_info,
+                                      send_helpdesk_email=True)
+        except Exception:
+            log.exception("Error creating %s user", user_id)
 
-        if successfully_imported:
-            msg = 'User(s) %s successfully created.' % \
-                ', '.join(successfully_imported)
-            msgs.add(msg, type='info')
-            logged_in = logged_in_user(self.request)
+            return bulk_jobs.FAILED, "Error creating %s user" % user_id
 
-            for user_id in successfully_imported:
-                log.info("%s CREATED USER %s", logged_in, user_id)
-        else:
-            msgs.add('No user account created', type='error')
+        new_org_id = user_info['organisation']
+        new_org_id_valid = agent.org_exists(new_org_id)
 
-        return self.context._render_template('zpt/users/bulk_create.zpt')
+        if new_org_id_valid:
+            self.context._add_to_org(agent, new_org_id, user_id)
+
+        messages = [u"%s %s (%s) created" % (user_info['first_name'],
+                                             user_info['last_name'], user_id)]
+        try:
+            self.context.send_confirmation_email(user_info)
+        except Exception:
+            messages.append("Error sending confirmation email to %s"
+                            % user_info['email'])
+        try:
+            self.context.send_password_reset_email(user_info)
+        except Exception, e:
+            messages.append("Error: %s sending password reset email to %s"
+                            % (e, user_info['email']))
+
+        log.info("%s CREATED USER %s", logged_in_user(self.request), user_id)
+
+        return bulk_jobs.DONE, u'; '.join(messages)
+
+    def bulk_progress(self):
+        """ page following the progress of a bulk creation job """
+        self.context._set_breadcrumbs([("Create Accounts from File", '#')])
+
+        return self.context._render_template(
+            'zpt/users/bulk_create_progress.zpt',
+            job_id=self.request.form.get('job'))
+
+    def bulk_status(self):
+        """ JSON with the progress of a bulk creation job of the
+        logged in user """
+        try:
+            runner = bulk_runner()
+            runner.start()
+            progress = runner.store.progress(
+                int(self.request.form.get('job')))
+        except (TypeError, ValueError):
+            progress = None
+        self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+
+        if (progress is not None and
+                progress['author'] != logged_in_user(self.request)):
+            progress = None
+
+        if progress is None:
+            self.request.RESPONSE.setStatus(404)
+
+        return json.dumps(progress)
+
+
+# number of threads creating the users of bulk creation jobs
+BULK_WORKERS = 4
+# set (e.g. to "on") in the environment of the one instance that resumes
+# the unfinished bulk creation jobs when it starts
+RESUME_BULK_JOBS = getattr(CONFIG, 'environment', {}).get('RESUME_BULK_JOBS',
+                                                         '')
+
+_bulk_runner = {}
+_bulk_runner_lock = threading.Lock()
+
+
+def bulk_runner():
+    """ The `bulk_jobs.JobRunner` of this process, started on first use by
+    a bulk creation request """
+    with _bulk_runner_lock:
+        if 'runner' not in _bulk_runner:
+            _bulk_runner['runner'] = bulk_jobs.JobRunner(
+                bulk_jobs.JobStore(), _process_bulk_rows, BULK_WORKERS)
+            _bulk_runner['runner'].start()
+
+        return _bulk_runner['runner']
+
+
+def start_bulk_jobs(event):
+    """ Resume the unfinished bulk creation jobs once Zope is started, in
+    the instance with RESUME_BULK_JOBS set """
+    if not RESUME_BULK_JOBS:
+        return
+    try:
+        bulk_runner()
+    except Exception:
+        log.exception("Could not resume the bulk creation jobs")
+
+
+def _process_bulk_rows(job, rows, report):
+    """ Create the users of `rows`, claimed from a bulk creation `job`.
+
+    Runs in a worker thread, with its own ZODB connection and a request
+    made up for the author of the job.
+    """
+    import Zope2
+    from AccessControl.SecurityManagement import (newSecurityManager,
+                                                  noSecurityManager)
+    from Products.CMFCore.interfaces import ISiteRoot
+    from Testing.makerequest import makerequest
+    from zope.component.hooks import setSite
+
+    app = makerequest(Zope2.app())
+    try:
+        tool = app.unrestrictedTraverse(job['tool_path'])
+
+        for obj in aq_chain(tool):
+            if ISiteRoot.providedBy(obj):
+                setSite(obj)
+                break
+        user = tool.acl_users.getUserById(job['author'])
+
+        if user is None:
+            # no one to create the users for, not even the system user
+            for row, user_info in rows:
+                report(row, bulk_jobs.FAILED,
+                       "%s, the author of the job, no longer exists; "
+                       "%s user not created" % (job['author'],
+                                                user_info['id']))
+
+            return
+        newSecurityManager(None, user)
+        app.REQUEST.AUTHENTICATED_USER = app.REQUEST['AUTHENTICATED_USER'] = \
+            user
+
+        importer = BulkUserImporter(tool, app.REQUEST)
+        agent = tool._get_ldap_agent(bind=True)
+
+        for row, user_info in rows:
+            status, message = importer.create_bulk_user(agent, user_info)
+            transaction.commit()
+            report(row, status, message)
+    finally:
+        transaction.abort()
+        noSecurityManager()
+        setSite(None)
+        app.REQUEST.close()
+        app._p_jar.close()
 
 
 class ResetUser(BrowserView):
@@ -1516,248 +1599,62 @@ class AutomatedUserDisabler(BrowserView):
     """ A view that will automatically disable users
     """
 
-    DISABLE_DELTA = timedelta(days=780)
-    ONE_MONTH = timedelta(days=30)
-    SERVICE_URL = "http://ldapmon.eea.europa.eu/export"
-    LDAP_PREDISABLE_FIELDNAME = "employeeNumber"
+    DISABLE_DELTA = auto_disable.DISABLE_DELTA
+    ONE_MONTH = auto_disable.ONE_MONTH
+    SERVICE_URL = auto_disable.SERVICE_URL
+    LDAP_PREDISABLE_FIELDNAME = auto_disable.LDAP_PREDISABLE_FIELDNAME
 
     def get_login_statistics(self):
-        data = requests.get(self.SERVICE_URL).json()
-
-        return data
+        return auto_disable.login_statistics(self.SERVICE_URL)
 
     def get_ldap_users(self):
-        result = []
-        reader = getUtility(IDumpReader)
-
-        for dn, attrs in reader.get_dump():
-            if not dn.startswith('uid='):
-                continue
-
-            if not attrs.get('mail'):   # probably a system user
-                continue
-            result.append(dict(
-                disabled=attrs.get('employeeType', 'enabled') in ['disabled'],
-                dn=dn,
-                email=attrs['mail'],
-                full_name=attrs['cn'],
-                pending_disable=attrs.get(self.LDAP_PREDISABLE_FIELDNAME),
-                username=attrs['uid'],
-            ))
-
-        return result
-
-    def predisable_users(self, agent, users):
-        for user in users:
-            log.warn("User will be disabled the next check %s",
-                     user['username'])
-            self.send_predisable_notification_email(user)
-            timestamp = datetime.now().isoformat()
-            try:
-                result = agent.conn.modify_s(
-                    agent._user_dn(user['username']),
-                    [(ldap.MOD_REPLACE, self.LDAP_PREDISABLE_FIELDNAME,
-                      timestamp), ]
-                )
-            except ldap.NO_SUCH_OBJECT:
-                log.info("Could not predisable user: %s", user['dn'])
-
-                continue
-            assert result[:2] == (ldap.RES_MODIFY, [])
-
-    def disable_users(self, agent, users):
-        for user in users:
-            username = user.get('username') or user.get('id')
-
-            if not username:
-                continue
-            log.warn("Disabling user %s", username)
-            agent.disable_user(username)
-            self.send_disable_notification_email(user)
-
-    def remove_pending_users(self, agent, users):
-        for user in users:
-            log.warn("Removing predisable for user %s", user['username'])
-            try:
-                result = agent.conn.modify_s(
-                    agent._user_dn(user['username']),
-                    [(ldap.MOD_REPLACE, self.LDAP_PREDISABLE_FIELDNAME, ''), ]
-                )
-            except ldap.NO_SUCH_OBJECT:
-                log.info("Could not remove predisable for user: %s",
-                         user['dn'])
+        """ Yield the users of the LDAP dump that have an email """
+        return auto_disable.user_records(ldapdump.users_cache.users())
 
-                continue
-            assert result[:2] == (ldap.RES_MODIFY, [])
+    def decide(self, users, users_stats, now):
+        """ Yield (action, user) for the `users` to 'predisable', 'disable'
+        or 'remove_pending', based on their last login in `users_stats` """
+        return auto_disable.decide(users, users_stats, now,
+                                   self.DISABLE_DELTA, self.ONE_MONTH)
 
     def __call__(self):
-        # call up the login service report
-        # make a list of all users from ldap that are not disabled
-        #       this list should have a "has been notified" value
-        # construct a list of users that should be disabled
-        #       also have a list of users that should be "predisabled"
-        # predisable users
-        # disable users
-        # send emails that they are disabled
-        # send emails to helpdesk that they have been disabled
-
+        """ Disable the users that haven't logged in for DISABLE_DELTA,
+        after warning them a month before; with `dry_run` in the request
+        only the report of what the dump shows would be done is returned
+        """
+        dry_run = bool(self.request.form.get('dry_run'))
         users_stats = self.get_login_statistics()
-        all_ldap_users = self.get_ldap_users()
-
-        agent = self.context.restrictedTraverse('ldap-roles')._get_ldap_agent(
-            bind=True)
-
         now = datetime.now()
-        users_to_disable = []
-        users_to_predisable = []
-        users_to_remove_pending = []
-
-        # only use all_ldap_users to provide a list of users
-
-        for user in all_ldap_users:
-            if user['disabled']:
-                continue
-            username = user['username']
-            try:
-                user = agent.user_info(user['username'])
-            except UserNotFound:
-                continue
-            user['username'] = username
-            last_login = users_stats.get(username)
-
-            if last_login:
-                last_login = parser.parse(last_login)
-                user['last_login'] = last_login
-
-                # check if the user has logged during in the one month period
-                pending_disable = user.get('pending_disable')
-
-                if pending_disable:
-                    pending_disable = parser.parse(pending_disable)
-
-                    if last_login > pending_disable:
-                        users_to_remove_pending.append(user)
 
-                        continue
+        decisions = auto_disable.group_decisions(
+            self.decide(self.get_ldap_users(), users_stats, now))
 
-                if last_login + self.DISABLE_DELTA < now:
-                    if pending_disable:
-                        if (pending_disable + self.ONE_MONTH) < now:
-                            # double check if everything is ok
+        if not dry_run and any(decisions.values()):
+            agent = self.context.restrictedTraverse(
+                'ldap-roles')._get_ldap_agent(bind=True)
+            # the dump may be stale, act on what LDAP says of the candidates
+            decisions = auto_disable.apply_decisions(
+                agent, decisions, users_stats, now, self.notifier(),
+                self.DISABLE_DELTA, self.ONE_MONTH)
+            user_roles.invalidate(*[user['username']
+                                    for user in decisions['disable']])
 
-                            if (last_login + self.DISABLE_DELTA +
-                                    self.ONE_MONTH) < now:
-                                users_to_disable.append(user)
-                    else:
-                        users_to_predisable.append(user)
-
-        self.predisable_users(agent, users_to_predisable)
-        self.disable_users(agent, users_to_disable)
-        self.remove_pending_users(agent, users_to_remove_pending)
-
-        self.send_admin_report_email(users_to_predisable, users_to_disable)
+        self.request.RESPONSE.setHeader('Content-Type', 'text/plain')
 
-        return "Predisabled %s users, disabled % users" % (
-            len(users_to_predisable), len(users_to_disable)
-        )
+        return self.report(decisions, dry_run)
 
-    def send_disable_notification_email(self, user):
-        site = api.portal.get()
-        addr_from = "no-reply@eea.europa.eu"
-        addr_to = user['email']
+    def report(self, decisions, dry_run=False):
+        """ What is (or, on a dry run, would be) done to which users """
+        return auto_disable.report(decisions, dry_run)
 
-        message = MIMEText('')
-        message['From'] = addr_from
-        message['To'] = addr_to
+    def notifier(self):
+        """ The `auto_disable.Notifier` sending the emails of the site """
+        def render(name, **options):
+            return self.context._render_template.render(
+                "zpt/users/" + name, **options)
 
-        options = deepcopy(user)
-        options['site_title'] = site.title
-
-        body = self.context._render_template.render(
-            "zpt/users/email_auto_disabled.zpt",
-            **options)
-
-        message['Subject'] = "[You have been automatically disabled]"
-        message.set_payload(body.encode('utf-8'), charset='utf-8')
-        _send_email(addr_from, addr_to, message)
-
-    def send_predisable_notification_email(self, user):
-        site = api.portal.get()
-        addr_from = "no-reply@eea.europa.eu"
-        addr_to = user['email']
-
-        message = MIMEText('')
-        message['From'] = addr_from
-        message['To'] = addr_to
-
-        options = deepcopy(user)
-        options['site_title'] = site.title
-
-        body = self.context._render_template.render(
-            "zpt/users/email_auto_predisabled.zpt",
-            **options)
-
-        message['Subject'] = "[You will be automatically disabled]"
-        message.set_payload(body.encode('utf-8'), charset='utf-8')
-        _send_email(addr_from, addr_to, message)
-
-    def send_admin_report_email(self, users_to_predisable, users_to_disable):
-        site = api.portal.get()
-        addr_from = "no-reply@eea.europa.eu"
-        addr_to = 'helpdesk@eea.europa.eu'
-
-        message = MIMEText('')
-        message['From'] = addr_from
-        message['To'] = addr_to
-
-        options = {}
-        options['users_predisable'] = users_to_predisable
-        options['users_disable'] = users_to_disable
-        options['site_title'] = site.title
-        options['days'] = (self.DISABLE_DELTA + self.ONE_MONTH).days
-
-        body = self.context._render_template.render(
-            "zpt/users/email_report_autodisable.zpt",
-            **options)
-
-        message['Subject'] = "[Report on auto-disabled users]"
-        message.set_payload(body.encode('utf-8'), charset='utf-8')
-        _send_email(addr_from, addr_to, message)
-
-
-def auto_disable_users():
-    """ A script to automatically disable users
-
-    Should be run as ``bin/zope-instance run /path/to/this/disable_users.py``
-    """
-
-    from AccessControl.SecurityManagement import newSecurityManager
-    from AccessControl.SpecialUsers import system
-    from Globals import DB
-    from Testing.makerequest import makerequest
-    from zope.component import getMultiAdapter
-    import transaction
-
-    app = DB.open().root()['Application']
-
-    def spoofRequest(app):
-        admin = app.acl_users.getUserById("admin")
-        newSecurityManager(None, admin)
-
-        return makerequest(app)
-
-    app = spoofRequest(app)
-
-    site = app['nfp-eionet']
-    users = site['users']
-    request = users.REQUEST
-    system.id = u'SystemUser'
-    request.AUTHENTICATED_USER = request['AUTHENTICATED_USER'] = system
-    view = getMultiAdapter((users, request), name="auto_disable_users")
-    view()
-
-    transaction.commit()
-    app._p_jar.sync()
+        return auto_disable.Notifier(render, _send_email,
+                                     api.portal.get().title)
 
 
 def check_valid_email(node, value):
@@ -1770,35 +1667,5 @@ def check_valid_email(node, value):
 
 
 def _transliterate(first_name, last_name, full_name_native, search_helper):
-    vocab = set(first_name.split(' ') + last_name.split(' ') +
-                full_name_native.split(' ') + search_helper.split(' '))
-    langs = get_available_language_codes()
-    ascii_values = []
-    translate_table = {
-        0xe4: ord('a'),
-        0xc4: ord('A'),
-        0xf6: ord('o'),
-        0xd6: ord('O'),
-        0xfc: ord('u'),
-        0xdc: ord('U'),
-    }
-
-    for name in vocab:
-        ascii_values.append(unidecode(name))
-
-        for lang in langs:
-            try:
-                ascii_values.append(
-                    str(translit(name, lang, reversed=True)))
-            except UnicodeEncodeError:
-                # if we encounter other characters = other languages
-                # than German
-                pass
-        try:
-            ascii_values.append(
-                str(name.replace(u'\xdf', 'ss').translate(translate_table)))
-        except UnicodeEncodeError:
-            # if we encounter other characters = other languages than German
-            pass
-
-    return ' '.join(sorted(set(ascii_values))).strip()
+    return transliteration.transliterate(first_name, last_name,
+                                         full_name_native, search_helper)
@@ -1,27 +1,49 @@
 $(document).ready(function(){
+    var render = function(parentdiv, service, uid, answer){
+        var rolesdiv = $("div.roles", parentdiv);
+        var latency = " (" + answer['latency'] + "s)";
+        if (answer['error']) {
+            rolesdiv.html("");
+            rolesdiv.text(service + " did not answer: " + answer['error'] +
+                          latency);
+            return;
+        }
+        var roles = answer['data'][uid] || [];
+        var ul = $("<ul>");
+        for(var i=0; i<roles.length; i++){
+            var role = roles[i];
+            var li = $("<li>" + role['roles'].join(", ") + " in " +
+            "<a href=\"" + role['ob_url'] +
+                      "\" target=\"blank\">" + role['ob_title']
+                      + "</a></li>");
+            ul.append(li);
+        }
+        if (roles.length) {
+            rolesdiv.html("");
+            rolesdiv.append(ul);
+            rolesdiv.append($("<small>").text("Answered in" + latency));
+        } else {
+            rolesdiv.html("No roles found for this user in " + service +
+                          latency);
+        }
+    };
+
     $("div.eionet-profile a.trigger").click(function(){
-       $(this).hide();
-       var parentdiv = $(this).parent("div.eionet-profile");
-       var service = $("h2", parentdiv).text().trim();
-       var uid = parentdiv.data("uid");
-       var rolesdiv = $("div.roles", parentdiv);
-       rolesdiv.show();
-       $.post("get_endpoint", {service: service, userid: uid}, function(data){
-            var ul = $("<ul>");
-            for(var i=0; i<data[uid].length; i++){
-                var role = data[uid][i];
-                var li = $("<li>" + role['roles'].join(", ") + " in " +
-                "<a href=\"" + role['ob_url'] +
-                          "\" target=\"blank\">" + role['ob_title']
-                          + "</a></li>");
-                ul.append(li);
-            }
-            if (data[uid].length) {
-                rolesdiv.html("");
-                rolesdiv.append(ul);
-            } else {
-                rolesdiv.html("No roles found for this user in " + service);
-            }
-        }, 'json');
+       var profiles = $("div.eionet-profile");
+       $("a.trigger", profiles).hide();
+       $("div.roles", profiles).show();
+       // one request per service, each shown as soon as it answers
+       profiles.each(function(){
+            var parentdiv = this;
+            var service = $("h2", parentdiv).text().trim();
+            var uid = $(parentdiv).data("uid");
+            $.post("get_endpoint", {service: service, userid: uid},
+                   function(answer){
+                render(parentdiv, service, uid, answer);
+            }, 'json').fail(function(){
+                $("div.roles", parentdiv).text(service +
+                                               " could not be asked");
+            });
+        });
        });
-});
\ No newline at end of file
+});
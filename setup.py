@@ -34,8 +34,7 @@ setup(name='eea.ldapadmin',
                     ['dump_ldap = eea.ldapadmin.ldapdump:dump_ldap',
                      'update_countries = '
                      'eea.ldapadmin.countries:update_countries',
-                     'auto_disable_users = eea.ldapadmin.users_admin:' +
-                     'auto_disable_users'
+                     'auto_disable_users = eea.ldapadmin.auto_disable:main'
                      ]
                     },
       )